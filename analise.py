@@ -0,0 +1,285 @@
+import numpy as np
+import pandas as pd
+import streamlit as st
+from textos import TEXTOS
+from supabase_db import get_supabase_client, get_setting, fetch_all_rows
+from calculadora import (display_error, get_variables_snapshot, index_catalog,
+                         CostEvaluator)
+from formulas import normalize_name, FormulaError
+from perfil import span
+
+# --- Cenários de Custo ---
+#
+# Um cenário sobrepõe alguns valores de variaveis_custos (percentual ou valor
+# fixo) sem alterar o banco. Cada fórmula é avaliada uma única vez para todos
+# os cenários: as variáveis alteradas viram arrays NumPy (coluna 0 = base) e
+# o resultado é uma matriz produtos × cenários.
+
+TIPOS_ALTERACAO = {"%": "Percentual (%)", "=": "Valor fixo"}
+
+# variação aplicada a cada variável na análise de sensibilidade, em %
+SENSIBILIDADE_PASSO = float(get_setting("SENSIBILIDADE_PASSO", 1))
+
+
+def load_products():
+    """Todos os produtos como [(id, nome, (fórmula, fórmula pré-processada))],
+    lidos em lotes."""
+    sb = get_supabase_client()
+    return [(r["id"], r["nome"], (r.get("formula"), r.get("formula_compilada")))
+            for r in fetch_all_rows(sb, "produtos_custos",
+                                    "id, nome, formula, formula_compilada")]
+
+
+def products_catalog(products):
+    """Catálogo para o CostEvaluator a partir de load_products(): os
+    componentes dos produtos compostos sem consultar o banco de novo."""
+    return lambda: ({pid: formula for pid, _, formula in products},
+                    {pid: nome for pid, nome, _ in products})
+
+
+def scenario_values(snapshot, scenarios):
+    """
+    Valores das variáveis alteradas em cada cenário.
+    `scenarios` é uma lista de {"nome": ..., "alteracoes": {variável: (tipo,
+    valor)}}, com tipo "%" (variação percentual) ou "=" (valor fixo).
+    Retorna {nome_normalizado: array}, com a base na posição 0 e o cenário i
+    na posição i + 1; variáveis não alteradas ficam de fora (valor da base).
+    """
+    size = len(scenarios) + 1
+    values = {}
+    for i, scenario in enumerate(scenarios, start=1):
+        for name, (kind, amount) in scenario["alteracoes"].items():
+            key = normalize_name(name)
+            if key not in snapshot.values:
+                raise FormulaError(
+                    f"Variável '{name}' do cenário '{scenario['nome']}' não encontrada")
+            if key not in values:
+                values[key] = np.full(size, snapshot.values[key])
+            base = snapshot.values[key]
+            values[key][i] = base * (1 + amount / 100) if kind == "%" else amount
+    return values
+
+
+def evaluate_scenarios(products, scenarios, snapshot=None):
+    """
+    Custos de [(id, nome, (fórmula, fórmula pré-processada))] em cada
+    cenário. Retorna uma matriz (produtos × (1 + cenários)): coluna 0 com a
+    base e NaN onde a fórmula tem erro. Os componentes dos produtos
+    compostos são avaliados uma única vez por cenário.
+    """
+    snapshot = snapshot or get_variables_snapshot()
+    size = len(scenarios) + 1
+    changed = scenario_values(snapshot, scenarios)
+    # valores por nome (fórmulas só em texto) e por id (pré-processadas)
+    by_name = {**snapshot.values, **changed}
+    by_id = {**snapshot.by_id, **{snapshot.ids[k]: v for k, v in changed.items()}}
+    evaluator = CostEvaluator(snapshot, products_catalog(products), size,
+                              by_id, by_name)
+    by_formula = {}
+    for row, (_, _, formula) in enumerate(products):
+        by_formula.setdefault(formula, []).append(row)
+
+    result = np.full((len(products), size), np.nan)
+    with span("fórmulas", "cenários", len(by_formula)):
+        for (formula, tokens), rows in by_formula.items():
+            if not tokens and (not formula or not formula.strip()):
+                continue
+            try:
+                result[rows] = evaluator.evaluate(formula, tokens)
+            except FormulaError:
+                continue
+    return result
+
+
+def scenarios_table(products, scenarios, costs):
+    """DataFrame de comparação: custo base e, por cenário, custo e variação."""
+    table = {"Produto": [nome for _, nome, _ in products], "Base": costs[:, 0]}
+    base = costs[:, 0]
+    with np.errstate(all="ignore"):
+        for i, scenario in enumerate(scenarios, start=1):
+            table[scenario["nome"]] = costs[:, i]
+            table[f"Δ% {scenario['nome']}"] = np.where(
+                base != 0, (costs[:, i] - base) / np.abs(base) * 100, np.nan)
+    return pd.DataFrame(table)
+
+
+# --- Sensibilidade ---
+#
+# A sensibilidade de um produto a uma variável é a variação do custo quando
+# a variável sobe SENSIBILIDADE_PASSO % (diferença central entre +passo e
+# -passo). Cada fórmula distinta é avaliada uma única vez: com k variáveis,
+# um array de 1 + 2k posições (base, +passo e -passo de cada variável). Nos
+# produtos compostos, entram também as variáveis dos componentes.
+
+
+def formula_sensitivities(formulas, snapshot=None, step=SENSIBILIDADE_PASSO,
+                          catalog=index_catalog):
+    """
+    Sensibilidade de cada fórmula, [(texto, fórmula pré-processada ou
+    None)], a cada variável de que ela depende. Retorna, na mesma ordem,
+    {nome da variável: (Δ custo, Δ custo em %)} ou None para fórmula vazia
+    ou com erro. `catalog` fornece os componentes (ver CostEvaluator).
+    """
+    snapshot = snapshot or get_variables_snapshot()
+    with span("fórmulas", "sensibilidade") as info:
+        results = _sensitivities(formulas, snapshot, step, catalog)
+        info["count"] = len(results)
+    return [results[f] for f in formulas]
+
+
+def _sensitivities(formulas, snapshot, step, catalog):
+    results = {}
+    base = CostEvaluator(snapshot, catalog)
+    for item in formulas:
+        if item in results:
+            continue
+        results[item] = None
+        formula, tokens = item
+        if not tokens and (not formula or not formula.strip()):
+            continue
+        try:
+            names = base.variables(formula, tokens)
+            values = base.by_id if tokens else base.by_name
+            size = 1 + 2 * len(names)
+            env = {}
+            for j, name in enumerate(names):
+                env[name] = np.full(size, values[name])
+                env[name][1 + 2 * j] *= 1 + step / 100
+                env[name][2 + 2 * j] *= 1 - step / 100
+            # memo próprio: os componentes dependem dos valores alterados
+            evaluator = CostEvaluator(snapshot, base.catalog_data, size, env, env)
+            costs = evaluator.evaluate(formula, tokens)
+        except (FormulaError, KeyError):
+            continue
+        if np.isnan(costs[0]):
+            continue
+        sens = {}
+        for j, name in enumerate(names):
+            delta = float(costs[1 + 2 * j] - costs[2 + 2 * j]) / 2
+            relative = delta / abs(costs[0]) * 100 if costs[0] else float("nan")
+            sens[snapshot.label(name)] = (delta, relative)
+        results[item] = sens
+    return results
+
+
+def sensitivity_table(products, sensitivities):
+    """DataFrame longo: uma linha por (produto, variável)."""
+    rows = [(nome, variable, delta, relative)
+            for (_, nome, _), sens in zip(products, sensitivities) if sens
+            for variable, (delta, relative) in sens.items()]
+    return pd.DataFrame(rows, columns=["Produto", "Variável", "Δ custo", "Δ %"])
+
+
+def rank_variables(table):
+    """Ranking das variáveis pelo impacto somado no catálogo."""
+    table = table.assign(impacto=table["Δ custo"].abs())
+    ranking = table.groupby("Variável").agg(
+        Produtos=("Produto", "count"),
+        **{"Impacto total": ("impacto", "sum"),
+           "Impacto médio": ("impacto", "mean"),
+           "Maior Δ %": ("Δ %", lambda s: s.abs().max())})
+    return ranking.sort_values("Impacto total", ascending=False).reset_index()
+
+
+def _parse_scenarios(editor):
+    """Agrupa as linhas do editor (Cenário, Variável, Tipo, Valor) em
+    cenários, na ordem em que aparecem."""
+    scenarios = {}
+    for row in editor.to_dict("records"):
+        nome = str(row.get("Cenário") or "").strip()
+        variavel = row.get("Variável")
+        if not nome or not variavel or pd.isna(row.get("Valor")):
+            continue
+        kind = "%" if row.get("Tipo") == TIPOS_ALTERACAO["%"] else "="
+        scenarios.setdefault(nome, {"nome": nome, "alteracoes": {}})
+        scenarios[nome]["alteracoes"][variavel] = (kind, float(row["Valor"]))
+    return list(scenarios.values())
+
+
+# --- Funções de UI ---
+
+
+def show_scenarios():
+    st.subheader(TEXTOS["cen_titulo"])
+    st.caption(TEXTOS["cen_descricao"])
+    try:
+        snapshot = get_variables_snapshot()
+    except Exception as e:
+        display_error(f"Erro ao buscar todas as variáveis: {e}", e)
+        return
+
+    if "cen_editor_dados" not in st.session_state:
+        st.session_state.cen_editor_dados = pd.DataFrame(
+            {"Cenário": pd.Series(dtype=str), "Variável": pd.Series(dtype=str),
+             "Tipo": pd.Series(dtype=str), "Valor": pd.Series(dtype=float)})
+    editor = st.data_editor(
+        st.session_state.cen_editor_dados, num_rows="dynamic", key="cen_editor",
+        use_container_width=True,
+        column_config={
+            "Cenário": st.column_config.TextColumn(required=True),
+            "Variável": st.column_config.SelectboxColumn(
+                options=sorted(snapshot.names.values(), key=str.lower), required=True),
+            "Tipo": st.column_config.SelectboxColumn(
+                options=list(TIPOS_ALTERACAO.values()),
+                default=TIPOS_ALTERACAO["%"], required=True),
+            "Valor": st.column_config.NumberColumn(required=True),
+        })
+
+    if st.button("Calcular cenários", key="cen_calcular"):
+        scenarios = _parse_scenarios(editor)
+        if not scenarios:
+            display_error("Defina ao menos um cenário com uma variável alterada.")
+            return
+        try:
+            with st.spinner("Calculando..."):
+                products = load_products()
+                costs = evaluate_scenarios(products, scenarios, snapshot)
+            st.session_state.cen_resultado = scenarios_table(products, scenarios, costs)
+        except Exception as e:
+            display_error(f"Erro ao calcular cenários: {e}", e)
+            return
+
+    result = st.session_state.get("cen_resultado")
+    if result is not None:
+        st.dataframe(
+            result, hide_index=True, use_container_width=True,
+            column_config={
+                col: st.column_config.NumberColumn(
+                    format="%.2f%%" if col.startswith("Δ%") else "R$ %.2f")
+                for col in result.columns if col != "Produto"})
+
+
+def show_sensitivity():
+    st.subheader(TEXTOS["sens_titulo"])
+    st.caption(TEXTOS["sens_descricao"].format(passo=f"{SENSIBILIDADE_PASSO:g}"))
+    if st.button("Calcular sensibilidade", key="sens_calcular"):
+        try:
+            with st.spinner("Calculando..."):
+                snapshot = get_variables_snapshot()
+                products = load_products()
+                sens = formula_sensitivities([f for _, _, f in products], snapshot,
+                                             catalog=products_catalog(products))
+                st.session_state.sens_resultado = sensitivity_table(products, sens)
+        except Exception as e:
+            display_error(f"Erro ao calcular sensibilidade: {e}", e)
+            return
+
+    table = st.session_state.get("sens_resultado")
+    if table is None:
+        return
+    if table.empty:
+        st.info("Nenhum produto com fórmula válida.")
+        return
+    money = st.column_config.NumberColumn(format="R$ %.4f")
+    percent = st.column_config.NumberColumn(format="%.3f%%")
+    ranking = rank_variables(table)
+    st.dataframe(ranking, hide_index=True, use_container_width=True,
+                 column_config={"Impacto total": money, "Impacto médio": money,
+                                "Maior Δ %": percent})
+    variable = st.selectbox("Produtos mais sensíveis à variável",
+                            ranking["Variável"], key="sens_variavel")
+    detail = table[table["Variável"] == variable]
+    detail = detail.reindex(detail["Δ custo"].abs().sort_values(ascending=False).index)
+    st.dataframe(detail[["Produto", "Δ custo", "Δ %"]], hide_index=True,
+                 use_container_width=True,
+                 column_config={"Δ custo": money, "Δ %": percent})
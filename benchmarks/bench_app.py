@@ -0,0 +1,203 @@
+"""
+Benchmark do app sobre um catálogo sintético no banco local (SQLite):
+avaliação de fórmulas, histórico de custos, paginação das listagens e
+gravações em lote.
+
+Uso: python benchmarks/bench_app.py [--produtos 5000] [--variaveis 500]
+                                    [--saida resultado.json]
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+
+def configurar_ambiente(caminho):
+    # precisa vir antes de importar os módulos do app
+    os.environ["BACKEND"] = "sqlite"
+    os.environ["SQLITE_PATH"] = caminho
+    # o recálculo em segundo plano não pode rodar durante as medições
+    os.environ["RECALCULO_DEBOUNCE"] = "3600"
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+
+def versao():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cronometrar(func, repeticoes=1):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        resultado = func()
+    return (time.perf_counter() - inicio) / repeticoes, resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--categorias", type=int, default=20)
+    parser.add_argument("--variaveis", type=int, default=500)
+    parser.add_argument("--produtos", type=int, default=5000)
+    parser.add_argument("--termos-min", type=int, default=1)
+    parser.add_argument("--termos-max", type=int, default=12)
+    parser.add_argument("--compostos", type=float, default=0.2,
+                        help="fração dos produtos feita de outros produtos")
+    parser.add_argument("--gravacoes", type=int, default=200,
+                        help="produtos gravados um a um e via importação")
+    parser.add_argument("--alteracoes", type=int, default=50000,
+                        help="alterações de valor no histórico das variáveis")
+    parser.add_argument("--repeticoes", type=int, default=5)
+    parser.add_argument("--saida", help="arquivo JSON (padrão: stdout)")
+    args = parser.parse_args()
+
+    pasta = tempfile.mkdtemp(prefix="bench_custos_")
+    configurar_ambiente(os.path.join(pasta, "custos.db"))
+
+    from catalogo import gerar_catalogo
+    from supabase_db import get_supabase_client
+    from formulas import compile_formula
+    import calculadora
+    import importacao
+    import producao
+    import busca
+    import historico
+    import analise
+    from recalculo import RecomputeWorker
+
+    sb = get_supabase_client()
+    r = {}
+    r["geracao_catalogo_s"], catalogo = cronometrar(lambda: gerar_catalogo(
+        sb, args.categorias, args.variaveis, args.produtos,
+        args.termos_min, args.termos_max, compostos=args.compostos))
+    linhas = sb.table("produtos_custos").select("formula, formula_compilada").execute().data
+    formulas = [row["formula"] for row in linhas]
+    pre_processadas = [row["formula_compilada"] for row in linhas]
+
+    # --- avaliação de fórmulas ---
+    calculadora.invalidate_variables_cache()
+    r["carga_variaveis_s"], _ = cronometrar(calculadora.get_variables_snapshot)
+    amostra = formulas[:min(len(formulas), 1000)]
+    compile_formula.cache_clear()
+    t, _ = cronometrar(lambda: [calculadora.calculate_cost(f) for f in amostra])
+    r["calculate_cost_frio_us"] = t / len(amostra) * 1e6
+    t, _ = cronometrar(lambda: [calculadora.calculate_cost(f) for f in amostra],
+                       args.repeticoes)
+    r["calculate_cost_quente_us"] = t / len(amostra) * 1e6
+    r["calculate_costs_catalogo_s"], _ = cronometrar(
+        lambda: calculadora.calculate_costs(formulas, show_errors=False),
+        args.repeticoes)
+    r["calculate_costs_pre_processadas_s"], _ = cronometrar(
+        lambda: calculadora.calculate_costs(formulas, show_errors=False,
+                                            tokens=pre_processadas),
+        args.repeticoes)
+
+    # catálogo inteiro com um avaliador: componentes calculados uma vez só
+    snapshot = calculadora.get_variables_snapshot()
+
+    def custos_catalogo():
+        avaliador = calculadora.CostEvaluator(snapshot, calculadora.index_catalog)
+        for pid in catalogo["produtos"]:
+            avaliador.cost(pid)
+        return avaliador.evaluated
+
+    calculadora.get_product_index()
+    r["custos_catalogo_compostos_s"], r["avaliacoes_catalogo"] = cronometrar(
+        custos_catalogo, args.repeticoes)
+
+    # --- histórico: catálogo em uma data passada e séries de custos ---
+    # alterações sintéticas ao longo de um ano, só em memória
+    rnd = random.Random(3)
+    fim = time.time()
+    inicio = fim - 365 * 86400
+    variaveis = list(snapshot.rows)
+    alteracoes = sorted(
+        ((rnd.choice(variaveis), rnd.uniform(1, 100), rnd.uniform(inicio, fim))
+         for _ in range(args.alteracoes)), key=lambda a: a[2])
+    r["historico_carga_s"], historia = cronometrar(
+        lambda: historico.VariableHistory(alteracoes))
+    historico._history_state()["history"] = historia
+    produtos = analise.load_products()
+    meio = (inicio + fim) / 2
+    r["historico_valores_em_ms"], _ = cronometrar(
+        lambda: historia.values_at(meio, snapshot.by_id), args.repeticoes)
+    r["historico_valores_em_ms"] *= 1e3
+    r["historico_catalogo_em_s"], _ = cronometrar(
+        lambda: historico.costs_at(produtos, meio, snapshot=snapshot), args.repeticoes)
+    amostra_serie = produtos[:50]
+    r["historico_serie_50_produtos_s"], (instantes, _) = cronometrar(
+        lambda: historico.cost_series(amostra_serie, inicio, fim, snapshot=snapshot),
+        args.repeticoes)
+    r["historico_serie_pontos"] = len(instantes)
+
+    # --- paginação ---
+    busca.invalidate_search_index()
+    r["indice_busca_produtos_s"], _ = cronometrar(
+        lambda: busca.get_search_index("produtos_custos"))
+    _, paginas, _ = producao.get_products()
+    _, paginas_var, _ = producao.get_variables()
+    casos = {
+        "produtos_primeira_pagina_ms": lambda: producao.get_products(page=1),
+        "produtos_ultima_pagina_ms": lambda: producao.get_products(page=paginas),
+        "produtos_cursor_ms": lambda: producao.get_products(
+            after_id=catalogo["produtos"][len(catalogo["produtos"]) // 2]),
+        "produtos_busca_ms": lambda: producao.get_products(search_term="produto 1"),
+        "produtos_ordem_custo_ms": lambda: producao.get_products(
+            order_by=("custo_calculado", True)),
+        "variaveis_primeira_pagina_ms": lambda: producao.get_variables(page=1),
+        "variaveis_ultima_pagina_ms": lambda: producao.get_variables(page=paginas_var),
+        "variaveis_busca_ms": lambda: producao.get_variables(search_term="frete"),
+    }
+    for nome, func in casos.items():
+        t, _ = cronometrar(func, args.repeticoes)
+        r[nome] = t * 1e3
+
+    # --- gravações ---
+    calculadora.invalidate_variables_cache()
+    t, _ = cronometrar(lambda: [
+        producao.add_product(f"Novo {i}", formulas[i % len(formulas)], None)
+        for i in range(args.gravacoes)])
+    r["add_product_ms"] = t / args.gravacoes * 1e3
+    csv = "nome,formula\n" + "".join(
+        f"Importado {i},\"{formulas[i % len(formulas)]}\"\n" for i in range(args.gravacoes))
+    t, relatorio = cronometrar(
+        lambda: importacao.import_products(io.BytesIO(csv.encode()), "csv"))
+    r["importacao_por_produto_ms"] = t / args.gravacoes * 1e3
+    r["importacao_rejeitados"] = relatorio["rejeitados"]
+    valores = {f"peso_bench_{i}": float(i) for i in range(args.gravacoes)}
+    t, _ = cronometrar(lambda: calculadora.update_calc_variables(valores))
+    r["update_calc_variables_lote_ms"] = t * 1e3
+    worker = RecomputeWorker(sb, start=False)
+    r["recalculo_catalogo_s"], _ = cronometrar(worker.recompute_now)
+
+    resultado = {
+        "versao": versao(),
+        "data": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "parametros": {k: v for k, v in vars(args).items() if k != "saida"},
+        "resultados": r,
+    }
+    shutil.rmtree(pasta, ignore_errors=True)
+    texto = json.dumps(resultado, indent=2)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            f.write(texto)
+    else:
+        print(texto)
+
+
+if __name__ == "__main__":
+    main()
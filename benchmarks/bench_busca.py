@@ -0,0 +1,92 @@
+"""
+Benchmark do índice de busca por nome (busca.py) com muitos nomes.
+
+Uso: python benchmarks/bench_busca.py [--nomes 100000] [--consultas 200]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+from bench_tokenizer import gerar_nomes  # noqa: E402
+from busca import SearchIndex, fold  # noqa: E402
+
+
+def cronometrar(func, repeticoes=1):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        resultado = func()
+    return (time.perf_counter() - inicio) / repeticoes, resultado
+
+
+def errar(palavra, rnd):
+    # troca uma letra do meio, como um erro de digitação
+    i = rnd.randrange(1, len(palavra) - 1)
+    return palavra[:i] + rnd.choice("aeiourst") + palavra[i + 1:]
+
+
+def gerar_consultas(nomes, total, rnd):
+    """Termos por tipo: nome quase inteiro, palavra + número, prefixo curto
+    e palavra com erro de digitação."""
+    amostra = [fold(rnd.choice(nomes)).split() for _ in range(total)]
+    return {
+        "nome": [" ".join(p) for p in amostra],
+        "palavra_numero": [f"{p[0]} {p[-1][:3]}" for p in amostra],
+        "prefixo": [p[0][:2] for p in amostra],
+        "erro_digitacao": [errar(max(p, key=len), rnd) for p in amostra],
+    }
+
+
+def medir(index, termos):
+    tempos, resultados = [], 0
+    for termo in termos:
+        t, ids = cronometrar(lambda: index.search(termo))
+        tempos.append(t * 1e3)
+        resultados += len(ids)
+    tempos.sort()
+    return {
+        "mediana_ms": statistics.median(tempos),
+        "p95_ms": tempos[int(len(tempos) * 0.95) - 1],
+        "resultados_medio": resultados / len(termos),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--nomes", type=int, default=100000)
+    parser.add_argument("--consultas", type=int, default=200)
+    args = parser.parse_args()
+
+    rnd = random.Random(7)
+    nomes = gerar_nomes(args.nomes)
+    t_indice, index = cronometrar(
+        lambda: SearchIndex((i, n, i % 20) for i, n in enumerate(nomes)))
+    t_put, _ = cronometrar(lambda: [index.put(i, f"{nomes[i]} novo", 0)
+                                    for i in range(1000)])
+
+    resultado = {
+        "nomes": args.nomes,
+        "consultas": args.consultas,
+        "indice_s": t_indice,
+        "atualizacao_us": t_put / 1000 * 1e6,
+    }
+    for tipo, termos in gerar_consultas(nomes, args.consultas, rnd).items():
+        resultado[tipo] = medir(index, termos)
+
+    # referência: varredura linear, como um ilike '%termo%' sem índice
+    chaves = [fold(n) for n in nomes]
+    termo = fold(nomes[len(nomes) // 2]).split()[-1]
+    t_linear, _ = cronometrar(lambda: [c for c in chaves if termo in c], 5)
+    resultado["varredura_linear_ms"] = t_linear * 1e3
+    print(json.dumps(resultado, indent=2))
+
+
+if __name__ == "__main__":
+    main()
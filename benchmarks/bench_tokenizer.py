@@ -0,0 +1,107 @@
+"""
+Benchmark do tokenizador de fórmulas com muitas variáveis.
+
+Uso: python benchmarks/bench_tokenizer.py [--variaveis 50000] [--legado]
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from formulas import Vocabulary, compile_formula, normalize_name  # noqa: E402
+
+PALAVRAS = ["ps", "branco", "preto", "frete", "mao", "obra", "placa", "custo",
+            "embalagem", "energia", "kg", "caixa", "tinta", "cola", "corte"]
+
+
+def gerar_nomes(total, seed=42):
+    rnd = random.Random(seed)
+    nomes = set()
+    while len(nomes) < total:
+        partes = rnd.sample(PALAVRAS, rnd.randint(1, 3)) + [str(len(nomes))]
+        sep = rnd.choice([" ", "_"])
+        nome = sep.join(partes)
+        if rnd.random() < 0.05:
+            nome += " (%)"
+        nomes.add(nome.upper() if rnd.random() < 0.3 else nome)
+    return sorted(nomes)
+
+
+def gerar_formula(nomes, termos, rnd):
+    partes = []
+    for _ in range(termos):
+        nome = rnd.choice(nomes)
+        # escreve com espaço ou underscore, como o usuário digitaria
+        nome = nome.replace(" ", rnd.choice([" ", "_"]))
+        partes.append(f"{nome} * {rnd.randint(1, 9)},5")
+    return " + ".join(partes)
+
+
+def calculo_legado(formula, variables):
+    # implementação anterior de calculate_cost (regex + busca linear)
+    patterns = [re.escape(n).replace(r"\ ", r"[ _]") for n in variables]
+    regex = re.compile(r"\b(?:" + "|".join(patterns) + r")\b", flags=re.IGNORECASE)
+
+    def repl(m):
+        key_lc = m.group(0).replace("_", " ").strip().lower()
+        actual = next((k for k in variables if k.lower() == key_lc), None)
+        return "0" if actual is None else str(variables[actual])
+    expr = regex.sub(repl, formula).replace(" ", "").replace(",", ".")
+    try:
+        return float(eval(expr, {"__builtins__": None}, {}))
+    except SyntaxError:
+        # a versão anterior não reconhecia nomes terminados em símbolo
+        return None
+
+
+def cronometrar(func, repeticoes=1):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        resultado = func()
+    return (time.perf_counter() - inicio) / repeticoes, resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--variaveis", type=int, default=50000)
+    parser.add_argument("--formulas", type=int, default=200)
+    parser.add_argument("--termos", type=int, default=8)
+    parser.add_argument("--legado", action="store_true",
+                        help="mede também a implementação anterior (lenta)")
+    args = parser.parse_args()
+
+    rnd = random.Random(7)
+    nomes = gerar_nomes(args.variaveis)
+    values = {normalize_name(n): rnd.random() * 100 for n in nomes}
+    formulas = [gerar_formula(nomes, args.termos, rnd) for _ in range(args.formulas)]
+    tokens = sum(len(f.split()) for f in formulas)
+
+    t_vocab, vocabulary = cronometrar(lambda: Vocabulary(values))
+    compile_formula.cache_clear()
+    t_compile, compiled = cronometrar(
+        lambda: [compile_formula(f, vocabulary) for f in formulas])
+    t_eval, _ = cronometrar(lambda: [c.evaluate(values) for c in compiled], 20)
+
+    resultado = {
+        "variaveis": args.variaveis,
+        "formulas": args.formulas,
+        "termos_por_formula": args.termos,
+        "vocabulario_s": t_vocab,
+        "compilacao_por_formula_us": t_compile / args.formulas * 1e6,
+        "compilacao_por_token_us": t_compile / tokens * 1e6,
+        "avaliacao_por_formula_us": t_eval / args.formulas * 1e6,
+    }
+    if args.legado:
+        originais = dict(zip(nomes, (values[normalize_name(n)] for n in nomes)))
+        t_legado, _ = cronometrar(lambda: calculo_legado(formulas[0], originais))
+        resultado["legado_por_formula_s"] = t_legado
+    print(json.dumps(resultado, indent=2))
+
+
+if __name__ == "__main__":
+    main()
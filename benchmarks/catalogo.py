@@ -0,0 +1,76 @@
+"""
+Gerador de catálogos sintéticos (categorias, variáveis e produtos) para os
+benchmarks. Grava pelo cliente do banco configurado, em lotes.
+"""
+import random
+
+from bench_tokenizer import gerar_nomes, gerar_formula
+from formulas import Vocabulary, normalize_name, tokenize_formula
+
+LOTE = 1000
+
+
+def _inserir(sb, tabela, linhas):
+    ids = []
+    for i in range(0, len(linhas), LOTE):
+        res = sb.table(tabela).insert(linhas[i:i + LOTE]).execute()
+        ids += [r["id"] for r in res.data]
+    return ids
+
+
+def _compostos(rnd, inicio, total, componentes):
+    """Fórmulas de produtos compostos: 2 a 4 componentes sorteados entre
+    `componentes` ([(id, nome)]), com quantidades."""
+    for i in range(inicio, inicio + total):
+        partes = [f"[{nome}] * {rnd.randint(1, 5)}"
+                  for _, nome in rnd.sample(componentes, min(len(componentes),
+                                                            rnd.randint(2, 4)))]
+        yield f"Produto {i}", " + ".join(partes)
+
+
+def gerar_catalogo(sb, categorias=20, variaveis=500, produtos=5000,
+                   termos_min=1, termos_max=12, seed=42, compostos=0.0):
+    """
+    Cria um catálogo sintético: nomes de variáveis com várias palavras,
+    escritos com espaço ou underscore, e fórmulas de `termos_min` a
+    `termos_max` termos. Uma fração `compostos` dos produtos é feita de
+    outros produtos, em dois níveis (componentes simples, depois compostos
+    de compostos). Retorna {"variaveis": [nomes], "produtos": [ids]}.
+    """
+    rnd = random.Random(seed)
+    cats_prod = _inserir(sb, "categorias_produtos",
+                         [{"nome": f"Categoria {i}"} for i in range(categorias)])
+    cats_var = _inserir(sb, "categorias_variaveis",
+                        [{"nome": f"Grupo {i}"} for i in range(categorias)])
+    nomes = gerar_nomes(variaveis, seed)
+    var_ids = _inserir(sb, "variaveis_custos", [
+        {"nome": nome, "valor": round(rnd.uniform(0.1, 100), 4),
+         "categoria_id": rnd.choice(cats_var + [None])}
+        for nome in nomes])
+    # fórmulas gravadas como pelo app: texto e versão pré-processada
+    chaves = {normalize_name(n): i for n, i in zip(nomes, var_ids)}
+    vocabulario = Vocabulary(chaves)
+    n_compostos = int(produtos * compostos)
+    simples = produtos - n_compostos
+    linhas = [(f"Produto {i}", gerar_formula(nomes, rnd.randint(termos_min, termos_max), rnd))
+              for i in range(simples)]
+    ids = _inserir(sb, "produtos_custos", _produtos(rnd, linhas, vocabulario, chaves, {},
+                                                   cats_prod))
+    feitos = [(pid, nome) for pid, (nome, _) in zip(ids, linhas)]
+    for nivel in (n_compostos // 2, n_compostos - n_compostos // 2):
+        linhas = list(_compostos(rnd, simples, nivel, feitos))
+        produtos_ids = {normalize_name(nome): pid for pid, nome in feitos}
+        novos = _inserir(sb, "produtos_custos", _produtos(
+            rnd, linhas, vocabulario, chaves, produtos_ids, cats_prod))
+        ids += novos
+        feitos += [(pid, nome) for pid, (nome, _) in zip(novos, linhas)]
+        simples += nivel
+    return {"variaveis": nomes, "produtos": ids}
+
+
+def _produtos(rnd, linhas, vocabulario, chaves, produtos_ids, cats_prod):
+    return [{"nome": nome, "formula": formula,
+             "formula_compilada": tokenize_formula(formula, vocabulario, chaves,
+                                                   produtos_ids),
+             "categoria_id": rnd.choice(cats_prod + [None])}
+            for nome, formula in linhas]
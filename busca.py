@@ -0,0 +1,276 @@
+import threading
+import time
+import unicodedata
+from collections import Counter
+import streamlit as st
+from supabase_db import get_supabase_client, get_setting, fetch_all_rows
+
+# --- Busca por Nome ---
+#
+# Índice de trigramas em memória sobre os nomes de produtos, variáveis e
+# categorias, compartilhado entre as sessões: a busca não vai ao servidor
+# (um `ilike '%termo%'` não usa índice e percorre a tabela inteira). Os
+# nomes são comparados sem acento e sem diferenciar maiúsculas; o índice é
+# atualizado pelas gravações do app e recarregado após BUSCA_CACHE_TTL
+# segundos, para edições feitas fora dele.
+
+BUSCA_CACHE_TTL = float(get_setting("BUSCA_CACHE_TTL", 600))
+BUSCA_MAX_RESULTADOS = int(get_setting("BUSCA_MAX_RESULTADOS", 500))
+# semelhança mínima (Dice dos trigramas) para sugerir uma palavra digitada errado
+BUSCA_SIMILARIDADE = float(get_setting("BUSCA_SIMILARIDADE", 0.5))
+
+# tabelas indexadas e a coluna usada como grupo (filtro por categoria)
+TABELAS = {
+    "produtos_custos": "categoria_id",
+    "variaveis_custos": "categoria_id",
+    "categorias_produtos": None,
+    "categorias_variaveis": None,
+}
+
+
+def fold(text):
+    """Texto sem acentos, em minúsculas, só com letras, dígitos e espaços
+    simples: 'Mão-de-Obra (%)' -> 'mao de obra'."""
+    text = unicodedata.normalize("NFKD", str(text or "")).casefold()
+    text = "".join(c if c.isalnum() else " " for c in text
+                   if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+
+def trigrams(key):
+    """Trigramas de cada palavra com dois espaços antes e um depois (como o
+    pg_trgm): os primeiros ("  a", " ab") servem de índice de prefixo."""
+    result = set()
+    for word in key.split():
+        padded = f"  {word} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def _required(word):
+    """Trigramas que toda palavra contendo `word` tem: prefixo de palavra
+    para termos de 1 ou 2 letras, substring a partir de 3."""
+    if len(word) < 3:
+        return {f"{' ' * (3 - len(word))}{word}"}
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+class SearchIndex:
+    """
+    Índice de {id: nome}, com um grupo opcional por id (ex.: categoria).
+    As palavras dos nomes apontam para os ids; os trigramas apontam para as
+    palavras distintas, que são bem menos numerosas que os nomes.
+    """
+
+    def __init__(self, rows=()):
+        self.lock = threading.Lock()
+        self.keys = {}        # {id: nome normalizado}
+        # {id: (tamanho << 40) + id}: nomes curtos primeiro; um inteiro
+        # ordena bem mais rápido que a tupla (tamanho, id)
+        self.order = {}
+        self.groups = {}      # {id: grupo}
+        self.by_group = {}    # {grupo: {ids}}
+        self.by_word = {}     # {palavra: {ids}}
+        self.first_word = {}  # {palavra: {ids dos nomes que começam por ela}}
+        self.word_grams = {}  # {trigrama: {palavras}}
+        self.word_sizes = {}  # {palavra: número de trigramas}
+        self.loaded_at = time.time()
+        for item_id, name, group in rows:
+            self._add(item_id, name, group)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _add(self, item_id, name, group):
+        key = fold(name)
+        self.keys[item_id] = key
+        self.order[item_id] = (len(key) << 40) + item_id
+        self.groups[item_id] = group
+        self.by_group.setdefault(group, set()).add(item_id)
+        words = key.split()
+        if words:
+            self.first_word.setdefault(words[0], set()).add(item_id)
+        for word in set(words):
+            if word not in self.by_word:
+                self.by_word[word] = set()
+                grams = trigrams(word)
+                self.word_sizes[word] = len(grams)
+                for gram in grams:
+                    self.word_grams.setdefault(gram, set()).add(word)
+            self.by_word[word].add(item_id)
+
+    def _remove(self, item_id):
+        key = self.keys.pop(item_id, None)
+        if key is None:
+            return
+        del self.order[item_id]
+        group = self.groups.pop(item_id)
+        _discard(self.by_group, group, item_id)
+        words = key.split()
+        if words:
+            _discard(self.first_word, words[0], item_id)
+        for word in set(words):
+            if _discard(self.by_word, word, item_id):
+                # palavra sem nenhum nome: sai do índice de trigramas
+                del self.word_sizes[word]
+                for gram in trigrams(word):
+                    _discard(self.word_grams, gram, word)
+
+    def put(self, item_id, name, group=None):
+        with self.lock:
+            self._remove(item_id)
+            self._add(item_id, name, group)
+
+    def remove(self, item_id):
+        with self.lock:
+            self._remove(item_id)
+
+    def search(self, term, groups=None, limit=BUSCA_MAX_RESULTADOS):
+        """
+        Ids dos nomes que têm, para cada palavra do termo, uma palavra que a
+        contém (palavras de 1 ou 2 letras valem como prefixo), do mais ao
+        menos relevante: nome começando pelo termo, palavra começando pela
+        primeira palavra do termo, demais; nomes curtos primeiro. Uma
+        palavra do termo sem nenhuma ocorrência é trocada pelas palavras
+        parecidas (erros de digitação). `groups` restringe aos ids desses
+        grupos.
+        """
+        query = fold(term)
+        if not query:
+            return []
+        words = query.split()
+        with self.lock:
+            fuzzy, plan = False, []
+            for word in words:
+                matches = self._matching_words(word)
+                if not matches:
+                    matches, fuzzy = self._similar_words(word), True
+                plan.append((self._size(matches), matches))
+            first = plan[0][1]
+            prefixed = {w for w in first if w.startswith(words[0])}
+            # palavra mais seletiva primeiro
+            plan.sort(key=lambda p: p[0])
+            candidates = self._ids(plan[0][1])
+            for size, matches in plan[1:]:
+                if not candidates:
+                    return []
+                candidates = self._having(candidates, matches, size)
+            if groups is not None:
+                candidates &= set().union(*(self.by_group.get(g, ()) for g in groups))
+            if fuzzy:
+                return sorted(candidates, key=self.order.__getitem__)[:limit]
+
+            # níveis de relevância, cada um ordenado por tamanho do nome
+            if len(prefixed) == len(first):
+                starts = candidates
+            else:
+                starts = self._having(
+                    candidates, prefixed, self._size(prefixed))
+            heads = set().union(*(self.first_word.get(w, ()) for w in prefixed))
+            begins = {i for i in starts & heads if self.keys[i].startswith(query)}
+            found = []
+            for level in (begins, starts - begins, candidates - starts):
+                found += sorted(level, key=self.order.__getitem__)[:limit - len(found)]
+                if len(found) >= limit:
+                    break
+            return found
+
+    def _ids(self, words):
+        return set().union(*map(self.by_word.__getitem__, words))
+
+    def _size(self, words):
+        return sum(map(len, map(self.by_word.__getitem__, words)))
+
+    def _having(self, candidates, words, size):
+        """Candidatos com alguma das `words` (`size`: total de ids delas).
+        Com poucos candidatos, confere o nome de cada um em vez de unir as
+        listas de ids das palavras."""
+        # conferir um nome custa algumas vezes mais que unir um id
+        if 4 * len(candidates) < size:
+            return {i for i in candidates if not words.isdisjoint(self.keys[i].split())}
+        return candidates & self._ids(words)
+
+    def _matching_words(self, word):
+        # interseção começando pela lista menor
+        postings = sorted((self.word_grams.get(g, ()) for g in _required(word)), key=len)
+        if not postings[0]:
+            return set()
+        found = set(postings[0]).intersection(*postings[1:])
+        if len(word) > 3:
+            # trigramas presentes não garantem a ordem: confere a substring
+            found = {w for w in found if word in w}
+        return found
+
+    def _similar_words(self, word):
+        """Palavras com coeficiente de Dice dos trigramas >= BUSCA_SIMILARIDADE."""
+        grams = trigrams(word)
+        counts = Counter()
+        for gram in grams:
+            counts.update(self.word_grams.get(gram, ()))
+        return {w for w, shared in counts.items()
+                if 2 * shared / (len(grams) + self.word_sizes[w]) >= BUSCA_SIMILARIDADE}
+
+
+def _discard(postings, key, value):
+    """Tira `value` de postings[key]; retorna True se a lista esvaziou."""
+    items = postings.get(key)
+    if items is None:
+        return False
+    items.discard(value)
+    if not items:
+        del postings[key]
+        return True
+    return False
+
+
+# --- Índices Compartilhados ---
+
+
+@st.cache_resource(show_spinner=False)
+def _search_state():
+    return {"lock": threading.Lock(), "indexes": {}}
+
+
+def _load_index(table):
+    sb = get_supabase_client()
+    group = TABELAS[table]
+    columns = f"id, nome, {group}" if group else "id, nome"
+    return SearchIndex((r["id"], r["nome"], r.get(group) if group else None)
+                       for r in fetch_all_rows(sb, table, columns))
+
+
+def get_search_index(table):
+    state = _search_state()
+    with state["lock"]:
+        index = state["indexes"].get(table)
+        if index is None or time.time() - index.loaded_at > BUSCA_CACHE_TTL:
+            index = _load_index(table)
+            state["indexes"][table] = index
+        return index
+
+
+def search_ids(table, term, groups=None, limit=BUSCA_MAX_RESULTADOS):
+    """Ids de `table` cujo nome combina com `term`, por relevância."""
+    return get_search_index(table).search(term, groups, limit)
+
+
+def index_name(table, item_id, name, group=None):
+    """Atualiza o nome (e o grupo) de um id no índice, se já carregado."""
+    index = _search_state()["indexes"].get(table)
+    if index is not None:
+        index.put(item_id, name, group)
+
+
+def unindex_name(table, item_id):
+    index = _search_state()["indexes"].get(table)
+    if index is not None:
+        index.remove(item_id)
+
+
+def invalidate_search_index(table=None):
+    state = _search_state()
+    with state["lock"]:
+        if table is None:
+            state["indexes"].clear()
+        else:
+            state["indexes"].pop(table, None)
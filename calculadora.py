@@ -1,7 +1,16 @@
 import streamlit as st
-import re
+import math
+import threading
+import time
+import altair as alt
+import numpy as np
+import pandas as pd
 from textos import TEXTOS
-from supabase_db import get_supabase_client
+from supabase_db import get_supabase_client, get_setting, fetch_all_rows
+from formulas import (compile_formula, compile_tokens, tokenize_formula,
+                      render_formula, normalize_name, FormulaError,
+                      Vocabulary, is_plain_name)
+from perfil import current_profile
 
 # --- Funções de Exibição de Mensagens ---
 
@@ -17,30 +26,174 @@ def display_success(message):
     st.success(message)
 
 
+# --- Variáveis da Calculadora ---
+#
+# A tabela variaveis_calc é pequena e muda pouco: as leituras são feitas em
+# uma única consulta `in_` e ficam em cache até update_calc_variable (ou até
+# o TTL, para edições feitas fora do app).
+
+CALC_VARS_CACHE_TTL = float(get_setting("VARIAVEIS_CALC_CACHE_TTL", 300))
+
+
+@st.cache_data(ttl=CALC_VARS_CACHE_TTL, max_entries=32, show_spinner=False)
+def _fetch_calc_vars(names):
+    sb = get_supabase_client()
+    data = sb.table("variaveis_calc").select(
+        "nome, valor").in_("nome", list(names)).execute().data
+    return {item["nome"]: item.get("valor") for item in data or []}
+
+
+def invalidate_calc_vars_cache():
+    _fetch_calc_vars.clear()
+    _fetch_plates.clear()
+
+
+def get_calc_vars(names):
+    names = tuple(sorted(set(names)))
+    try:
+        found = _fetch_calc_vars(names)
+    except Exception as e:
+        display_error(f"Erro ao buscar variáveis de cálculo: {e}", e)
+        return {name: 0.0 for name in names}
+    values = {}
+    for name in names:
+        try:
+            values[name] = float(found.get(name, 0.0))
+        except (TypeError, ValueError):
+            values[name] = 0.0
+    return values
+
+
 def get_calc_var(name):
+    return get_calc_vars([name])[name]
+
+
+# --- Categorias ---
+#
+# {id: nome} de categorias_produtos e categorias_variaveis, compartilhado
+# entre as sessões: as listagens leem só as próprias colunas e resolvem o
+# nome da categoria aqui, sem join por linha. Invalidado ao adicionar,
+# renomear ou deletar categorias (ou até o TTL, para edições fora do app).
+
+CATEGORIES_CACHE_TTL = float(get_setting("CATEGORIAS_CACHE_TTL", 600))
+
+
+@st.cache_data(ttl=CATEGORIES_CACHE_TTL, max_entries=2, show_spinner=False)
+def _fetch_categories(table):
+    sb = get_supabase_client()
+    return {r["id"]: r["nome"] for r in fetch_all_rows(sb, table, "id, nome")}
+
+
+def get_category_names(table):
+    """{id: nome} das categorias da tabela, em ordem de cadastro."""
+    return _fetch_categories(table)
+
+
+def invalidate_categories_cache(table=None):
+    if table is None:
+        _fetch_categories.clear()
+    else:
+        _fetch_categories.clear(table)
+
+
+# --- Tipos de Placa ---
+#
+# Cada tipo de placa é o par de linhas peso_<tamanho> (g) e perda_<tamanho>
+# (%) em variaveis_calc: novos tamanhos são só novas linhas, sem mudar o
+# código. Os custos são calculados com NumPy, todas as placas de uma vez.
+
+
+_PLATE_PREFIXES = ("peso_", "perda_")
+
+
+@st.cache_data(ttl=CALC_VARS_CACHE_TTL, max_entries=1, show_spinner=False)
+def _fetch_plates():
     sb = get_supabase_client()
+    # o "_" do prefixo fica fora do LIKE, onde casaria qualquer caractere:
+    # o banco só reduz a resposta, e o prefixo exato é conferido aqui
+    data = sb.table("variaveis_calc").select("nome, valor").or_(
+        "nome.like.peso*,nome.like.perda*").execute().data
+    return {item["nome"]: item.get("valor") for item in data or []
+            if item["nome"].startswith(_PLATE_PREFIXES)}
+
+
+def _plate_order(size):
+    # maiores primeiro: "50x50" antes de "30x30"; tamanhos fora do padrão no fim
     try:
-        res = sb.table("variaveis_calc").select(
-            "valor").eq("nome", name).single().execute()
-        if isinstance(res.data, dict):
-            try:
-                return float(res.data.get("valor", 0.0))
-            except (TypeError, ValueError):
-                return 0.0
-        return 0.0
+        return (0, -math.prod(float(n) for n in size.lower().split("x")), size)
+    except ValueError:
+        return (1, 0, size)
+
+
+def get_plates():
+    """Tipos de placa cadastrados: [(tamanho, peso_g, perda_pct)]."""
+    try:
+        found = _fetch_plates()
+    except Exception as e:
+        display_error(f"Erro ao buscar tipos de placa: {e}", e)
+        return []
+
+    def value(name):
+        try:
+            return float(found.get(name) or 0.0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    sizes = {name[len("peso_"):] for name in found if name.startswith("peso_")}
+    return [(size, value(f"peso_{size}"), value(f"perda_{size}"))
+            for size in sorted(sizes, key=_plate_order)]
+
+
+def add_plate(size, weight, loss):
+    size = "".join(str(size).split()).lower()
+    if not size:
+        display_error("Informe o tamanho da placa (ex.: 40x40).")
+        return False
+    return update_calc_variables({f"peso_{size}": weight, f"perda_{size}": loss})
+
+
+def delete_plate(size):
+    sb = get_supabase_client()
+    try:
+        sb.table("variaveis_calc").delete().in_(
+            "nome", [f"peso_{size}", f"perda_{size}"]).execute()
+        invalidate_calc_vars_cache()
+        return True
     except Exception as e:
-        display_error(f"Erro ao buscar variável de cálculo: {e}", e)
-        return 0.0
+        display_error(f"Erro ao excluir placa {size}: {e}", e)
+        return False
+
+
+# limite de valores por eixo na simulação (a grade tem até N × N células)
+SIMULACAO_MAX_PASSOS = 50
+
+
+def plate_costs(weights, losses, ps_price, freight, ipi=0.0, cleaning=0.0,
+                lamination=0.0):
+    """
+    Custo por placa: peso × ((1 - perda) × preço + perda × preço com
+    limpeza e laminação), com preço = PS com IPI + frete.
+    Aceita arrays em qualquer argumento (regras de broadcasting do NumPy).
+    """
+    weight = np.asarray(weights, dtype=float) / 1000
+    loss = np.asarray(losses, dtype=float) / 100
+    price = np.asarray(ps_price, dtype=float) * (1 + np.asarray(ipi) / 100) \
+        + np.asarray(freight, dtype=float)
+    price_with_services = price + cleaning + lamination
+    return weight * ((1 - loss) * price + loss * price_with_services)
+
+
+def price_sweep(plates, ps_prices, freights, ipi=0.0, cleaning=0.0, lamination=0.0):
+    """Custos de todas as placas na grade preço do PS × frete, em uma única
+    operação. Retorna um array (placas × preços × fretes)."""
+    weights = np.array([p[1] for p in plates])[:, None, None]
+    losses = np.array([p[2] for p in plates])[:, None, None]
+    return plate_costs(weights, losses, np.asarray(ps_prices)[None, :, None],
+                       np.asarray(freights)[None, None, :], ipi, cleaning, lamination)
 
 
 def show_calculator_variables():
     st.subheader(TEXTOS["var_titulo"])
-    default_vals = {
-        "peso_50x50": 137.0, "perda_50x50": 10.0,
-        "peso_30x30": 44.0, "perda_30x30": 8.0,
-        "peso_25x25": 40.0, "perda_25x25": 7.0,
-    }
-    sb = get_supabase_client()
     with st.expander(TEXTOS["calc_resetar"]):
         if st.button(TEXTOS["calc_resetar"], type="primary"):
             if reset_calculator_variables_backend():
@@ -50,23 +203,33 @@ def show_calculator_variables():
                 display_error(
                     "Erro ao redefinir variáveis para os valores padrão.")
             st.rerun()
+    with st.expander(TEXTOS["var_adicionar_placa"]):
+        with st.form(key="form_nova_placa"):
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                size = st.text_input("Tamanho (ex.: 40x40)")
+            with col2:
+                weight = st.number_input("Peso (g)", min_value=0.0, format="%.2f")
+            with col3:
+                loss = st.number_input(
+                    "% de Perda", min_value=0.0, max_value=100.0, format="%.2f")
+            if st.form_submit_button("Adicionar") and add_plate(size, weight, loss):
+                display_success(f"Placa {size} adicionada.")
+                st.rerun()
 
-    placas = [
-        ("50x50cm", "peso_50x50", "perda_50x50"),
-        ("30x30cm", "peso_30x30", "perda_30x30"),
-        ("25x25cm", "peso_25x25", "perda_25x25"),
-    ]
-    labels = [TEXTOS["var_placas"][p[0][:2]] for p in placas]
+    plates = get_plates()
+    if not plates:
+        st.info(TEXTOS["var_sem_placas"])
+        return
+    labels = [TEXTOS["var_placa"].format(tamanho=p[0]) for p in plates]
     st.markdown(
         f"<h4 style=\'{TEXTOS['var_selecione_style']}\'>{TEXTOS['var_selecione_texto']}</h4>", unsafe_allow_html=True)
     choice = st.radio("Selecionar Placa para Editar Variáveis",
                       labels, horizontal=True, label_visibility="collapsed")
-    idx = labels.index(choice)
-    label, peso_key, perda_key = placas[idx]
-    peso_val = float(get_calc_var(peso_key))
-    perda_val = float(get_calc_var(perda_key))
+    size, peso_val, perda_val = plates[labels.index(choice)]
+    peso_key, perda_key = f"peso_{size}", f"perda_{size}"
 
-    with st.form(key=f"form_{label}"):
+    with st.form(key=f"form_{size}"):
         col1, col2 = st.columns(2)
         with col1:
             novo_peso = st.number_input(
@@ -75,14 +238,35 @@ def show_calculator_variables():
             nova_perda = st.number_input(
                 "% de Perda", min_value=0.0, max_value=100.0, value=perda_val, format="%.2f")
         if st.form_submit_button("Salvar"):
-            for key, val in [(peso_key, novo_peso), (perda_key, nova_perda)]:
-                if update_calc_variable(key, val):
-                    display_success(f"Variável \'{key}\' atualizada.")
-                else:
-                    display_error(f"Erro ao salvar variável \'{key}\'")
+            # envia só o que mudou, em uma única requisição
+            changed = {key: val for key, val, old in [
+                (peso_key, novo_peso, peso_val), (perda_key, nova_perda, perda_val)] if val != old}
+            if update_calc_variables(changed):
+                display_success(
+                    f"Variáveis atualizadas: {', '.join(changed) or 'nenhuma alteração'}.")
+            st.rerun()
+    if st.button(f"🗑️ Excluir {choice}", key=f"del_placa_{size}"):
+        if delete_plate(size):
             st.rerun()
 
 
+def _additional_costs(prefix):
+    """Campos de limpeza/granulação, laminação e IPI."""
+    tem_limpeza = st.radio(
+        "Limpeza/Granulação?", ["Não", "Sim"], key=f"{prefix}tem_limpeza", horizontal=True)
+    valor_limpeza = st.number_input("Valor Limpeza/Gran. (por KG)", min_value=0.0,
+                                    format="%.2f", key=f"{prefix}valor_limpeza") if tem_limpeza == "Sim" else 0.0
+    tem_laminacao = st.radio(
+        "Laminação?", ["Não", "Sim"], key=f"{prefix}tem_laminacao", horizontal=True)
+    valor_laminacao = st.number_input("Valor Laminação (por KG)", min_value=0.0,
+                                      format="%.2f", key=f"{prefix}valor_laminacao") if tem_laminacao == "Sim" else 0.0
+    tem_ipi = st.radio(
+        "IPI?", ["Não", "Sim"], key=f"{prefix}tem_ipi", horizontal=True)
+    percent_ipi = st.number_input(
+        "% IPI", min_value=0.0, max_value=100.0, format="%.1f", key=f"{prefix}percent_ipi") if tem_ipi == "Sim" else 0.0
+    return valor_limpeza, valor_laminacao, percent_ipi
+
+
 def show_price_calculator():
     st.markdown(
         "<style>.big-radio .st-emotion-cache-1wmy9hl{font-size:26px!important;font-weight:600!important;}</style>", unsafe_allow_html=True)
@@ -93,6 +277,9 @@ def show_price_calculator():
     if submenu == "Variáveis":
         show_calculator_variables()
         return
+    if submenu == "Simulação de Preços":
+        show_price_sweep()
+        return
 
     st.markdown(
         f"<h3 style=\'{TEXTOS['calc_titulo_style']}\'>{TEXTOS['calc_titulo_texto']}</h3>", unsafe_allow_html=True)
@@ -106,38 +293,17 @@ def show_price_calculator():
             valor_frete_kg = st.number_input(
                 "Valor do Frete (por KG)", min_value=0.0, format="%.2f", key="valor_frete_kg")
         with col2:
-            tem_limpeza = st.radio(
-                "Limpeza/Granulação?", ["Não", "Sim"], key="tem_limpeza", horizontal=True)
-            valor_limpeza = st.number_input("Valor Limpeza/Gran. (por KG)", min_value=0.0,
-                                            format="%.2f", key="valor_limpeza") if tem_limpeza == "Sim" else 0.0
-            tem_laminacao = st.radio(
-                "Laminação?", ["Não", "Sim"], key="tem_laminacao", horizontal=True)
-            valor_laminacao = st.number_input("Valor Laminação (por KG)", min_value=0.0,
-                                              format="%.2f", key="valor_laminacao") if tem_laminacao == "Sim" else 0.0
-            tem_ipi = st.radio(
-                "IPI?", ["Não", "Sim"], key="tem_ipi", horizontal=True)
-            percent_ipi = st.number_input(
-                "% IPI", min_value=0.0, max_value=100.0, format="%.1f", key="percent_ipi") if tem_ipi == "Sim" else 0.0
+            valor_limpeza, valor_laminacao, percent_ipi = _additional_costs("")
     st.divider()
     if st.button(TEXTOS["calc_botao"], use_container_width=True):
         try:
-            # Peso e Perdas
-            peso_50 = float(get_calc_var("peso_50x50"))/1000
-            perda_50 = float(get_calc_var("perda_50x50"))/100
-            peso_30 = get_calc_var("peso_30x30") / 1000
-            perda_30 = get_calc_var("perda_30x30") / 100
-            peso_25 = get_calc_var("peso_25x25") / 1000
-            perda_25 = get_calc_var("perda_25x25") / 100
-            preco1 = preco_ps*(1+percent_ipi/100)+valor_frete_kg
-            preco2 = preco1+valor_limpeza+valor_laminacao
-            # Custos das placas
-            custo_placa50 = peso_50*((1-perda_50)*preco1+perda_50*preco2)
-            custo_placa30 = peso_30*((1-perda_30)*preco1+perda_30*preco2)
-            custo_placa25 = peso_25*((1-perda_25)*preco1+perda_25*preco2)
+            plates = get_plates()
+            costs = plate_costs([p[1] for p in plates], [p[2] for p in plates],
+                                preco_ps, valor_frete_kg, percent_ipi,
+                                valor_limpeza, valor_laminacao)
             # Resultado
-            st.metric("Custo Placa 50x50", f"R$ {custo_placa50:.4f}")
-            st.metric("Custo Placa 30x30", f"R$ {custo_placa30:.4f}")
-            st.metric("Custo Placa 25x25", f"R$ {custo_placa25:.4f}")
+            for (size, _, _), cost in zip(plates, costs):
+                st.metric(f"Custo Placa {size}", f"R$ {cost:.4f}")
         except Exception as e:
             display_error(f"Erro no cálculo: {e}", e)
     else:
@@ -145,17 +311,579 @@ def show_price_calculator():
         st.info(TEXTOS["calc_info"])
 
 
-def get_all_variables_as_dict():
+def _sweep_heatmap(costs, ps_prices, freights):
+    data = pd.DataFrame({
+        "PS (R$/kg)": np.repeat(ps_prices, len(freights)).round(2),
+        "Frete (R$/kg)": np.tile(freights, len(ps_prices)).round(2),
+        "Custo (R$)": costs.ravel(),
+    })
+    return alt.Chart(data).mark_rect().encode(
+        x="Frete (R$/kg):O", y=alt.Y("PS (R$/kg):O", sort="descending"),
+        color=alt.Color("Custo (R$):Q", scale=alt.Scale(scheme="orangered")),
+        tooltip=list(data.columns))
+
+
+def show_price_sweep():
+    st.markdown(
+        f"<h3 style=\'{TEXTOS['calc_titulo_style']}\'>{TEXTOS['sim_titulo_texto']}</h3>", unsafe_allow_html=True)
+    st.caption(TEXTOS["sim_descricao"])
+    plates = get_plates()
+    if not plates:
+        st.info(TEXTOS["var_sem_placas"])
+        return
+    col1, col2 = st.columns(2)
+    with col1:
+        ps_min = st.number_input("Preço do PS de (por KG)", min_value=0.0,
+                                 value=5.0, format="%.2f", key="sim_ps_min")
+        ps_max = st.number_input("Preço do PS até (por KG)", min_value=0.0,
+                                 value=15.0, format="%.2f", key="sim_ps_max")
+        ps_steps = st.slider("Valores de PS", 2, SIMULACAO_MAX_PASSOS, 11,
+                             key="sim_ps_passos")
+    with col2:
+        freight_min = st.number_input("Frete de (por KG)", min_value=0.0,
+                                      value=0.0, format="%.2f", key="sim_frete_min")
+        freight_max = st.number_input("Frete até (por KG)", min_value=0.0,
+                                      value=2.0, format="%.2f", key="sim_frete_max")
+        freight_steps = st.slider("Valores de frete", 2, SIMULACAO_MAX_PASSOS, 5,
+                                  key="sim_frete_passos")
+    with st.expander(TEXTOS["calc_adicionais"]):
+        valor_limpeza, valor_laminacao, percent_ipi = _additional_costs("sim_")
+    view = st.radio("Exibir como", ["Tabela", "Mapa de calor"],
+                    horizontal=True, key="sim_exibicao")
+
+    ps_prices = np.linspace(ps_min, ps_max, ps_steps)
+    freights = np.linspace(freight_min, freight_max, freight_steps)
+    try:
+        grid = price_sweep(plates, ps_prices, freights, percent_ipi,
+                           valor_limpeza, valor_laminacao)
+    except Exception as e:
+        display_error(f"Erro no cálculo: {e}", e)
+        return
+    tabs = st.tabs([TEXTOS["var_placa"].format(tamanho=p[0]) for p in plates])
+    for tab, costs in zip(tabs, grid):
+        with tab:
+            if view == "Tabela":
+                table = pd.DataFrame(
+                    costs, index=pd.Index(ps_prices.round(2), name="PS \\ Frete"),
+                    columns=[f"{f:.2f}" for f in freights])
+                st.dataframe(table.style.format("R$ {:.4f}"),
+                             use_container_width=True)
+            else:
+                st.altair_chart(_sweep_heatmap(costs, ps_prices, freights),
+                                use_container_width=True)
+
+
+# --- Snapshot das Variáveis de Custo ---
+#
+# Uma cópia em memória da tabela variaveis_custos, compartilhada por todas as
+# sessões do processo. add/update/delete_variable aplicam a alteração direto
+# no snapshot (apply_variable_change), sem reler a tabela; o TTL cobre edições
+# feitas fora do app.
+
+VARIABLES_CACHE_TTL = float(get_setting("VARIAVEIS_CACHE_TTL", 300))
+
+
+class CostCache:
+    """
+    Custos já calculados por produto, {id: (fórmula, custo)}, com a fórmula
+    pré-processada (ou o texto, sem ela). Escrito ao mesmo tempo pelas
+    sessões e pela thread de recálculo: toda escrita e toda cópia passam
+    pelo lock.
+    """
+
+    __slots__ = ("_items", "_lock")
+
+    def __init__(self, items=None):
+        self._items = dict(items or {})
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, pid, key, default=None):
+        """Custo guardado para o produto com esta fórmula, ou `default`."""
+        cached = self._items.get(pid)
+        return cached[1] if cached is not None and cached[0] == key else default
+
+    def put(self, pid, key, cost):
+        with self._lock:
+            self._items[pid] = (key, cost)
+
+    def discard(self, product_ids=None):
+        """Tira os custos desses produtos (None = todos)."""
+        with self._lock:
+            if product_ids is None:
+                self._items.clear()
+            for pid in product_ids or ():
+                self._items.pop(pid, None)
+
+    def without(self, product_ids):
+        """Cópia sem os custos desses produtos."""
+        with self._lock:
+            return CostCache({pid: c for pid, c in self._items.items()
+                              if pid not in product_ids})
+
+
+class VariablesSnapshot:
+    __slots__ = ("version", "rows", "values", "names", "ids", "by_id", "costs",
+                 "loaded_at", "_vocabulary")
+
+    def __init__(self, version, rows, costs=None, loaded_at=None, vocabulary=None):
+        self.version = version
+        # {id: (nome, valor)}, como está no banco
+        self.rows = rows
+        # {nome_normalizado: valor}, {nome_normalizado: nome original} e
+        # {nome_normalizado: id}
+        self.values = {}
+        self.names = {}
+        self.ids = {}
+        # {id: valor}, para as fórmulas pré-processadas
+        self.by_id = {}
+        for var_id, (nome, valor) in rows.items():
+            key = normalize_name(nome)
+            self.values[key] = self.by_id[var_id] = float(valor)
+            self.names[key] = nome
+            self.ids[key] = var_id
+        # custos por produto já calculados com estes valores (CostCache)
+        self.costs = CostCache() if costs is None else costs
+        self.loaded_at = time.time() if loaded_at is None else loaded_at
+        self._vocabulary = vocabulary
+
+    @property
+    def vocabulary(self):
+        # trie dos nomes, montada na primeira compilação que precisar dela
+        if self._vocabulary is None:
+            self._vocabulary = Vocabulary(self.names)
+        return self._vocabulary
+
+    def compile(self, formula, tokens=None):
+        """
+        (fórmula compilada, valores): pela fórmula pré-processada, com os
+        valores por id; sem ela (produtos gravados antes), pelo texto, com
+        os valores por nome normalizado.
+        """
+        if tokens:
+            return compile_tokens(tokens), self.by_id
+        return compile_formula(formula, self.vocabulary), self.values
+
+    def label(self, key):
+        """Nome da variável a partir da chave usada na fórmula compilada."""
+        if key in self.rows:
+            return self.rows[key][0]
+        return self.names.get(key, str(key))
+
+    def tokenize(self, formula, products=None):
+        """Fórmula pré-processada, com as variáveis (e os produtos de
+        `products`, {nome_normalizado: id}) pelo id. FormulaError se inválida
+        ou com variável ou produto não cadastrado."""
+        return tokenize_formula(formula, self.vocabulary, self.ids, products)
+
+    def render(self, tokens, products=None):
+        """Texto da fórmula pré-processada com os nomes atuais das variáveis
+        e dos produtos ({id: nome})."""
+        return render_formula(
+            tokens, {i: row[0] for i, row in self.rows.items()}, products)
+
+
+@st.cache_resource(show_spinner=False)
+def _variables_state():
+    return {"version": 0, "snapshot": None, "lock": threading.Lock()}
+
+
+def _load_variables_snapshot(version):
     sb = get_supabase_client()
+    rows = {item["id"]: (item["nome"], item["valor"])
+            for item in fetch_all_rows(sb, "variaveis_custos", "id, nome, valor")}
+    return VariablesSnapshot(version, rows)
+
+
+def get_variables_snapshot():
+    state = _variables_state()
+    with state["lock"]:
+        snapshot = state["snapshot"]
+        if snapshot is None or time.time() - snapshot.loaded_at > VARIABLES_CACHE_TTL:
+            state["version"] += 1
+            snapshot = _load_variables_snapshot(state["version"])
+            state["snapshot"] = snapshot
+        return snapshot
+
+
+def invalidate_variables_cache():
+    state = _variables_state()
+    with state["lock"]:
+        state["snapshot"] = None
+
+
+def apply_variable_change(var_id, name=None, value=None):
+    """
+    Aplica no snapshot a inclusão/alteração (ou remoção, com name=None) de uma
+    variável e descarta só os custos dos produtos que a usam.
+    Retorna os ids dos produtos afetados, ou None quando não dá para saber
+    (snapshot ainda não carregado): nesse caso, considere todos afetados.
+    """
+    state = _variables_state()
+    snapshot = state["snapshot"]
+    if snapshot is None:
+        return None
+    old = snapshot.rows.get(var_id)
     try:
-        data = sb.table("variaveis_custos").select(
-            "nome, valor").execute().data
-        return {item["nome"]: item["valor"] for item in data}
+        index = get_product_index()
+    except Exception:
+        invalidate_variables_cache()
+        return None
+    affected = index.affected(var_id, *(n for n in (old and old[0], name) if n))
+
+    with state["lock"]:
+        snapshot = state["snapshot"]
+        if snapshot is None:
+            return affected
+        rows = dict(snapshot.rows)
+        rows.pop(var_id, None)
+        if name is not None:
+            rows[var_id] = (name, value)
+        state["version"] += 1
+        new = VariablesSnapshot(state["version"], rows,
+                                snapshot.costs.without(affected), snapshot.loaded_at)
+        if new.names.keys() == snapshot.names.keys():
+            # só mudou valor: as fórmulas compiladas continuam válidas
+            new._vocabulary = snapshot._vocabulary
+        state["snapshot"] = new
+
+    # nomes com caracteres especiais mudam a leitura das fórmulas: o índice
+    # precisa ser refeito com o novo vocabulário
+    if not all(is_plain_name(n) for n in (old[0] if old else "", name or "")):
+        invalidate_products_cache()
+    return affected
+
+
+def get_all_variables_as_dict():
+    try:
+        snapshot = get_variables_snapshot()
+        return {snapshot.names[k]: v for k, v in snapshot.values.items()}
     except Exception as e:
         display_error(f"Erro ao buscar todas as variáveis: {e}", e)
         return {}
 
 
+# --- Índice de Dependências Variável → Produtos ---
+#
+# Para cada variável (id), os produtos cujas fórmulas a citam. Fórmulas ainda
+# sem a versão pré-processada entram pelo nome normalizado. Guarda também o
+# grafo dos produtos compostos (produto → componentes citados entre
+# colchetes): alterar uma variável ou um componente afeta todos os produtos
+# que dependem dele, direta ou indiretamente.
+# Recarregado após add/update/delete_product.
+
+
+class ProductIndex:
+    __slots__ = ("products", "formulas", "by_variable", "by_name", "names",
+                 "components", "parents")
+
+    def __init__(self, rows, snapshot):
+        self.products = {}     # {id: nome}
+        self.formulas = {}     # {id: (fórmula, fórmula pré-processada)}
+        self.by_variable = {}  # {id da variável: {ids}}
+        self.by_name = {}      # {nome_normalizado da variável: {ids}}
+        self.names = {}        # {nome_normalizado do produto: id, ou None se repetido}
+        self.components = {}   # {id: (ids dos produtos citados)}
+        self.parents = {}      # {id: {ids dos produtos que o citam}}
+        for row in rows:
+            pid = row["id"]
+            self.products[pid] = row["nome"]
+            key = normalize_name(row["nome"])
+            self.names[key] = None if key in self.names else pid
+            tokens = row.get("formula_compilada")
+            self.formulas[pid] = (row.get("formula"), tokens)
+            try:
+                compiled, _ = snapshot.compile(row.get("formula") or "", tokens)
+            except FormulaError:
+                continue
+            postings = self.by_variable if tokens else self.by_name
+            for name in compiled.names:
+                if not isinstance(name, tuple):
+                    postings.setdefault(name, set()).add(pid)
+            if tokens and compiled.products:
+                self.components[pid] = compiled.products
+                for component in compiled.products:
+                    self.parents.setdefault(component, set()).add(pid)
+
+    def dependents(self, product_ids):
+        """Os produtos e todos os que dependem deles (que os citam, direta ou
+        indiretamente)."""
+        found = set(product_ids)
+        stack = list(found)
+        while stack:
+            for parent in self.parents.get(stack.pop(), ()):
+                if parent not in found:
+                    found.add(parent)
+                    stack.append(parent)
+        return found
+
+    def affected(self, var_id, *names):
+        """Produtos cujo custo depende da variável `var_id` (ou, nas fórmulas
+        só em texto, de algum dos `names`), inclusive pelos componentes."""
+        found = set(self.by_variable.get(var_id, ()))
+        for name in names:
+            found |= self.by_name.get(normalize_name(name), set())
+        return self.dependents(found)
+
+    def detached(self):
+        """Cópia com o grafo de componentes próprio, para aplicar alterações
+        ainda não gravadas (ex.: importação) sem mexer no índice
+        compartilhado."""
+        copy = object.__new__(ProductIndex)
+        for slot in self.__slots__:
+            setattr(copy, slot, getattr(self, slot))
+        copy.components = dict(self.components)
+        copy.parents = {pid: set(ids) for pid, ids in self.parents.items()}
+        return copy
+
+    def link(self, product_id, components):
+        """Troca os componentes do produto no grafo."""
+        for component in self.components.pop(product_id, ()):
+            self.parents.get(component, set()).discard(product_id)
+        if components:
+            self.components[product_id] = tuple(components)
+            for component in components:
+                self.parents.setdefault(component, set()).add(product_id)
+
+    def check_cycle(self, product_id, components):
+        """Lança FormulaError se o produto, citando `components`, passar a
+        depender do próprio custo."""
+        if product_id is None:
+            return
+        came_from = {c: None for c in components}
+        stack = list(components)
+        while stack:
+            current = stack.pop()
+            if current == product_id:
+                path = [current]
+                while came_from[current] is not None:
+                    current = came_from[current]
+                    path.append(current)
+                names = [self.products.get(p, f"#{p}") for p in [product_id, *path[::-1]]]
+                raise FormulaError(f"Referência circular: {' → '.join(names)}")
+            for component in self.components.get(current, ()):
+                if component not in came_from:
+                    came_from[component] = current
+                    stack.append(component)
+
+
+@st.cache_resource(show_spinner=False)
+def _products_state():
+    return {"version": 0, "lock": threading.Lock()}
+
+
+@st.cache_resource(ttl=VARIABLES_CACHE_TTL, max_entries=1, show_spinner=False)
+def _load_product_index(version):
+    sb = get_supabase_client()
+    return ProductIndex(
+        fetch_all_rows(sb, "produtos_custos", "id, nome, formula, formula_compilada"),
+        get_variables_snapshot())
+
+
+def get_product_index():
+    return _load_product_index(_products_state()["version"])
+
+
+def invalidate_products_cache():
+    state = _products_state()
+    with state["lock"]:
+        state["version"] += 1
+
+
+def get_affected_products(var_id, variable_name):
+    """Nomes dos produtos cujos custos dependem da variável."""
+    try:
+        index = get_product_index()
+        return sorted(index.products[pid]
+                      for pid in index.affected(var_id, variable_name))
+    except Exception as e:
+        display_error(f"Erro ao buscar produtos da variável: {e}", e)
+        return []
+
+
+def product_dependents(product_ids):
+    """Os produtos e os que dependem deles, pelo índice atual; None quando
+    não dá para saber (considere todos afetados)."""
+    try:
+        return get_product_index().dependents(product_ids)
+    except Exception:
+        return None
+
+
+def discard_product_costs(product_ids=None):
+    """Descarta os custos já calculados em memória desses produtos (None =
+    todos), após alterar a fórmula de um componente."""
+    snapshot = _variables_state()["snapshot"]
+    if snapshot is not None:
+        snapshot.costs.discard(product_ids)
+
+
+def index_catalog():
+    """({id: (fórmula, pré-processada)}, {id: nome}) de todos os produtos,
+    pelo índice: os componentes disponíveis para o CostEvaluator."""
+    index = get_product_index()
+    return index.formulas, index.products
+
+
+# --- Avaliação de Produtos Compostos ---
+#
+# Os componentes citados entre colchetes são avaliados antes (ordem
+# topológica, com uma pilha explícita) e cada custo fica em `memo` até o fim
+# da avaliação: um componente comum a vários produtos é calculado uma única
+# vez. Com `size`, os valores das variáveis podem ser arrays (cenários) e os
+# custos também são arrays.
+
+
+_MISSING = object()
+
+
+class CostEvaluator:
+
+    def __init__(self, snapshot, catalog=None, size=None, by_id=None,
+                 by_name=None, cache=None):
+        self.snapshot = snapshot
+        # função que retorna ({id: (fórmula, pré-processada)}, {id: nome}) dos
+        # produtos; só é chamada se alguma fórmula citar outro produto
+        self._catalog = catalog
+        self._loaded = None
+        self.size = size
+        self.by_id = snapshot.by_id if by_id is None else by_id
+        self.by_name = snapshot.values if by_name is None else by_name
+        # custos já calculados (CostCache, ex.: snapshot.costs)
+        self.cache = cache
+        # fórmulas a usar no lugar das do catálogo: {id: (fórmula, pré-processada)}
+        self.formulas = {}
+        self.memo = {}    # {id: custo; None se a fórmula tem erro}
+        self.errors = {}  # {id: exceção}
+        self.compiling = self.evaluating = 0.0
+        self.evaluated = 0
+
+    def catalog_data(self):
+        """Catálogo de produtos, carregado na primeira vez que é preciso."""
+        if self._loaded is None:
+            self._loaded = self._catalog() if self._catalog else ({}, {})
+        return self._loaded
+
+    def _formula(self, pid):
+        if pid in self.formulas:
+            return self.formulas[pid]
+        formulas = self.catalog_data()[0]
+        if pid not in formulas:
+            raise FormulaError(f"Produto '#{pid}' não encontrado")
+        return formulas[pid]
+
+    def _name(self, pid):
+        return self.catalog_data()[1].get(pid, f"#{pid}")
+
+    def _compile(self, formula, tokens):
+        """(fórmula compilada, valores, componentes). Só as fórmulas
+        pré-processadas citam produtos pelo id; no texto, [produto] não é
+        resolvido."""
+        start = time.perf_counter()
+        try:
+            compiled, _ = self.snapshot.compile(formula, tokens)
+        finally:
+            self.compiling += time.perf_counter() - start
+        if tokens:
+            return compiled, self.by_id, compiled.products
+        return compiled, self.by_name, ()
+
+    def _run(self, compiled, values, products):
+        if products:
+            failed = [p for p in products if self.memo.get(p) is None]
+            if failed:
+                raise FormulaError(f"Erro no componente '{self._name(failed[0])}'")
+            values = {name: self.memo[name[1]] if isinstance(name, tuple) else values[name]
+                      for name in compiled.names
+                      if isinstance(name, tuple) or name in values}
+        start = time.perf_counter()
+        try:
+            if self.size is None:
+                return compiled.evaluate(values)
+            return compiled.evaluate_many(values, self.size)
+        finally:
+            self.evaluating += time.perf_counter() - start
+            self.evaluated += 1
+
+    def _resolve(self, product_ids):
+        """Avalia os produtos e seus componentes, componentes primeiro."""
+        stack = [pid for pid in product_ids if pid not in self.memo]
+        expanded = set()
+        while stack:
+            pid = stack[-1]
+            if pid in self.memo:
+                stack.pop()
+                continue
+            try:
+                formula, tokens = self._formula(pid)
+                key = tokens or formula
+                cached = _MISSING if self.cache is None else self.cache.get(pid, key, _MISSING)
+                if cached is not _MISSING:
+                    self.memo[pid] = cached
+                    stack.pop()
+                    continue
+                if not tokens and (not formula or not formula.strip()):
+                    self.memo[pid] = None
+                    stack.pop()
+                    continue
+                compiled, values, products = self._compile(formula, tokens)
+                if pid not in expanded and products:
+                    pending = [p for p in products if p not in self.memo]
+                    if any(p in expanded for p in pending):
+                        raise FormulaError(f"Referência circular em '{self._name(pid)}'")
+                    if pending:
+                        expanded.add(pid)
+                        stack.extend(pending)
+                        continue
+                cost = self._run(compiled, values, products)
+                self.memo[pid] = cost
+                if self.cache is not None:
+                    self.cache.put(pid, key, cost)
+            except Exception as e:
+                self.memo[pid] = None
+                self.errors[pid] = e
+                if self.cache is not None:
+                    self.cache.discard([pid])
+            stack.pop()
+
+    def cost(self, pid):
+        """Custo do produto (None se a fórmula ou um componente tem erro)."""
+        self._resolve([pid])
+        return self.memo[pid]
+
+    def evaluate(self, formula, tokens=None):
+        """Valor de uma fórmula qualquer; lança FormulaError em caso de erro."""
+        compiled, values, products = self._compile(formula, tokens)
+        self._resolve(products)
+        return self._run(compiled, values, products)
+
+    def variables(self, formula, tokens=None):
+        """Chaves das variáveis de que a fórmula depende, inclusive pelos
+        componentes, na ordem em que aparecem."""
+        found = {}
+        seen = set()
+        pending = [(formula, tokens)]
+        while pending:
+            compiled, _, products = self._compile(*pending.pop())
+            for name in compiled.names:
+                if not isinstance(name, tuple):
+                    found.setdefault(name, None)
+            for pid in products:
+                if pid not in seen:
+                    seen.add(pid)
+                    pending.append(self._formula(pid))
+        return list(found)
+
+    def record(self):
+        """Registra os tempos no perfil da execução, se ativo."""
+        profile = current_profile()
+        if profile is not None and self.evaluated:
+            profile.record("fórmulas", "compilação", self.compiling, self.evaluated)
+            profile.record("fórmulas", "avaliação", self.evaluating, self.evaluated)
+
+
 def calculate_cost(formula):
     """
     Avalia uma fórmula de custo case-insensitive, permitindo nomes
@@ -164,72 +892,145 @@ def calculate_cost(formula):
     """
     if not formula or not formula.strip():
         return None
+    return calculate_costs([formula])[0]
+
+
+def calculate_costs(formulas, show_errors=True, tokens=None):
+    """
+    Avalia várias fórmulas de uma vez: as variáveis são lidas uma única vez
+    e cada fórmula distinta é compilada e avaliada uma única vez. `tokens`
+    traz, na mesma ordem, as versões pré-processadas (ou None), usadas no
+    lugar do texto. Retorna os custos na mesma ordem (None para fórmula
+    vazia ou com erro).
+    """
+    formulas = list(formulas)
+    try:
+        snapshot = get_variables_snapshot()
+    except Exception as e:
+        display_error(f"Erro ao buscar todas as variáveis: {e}", e)
+        return [None] * len(formulas)
+    tokens = [None] * len(formulas) if tokens is None else list(tokens)
+    return _evaluate_formulas(list(zip(formulas, tokens)), snapshot, show_errors)
+
+
+def _evaluate_formulas(formulas, snapshot, show_errors=True):
+    """Avalia [(texto, fórmula pré-processada ou None)], cada par distinto
+    uma única vez."""
+    results = {}
+    evaluator = CostEvaluator(snapshot, index_catalog)
+    for formula, tokens in formulas:
+        if (formula, tokens) in results:
+            continue
+        if not tokens and (not formula or not formula.strip()):
+            results[formula, tokens] = None
+            continue
+        try:
+            results[formula, tokens] = evaluator.evaluate(formula, tokens)
+        except Exception as e:
+            if show_errors:
+                display_error(f"Erro ao calcular fórmula: {e}", e)
+            results[formula, tokens] = None
+    evaluator.record()
+    return [results[f] for f in formulas]
+
+
+def prepare_formula(formula, product_id=None):
+    """
+    Valida a fórmula contra as variáveis e os produtos cadastrados e retorna
+    a versão pré-processada, com variáveis e produtos pelo id, para gravar em
+    produtos_custos.formula_compilada. Lança FormulaError se inválida ou se
+    `product_id` passaria a depender de si mesmo.
+    """
+    snapshot = get_variables_snapshot()
+    if "[" not in formula:
+        return snapshot.tokenize(formula)
+    index = get_product_index()
+    tokens = snapshot.tokenize(formula, index.names)
+    index.check_cycle(product_id, compile_tokens(tokens).products)
+    return tokens
+
 
+def rewrite_formulas(product_ids):
+    """
+    Regrava o texto das fórmulas dos produtos a partir da versão
+    pré-processada, com os nomes atuais das variáveis e dos produtos (após
+    renomear um deles). Retorna False em caso de erro.
+    """
+    product_ids = sorted(product_ids)
+    if not product_ids:
+        return True
+    sb = get_supabase_client()
     try:
-        # 1) Busca todas as variáveis no banco:
-        variables = get_all_variables_as_dict()  # {nome_exato: valor}
-
-        # 2) Monta um único regex que captura qualquer variável (spaces/_)
-        patterns = []
-        for name in variables.keys():
-            # transforma “PS BRANCO” em regex que aceita espaço ou underscore
-            pat = re.escape(name).replace(r"\ ", r"[ _]")
-            patterns.append(pat)
-        combined = r"\b(?:" + "|".join(patterns) + r")\b"
-        regex = re.compile(combined, flags=re.IGNORECASE)
-
-        # 3) Substitui cada ocorrência pelo valor correto
-        def repl(m):
-            raw = m.group(0)
-            # normaliza: underscore vira espaço e tudo para lowercase
-            key_lc = raw.replace("_", " ").strip().lower()
-            # encontra a chave exata no dict
-            actual = next((k for k in variables if k.lower() == key_lc), None)
-            if actual is None:
-                display_error(f"Variável '{raw}' não encontrada")
-                return "0"
-            return str(variables[actual])
-
-        processed = regex.sub(repl, formula)
-
-        # 4) Elimina espaços extras e padroniza vírgula para ponto
-        expr = processed.replace(" ", "").replace(",", ".")
-
-        # 5) Avalia com eval seguro
-        return float(eval(expr, {"__builtins__": None}, {}))
+        snapshot = get_variables_snapshot()
+        products = get_product_index().products
+        rows = sb.table("produtos_custos").select(
+            "id, nome, formula_compilada").in_("id", product_ids).execute().data or []
+        updates = [{"id": r["id"], "nome": r["nome"],
+                    "formula": snapshot.render(r["formula_compilada"], products)}
+                   for r in rows if r.get("formula_compilada")]
+        if updates:
+            sb.table("produtos_custos").upsert(updates, on_conflict="id").execute()
+        return True
+    except Exception as e:
+        display_error(f"Erro ao atualizar o texto das fórmulas: {e}", e)
+        return False
+
 
+def get_product_costs(products, show_errors=True):
+    """
+    Custos de [(id, fórmula, fórmula pré-processada)], com os componentes
+    dos produtos compostos. Reaproveita os custos já calculados com os
+    valores atuais das variáveis e só avalia os produtos novos, com fórmula
+    alterada ou afetados por uma variável ou componente alterado desde então.
+    """
+    products = list(products)
+    try:
+        snapshot = get_variables_snapshot()
     except Exception as e:
-        display_error(f"Erro ao calcular fórmula: {e}", e)
-        return None
+        display_error(f"Erro ao buscar todas as variáveis: {e}", e)
+        return [None] * len(products)
+
+    evaluator = CostEvaluator(snapshot, index_catalog, cache=snapshot.costs)
+    evaluator.formulas.update((pid, (f, t)) for pid, f, t in products)
+    costs = [evaluator.cost(pid) for pid, _, _ in products]
+    if show_errors:
+        for pid, _, _ in products:
+            if pid in evaluator.errors:
+                e = evaluator.errors.pop(pid)
+                display_error(f"Erro ao calcular fórmula: {e}", e)
+    evaluator.record()
+    return costs
 
 
 def update_calc_variable(name, value):
+    return update_calc_variables({name: value})
+
+
+def update_calc_variables(values):
+    """
+    Grava várias variáveis de cálculo em um único upsert. O PostgREST executa
+    o lote em uma só instrução, então ou todas as linhas são gravadas ou nenhuma.
+    """
+    if not values:
+        return True
     sb = get_supabase_client()
+    rows = [{"nome": nome, "valor": valor} for nome, valor in values.items()]
     try:
         sb.table("variaveis_calc").upsert(
-            {"nome": name, "valor": value},
+            rows,
             on_conflict="nome",
         ).execute()
+        invalidate_calc_vars_cache()
         return True
     except Exception as e:
-        display_error(f"Erro ao salvar variável \'{name}\'", e)
+        display_error(
+            f"Erro ao salvar variáveis de cálculo ({', '.join(values)}): {e}", e)
         return False
 
 
 def reset_calculator_variables_backend():
-    sb = get_supabase_client()
-    default_vals = {
-        "peso_50x50": 0, "perda_50x50": 0,
-        "peso_30x30": 0, "perda_30x30": 0,
-        "peso_25x25": 0, "perda_25x25": 0,
-    }
-    try:
-        for nome, valor in default_vals.items():
-            sb.table("variaveis_calc").upsert(
-                {"nome": nome, "valor": valor},
-                on_conflict="nome",
-            ).execute()
-        return True
-    except Exception as e:
-        display_error(f"Erro ao redefinir variáveis: {e}", e)
-        return False
+    default_vals = {}
+    for size, _, _ in get_plates():
+        default_vals[f"peso_{size}"] = 0
+        default_vals[f"perda_{size}"] = 0
+    return update_calc_variables(default_vals)
@@ -0,0 +1,486 @@
+import ast
+import hashlib
+import json
+import math
+import weakref
+from functools import lru_cache, reduce
+import numpy as np
+
+# --- Compilação de Fórmulas de Custo ---
+#
+# Uma fórmula é traduzida uma única vez para bytecode Python: cada nome de
+# variável vira um identificador interno (_v0, _v1, ...) e o resultado fica
+# em cache por texto. A avaliação só associa valores a esses identificadores,
+# sem regex nem reescrita de texto. `[Nome do Produto]` usa o custo de outro
+# produto (produtos compostos); a chave desses termos é ("p", produto).
+
+FORMULA_CACHE_SIZE = 4096
+
+
+class FormulaError(ValueError):
+    pass
+
+
+def _arredondar(valor, casas=0):
+    return round(valor, int(casas))
+
+
+# Funções matemáticas básicas disponíveis nas fórmulas.
+# Os argumentos são separados por ';' (a vírgula é o separador decimal).
+FUNCOES = {
+    "abs": abs,
+    "round": _arredondar,
+    "min": min,
+    "max": max,
+    "sqrt": math.sqrt,
+    "pow": math.pow,
+    "exp": math.exp,
+    "log": math.log,
+    "log10": math.log10,
+    "ceil": math.ceil,
+    "floor": math.floor,
+}
+
+_AMBIENTE = {"__builtins__": {}, **FUNCOES}
+
+
+def _log_vetorial(valor, base=math.e):
+    return np.log(valor) / np.log(base)
+
+
+# As mesmas funções, para avaliar com arrays NumPy (um valor por cenário).
+FUNCOES_VETORIAIS = {
+    "abs": np.abs,
+    "round": lambda valor, casas=0: np.round(valor, int(casas)),
+    "min": lambda *args: reduce(np.minimum, args),
+    "max": lambda *args: reduce(np.maximum, args),
+    "sqrt": np.sqrt,
+    "pow": np.power,
+    "exp": np.exp,
+    "log": _log_vetorial,
+    "log10": np.log10,
+    "ceil": np.ceil,
+    "floor": np.floor,
+}
+
+_AMBIENTE_VETORIAL = {"__builtins__": {}, **FUNCOES_VETORIAIS}
+
+_OPERADORES = {"+", "-", "*", "/", "%", "(", ")", ";", "^"}
+_OPERADORES_DUPLOS = {"**", "//"}
+
+_NOS_PERMITIDOS = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Constant,
+    ast.Load, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+    ast.Pow, ast.UAdd, ast.USub,
+)
+
+
+def normalize_name(name):
+    """Chave de comparação de um nome: sem diferença entre espaço e
+    underscore, nem entre maiúsculas e minúsculas."""
+    return " ".join(str(name).replace("_", " ").split()).lower()
+
+
+def normalize_variables(variables):
+    """Converte {nome: valor} em {nome_normalizado: float}."""
+    return {normalize_name(k): float(v) for k, v in variables.items()}
+
+
+def _numero(texto):
+    inteiro, _, decimal = texto.replace(",", ".").partition(".")
+    inteiro = inteiro or "0"
+    if not (inteiro.isascii() and inteiro.isdigit()):
+        return None
+    if decimal and not (decimal.isascii() and decimal.isdigit()):
+        return None
+    return float(f"{inteiro}.{decimal or 0}")
+
+
+def _eh_palavra(ch):
+    return ch.isalnum() or ch == "_"
+
+
+def is_plain_name(name):
+    """Nome só com letras, dígitos, espaços e underscores: é reconhecido na
+    fórmula mesmo sem consultar o vocabulário."""
+    return all(_eh_palavra(ch) or ch.isspace() for ch in str(name))
+
+
+class Vocabulary:
+    """
+    Trie dos nomes normalizados das variáveis. Permite reconhecer na fórmula
+    nomes com qualquer caractere (ex.: 'frete/kg', 'ICMS (%)'), sempre pelo
+    maior nome possível, com custo proporcional ao tamanho do nome e não ao
+    número de variáveis.
+    """
+
+    __slots__ = ("_root", "size", "cache_key", "__weakref__")
+
+    def __init__(self, names):
+        self._root = {}
+        self.size = 0
+        names = sorted(set(names))
+        for name in names:
+            node = self._root
+            for ch in name:
+                node = node.setdefault(ch, {})
+            node[""] = name
+            self.size += 1
+        self.cache_key = _VocabularyKey(self, names)
+
+    def match(self, text, start):
+        """Maior nome que começa em text[start] e termina em fronteira de
+        palavra. Retorna (fim, nome_normalizado) ou None."""
+        node = self._root
+        best = None
+        i, n = start, len(text)
+        while i < n and node is not None:
+            ch = text[i]
+            if ch.isspace() or ch == "_":
+                # espaço e underscore são equivalentes e contam como um só
+                while i < n and (text[i].isspace() or text[i] == "_"):
+                    i += 1
+                node = node.get(" ")
+            else:
+                for c in ch.lower():
+                    node = node.get(c) if node is not None else None
+                i += 1
+            if node is not None and "" in node and (
+                    i >= n or not _eh_palavra(text[i]) or not _eh_palavra(text[i - 1])):
+                best = (i, node[""])
+        return best
+
+
+class _VocabularyKey:
+    """
+    Chave do vocabulário no cache de compile_formula: igual para os mesmos
+    nomes, e com só uma referência fraca à trie, para o cache não manter
+    vivos os vocabulários trocados a cada variável incluída ou renomeada.
+    """
+
+    __slots__ = ("fingerprint", "_ref")
+
+    def __init__(self, vocabulary, names):
+        # `names` ordenados e sem repetição
+        digest = hashlib.blake2b(digest_size=16)
+        for name in names:
+            digest.update(name.encode("utf-8") + b"\0")
+        self.fingerprint = digest.digest()
+        self._ref = weakref.ref(vocabulary)
+
+    def __hash__(self):
+        return hash(self.fingerprint)
+
+    def __eq__(self, other):
+        return isinstance(other, _VocabularyKey) and self.fingerprint == other.fingerprint
+
+    def vocabulary(self):
+        return self._ref()
+
+
+def _tokenize(formula, vocabulary=None):
+    """Divide a fórmula em (tipo, texto, chave): "palavra", "nome" (variável
+    reconhecida pelo vocabulário, com a chave normalizada), "produto" (entre
+    colchetes) e "op"."""
+    tokens = []
+    i, n = 0, len(formula)
+    while i < n:
+        ch = formula[i]
+        if ch.isspace():
+            i += 1
+            continue
+        if ch == "[":
+            fim = formula.find("]", i)
+            if fim < 0:
+                raise FormulaError("Colchete sem fechamento na fórmula")
+            nome = formula[i + 1:fim].strip()
+            if not nome:
+                raise FormulaError("Nome de produto vazio entre colchetes")
+            tokens.append(("produto", nome, normalize_name(nome)))
+            i = fim + 1
+            continue
+        prox = formula[i + 1] if i + 1 < n else ""
+        if _eh_palavra(ch) and vocabulary is not None:
+            encontrado = vocabulary.match(formula, i)
+            if encontrado is not None and _numero(formula[i:encontrado[0]]) is None:
+                fim, chave = encontrado
+                tokens.append(("nome", formula[i:fim], chave))
+                i = fim
+                continue
+        if _eh_palavra(ch) or (ch in ",." and prox.isdigit()):
+            j = i + 1
+            while j < n:
+                c = formula[j]
+                if _eh_palavra(c):
+                    j += 1
+                elif c in ",." and j + 1 < n and formula[j + 1].isdigit() \
+                        and _numero(formula[i:j]) is not None:
+                    j += 1
+                else:
+                    break
+            tokens.append(("palavra", formula[i:j], None))
+            i = j
+        elif ch + prox in _OPERADORES_DUPLOS:
+            tokens.append(("op", ch + prox, None))
+            i += 2
+        elif ch in _OPERADORES:
+            tokens.append(("op", ch, None))
+            i += 1
+        else:
+            raise FormulaError(f"Caractere inválido na fórmula: '{ch}'")
+    return tokens
+
+
+def _agrupar(tokens):
+    """Junta palavras seguidas (separadas só por espaço) em um único nome,
+    permitindo variáveis como 'PS BRANCO', e classifica cada termo em
+    (tipo, texto, chave)."""
+    termos = []
+    i = 0
+    while i < len(tokens):
+        tipo, texto, chave = tokens[i]
+        if tipo == "op":
+            termos.append(("op", texto, None))
+            i += 1
+            continue
+        if tipo == "produto":
+            termos.append(("prod", texto, chave))
+            i += 1
+            continue
+        j = i
+        while j < len(tokens) and tokens[j][0] not in ("op", "produto"):
+            j += 1
+        proximo = tokens[j][1] if j < len(tokens) else None
+        if j - i > 1:
+            texto = " ".join(t[1] for t in tokens[i:j])
+            termos.append(("var", texto, normalize_name(texto)))
+        elif proximo == "(" and texto.lower() in FUNCOES:
+            termos.append(("func", texto.lower(), None))
+        elif tipo == "palavra" and _numero(texto) is not None:
+            termos.append(("num", _numero(texto), None))
+        else:
+            termos.append(("var", texto, chave or normalize_name(texto)))
+        i = j
+    return termos
+
+
+def _validar(arvore, placeholders):
+    for no in ast.walk(arvore):
+        if not isinstance(no, _NOS_PERMITIDOS):
+            raise FormulaError("Expressão não permitida na fórmula")
+        if isinstance(no, ast.Call):
+            if not (isinstance(no.func, ast.Name) and no.func.id in FUNCOES) \
+                    or no.keywords:
+                raise FormulaError("Chamada de função inválida na fórmula")
+        elif isinstance(no, ast.Name):
+            if no.id not in FUNCOES and no.id not in placeholders:
+                raise FormulaError(f"Nome inválido na fórmula: '{no.id}'")
+        elif isinstance(no, ast.Constant):
+            if not isinstance(no.value, float):
+                raise FormulaError("Constante inválida na fórmula")
+
+
+def _nao_encontrado(name, label):
+    if isinstance(name, tuple):
+        return FormulaError(f"Produto '{label}' não encontrado")
+    return FormulaError(f"Variável '{label}' não encontrada")
+
+
+class CompiledFormula:
+    """Fórmula já analisada: bytecode mais a lista de variáveis usadas."""
+
+    __slots__ = ("source", "code", "names", "labels", "placeholders", "products")
+
+    def __init__(self, source, code, names, labels):
+        self.source = source
+        self.code = code
+        # nomes normalizados, na ordem dos placeholders _v0, _v1, ...
+        self.names = names
+        # nomes como foram escritos na fórmula (para mensagens de erro)
+        self.labels = labels
+        self.placeholders = tuple(f"_v{i}" for i in range(len(names)))
+        # produtos citados entre colchetes (chaves ("p", produto) em `names`)
+        self.products = tuple(name[1] for name in names if isinstance(name, tuple))
+
+    def evaluate(self, variables):
+        """Avalia com `variables` no formato {nome_normalizado: valor}."""
+        env = {}
+        for placeholder, name, label in zip(self.placeholders, self.names, self.labels):
+            try:
+                env[placeholder] = variables[name]
+            except KeyError:
+                raise _nao_encontrado(name, label) from None
+        return float(eval(self.code, _AMBIENTE, env))
+
+    def evaluate_many(self, variables, size):
+        """
+        Avalia para `size` conjuntos de valores de uma vez: em `variables`
+        ({nome_normalizado: valor}) cada valor é um número ou um array com
+        `size` elementos. Retorna um array; resultados inválidos (divisão por
+        zero, raiz de negativo...) viram NaN.
+        """
+        env = {}
+        for placeholder, name, label in zip(self.placeholders, self.names, self.labels):
+            try:
+                env[placeholder] = np.asarray(variables[name], dtype=float)
+            except KeyError:
+                raise _nao_encontrado(name, label) from None
+        try:
+            with np.errstate(all="ignore"):
+                result = eval(self.code, _AMBIENTE_VETORIAL, env)
+            result = np.array(np.broadcast_to(result, (size,)), dtype=float)
+        except (ArithmeticError, ValueError, TypeError):
+            return np.full(size, np.nan)
+        result[~np.isfinite(result)] = np.nan
+        return result
+
+
+def _compilar(termos):
+    """Bytecode de uma lista de termos (tipo, valor, chave); cada chave de
+    variável distinta vira um placeholder _v0, _v1, ..."""
+    indices = {}
+    labels = []
+    partes = []
+    for tipo, valor, chave in termos:
+        if tipo == "num":
+            partes.append(repr(valor))
+        elif tipo == "func":
+            partes.append(valor)
+        elif tipo in ("var", "prod"):
+            if tipo == "prod":
+                chave = ("p", chave)
+            if chave not in indices:
+                indices[chave] = len(indices)
+                labels.append(valor)
+            partes.append(f"_v{indices[chave]}")
+        elif valor == ";":
+            partes.append(",")
+        elif valor == "^":
+            partes.append("**")
+        else:
+            partes.append(valor)
+    source = " ".join(partes)
+
+    try:
+        arvore = ast.parse(source, mode="eval")
+    except SyntaxError:
+        raise FormulaError("Sintaxe inválida na fórmula") from None
+    placeholders = {f"_v{i}" for i in range(len(indices))}
+    _validar(arvore, placeholders)
+    code = compile(arvore, "<formula>", "eval")
+    return CompiledFormula(source, code, tuple(indices), tuple(labels))
+
+
+def compile_formula(formula, vocabulary=None):
+    """
+    Analisa e compila uma fórmula; o resultado fica em cache por texto (e
+    pelos nomes do vocabulário). Com `vocabulary`, nomes cadastrados com
+    caracteres especiais também são reconhecidos.
+    """
+    return _compile_formula(formula, vocabulary and vocabulary.cache_key)
+
+
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def _compile_formula(formula, key):
+    if not formula or not formula.strip():
+        raise FormulaError("A fórmula está vazia")
+    # num cache miss, `key` é a do vocabulário de quem chamou, ainda vivo
+    return _compilar(_agrupar(_tokenize(formula, key and key.vocabulary())))
+
+
+compile_formula.cache_clear = _compile_formula.cache_clear
+
+
+# --- Fórmulas Pré-processadas ---
+#
+# Ao salvar um produto, a fórmula é validada e gravada também já dividida em
+# termos, com as variáveis pelo id (produtos_custos.formula_compilada), em
+# JSON: [["v", 12], ["o", "*"], ["n", 1.5], ["f", "round"], ...], e os
+# produtos citados também pelo id (["p", 7]). A leitura não resolve nome
+# nenhum, e renomear uma variável ou produto não quebra a fórmula.
+
+_TIPOS_TERMO = {"var": "v", "prod": "p", "num": "n", "func": "f", "op": "o"}
+
+
+def tokenize_formula(formula, vocabulary, ids, products=None):
+    """
+    Termos da fórmula em JSON, com cada variável trocada pelo id em `ids`
+    ({nome_normalizado: id}) e cada [produto] pelo id em `products` (idem;
+    None para nome repetido). Lança FormulaError se a fórmula é inválida ou
+    cita variáveis ou produtos não cadastrados.
+    """
+    compile_formula(formula, vocabulary)  # valida a sintaxe
+    termos = _agrupar(_tokenize(formula, vocabulary))
+    products = products or {}
+    unknown = [valor for tipo, valor, chave in termos
+               if tipo == "var" and chave not in ids]
+    if unknown:
+        raise FormulaError(
+            f"Variáveis não cadastradas: {', '.join(dict.fromkeys(unknown))}")
+    unknown = [valor for tipo, valor, chave in termos
+               if tipo == "prod" and chave not in products]
+    if unknown:
+        raise FormulaError(
+            f"Produtos não cadastrados: {', '.join(dict.fromkeys(unknown))}")
+    repeated = [valor for tipo, valor, chave in termos
+                if tipo == "prod" and products[chave] is None]
+    if repeated:
+        raise FormulaError(
+            f"Mais de um produto com o nome: {', '.join(dict.fromkeys(repeated))}")
+    tokens = [[_TIPOS_TERMO[tipo], ids[chave] if tipo == "var"
+               else products[chave] if tipo == "prod" else valor]
+              for tipo, valor, chave in termos]
+    return json.dumps(tokens, ensure_ascii=False, separators=(",", ":"))
+
+
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def compile_tokens(tokens):
+    """Compila uma fórmula pré-processada (tokenize_formula); os nomes da
+    CompiledFormula são os ids das variáveis. Fica em cache pelo JSON."""
+    termos = []
+    try:
+        for tipo, valor in json.loads(tokens):
+            if tipo == "v":
+                termos.append(("var", f"#{int(valor)}", int(valor)))
+            elif tipo == "p":
+                termos.append(("prod", f"#{int(valor)}", int(valor)))
+            elif tipo == "n":
+                termos.append(("num", float(valor), None))
+            elif tipo == "f" and valor in FUNCOES:
+                termos.append(("func", valor, None))
+            elif tipo == "o" and valor in _OPERADORES | _OPERADORES_DUPLOS:
+                termos.append(("op", valor, None))
+            else:
+                raise ValueError(tipo)
+    except (TypeError, ValueError):
+        raise FormulaError("Fórmula pré-processada inválida") from None
+    if not termos:
+        raise FormulaError("A fórmula está vazia")
+    return _compilar(termos)
+
+
+def _texto_numero(valor):
+    return np.format_float_positional(valor, trim="-").replace(".", ",")
+
+
+def render_formula(tokens, names, products=None):
+    """Texto de uma fórmula pré-processada, com os nomes atuais das variáveis
+    e dos produtos ({id: nome}); ids sem nome aparecem como #id."""
+    partes = []
+    anterior = None
+    for tipo, valor in json.loads(tokens):
+        if tipo == "v":
+            texto = names.get(valor, f"#{valor}")
+        elif tipo == "p":
+            texto = f"[{(products or {}).get(valor, f'#{valor}')}]"
+        elif tipo == "n":
+            texto = _texto_numero(valor)
+        else:
+            texto = valor
+        # sem espaço depois de "(" e de função, nem antes de ")" e ";"
+        if anterior is not None and anterior not in ("f", "(") \
+                and texto not in (")", ";"):
+            partes.append(" ")
+        partes.append(texto)
+        anterior = "f" if tipo == "f" else texto
+    return "".join(partes)
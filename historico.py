@@ -0,0 +1,351 @@
+import math
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from datetime import datetime, date, time as dtime, timedelta, timezone
+import altair as alt
+import numpy as np
+import pandas as pd
+import streamlit as st
+from textos import TEXTOS
+from supabase_db import get_supabase_client, get_setting, fetch_all_rows
+from calculadora import (display_error, get_variables_snapshot, get_product_index,
+                         index_catalog, VariablesSnapshot, CostEvaluator)
+from analise import load_products, products_catalog
+from perfil import span
+
+# --- Histórico dos Valores das Variáveis ---
+#
+# variaveis_historico guarda, só por acréscimo, cada alteração de valor de
+# uma variável de custo (variavel_id, valor, vigente_desde); valor nulo
+# marca a remoção. Em memória, compartilhado entre as sessões, cada variável
+# tem os instantes e os valores em dois array('d') ordenados, e o valor em
+# uma data é uma busca binária. Com isso, o catálogo inteiro pode ser
+# recalculado em qualquer data passada, e a série de custos de um produto
+# é uma única avaliação vetorial (uma posição por alteração), sem reaplicar
+# as alterações uma a uma. As fórmulas usadas são as atuais: só os valores
+# das variáveis têm histórico.
+
+HISTORICO_CACHE_TTL = float(get_setting("HISTORICO_CACHE_TTL", 600))
+
+# período padrão da série de custos, em dias
+HISTORICO_PERIODO = int(get_setting("HISTORICO_PERIODO", 90))
+
+_NAN = float("nan")
+
+
+def _instant(text):
+    """Segundos desde a época (UTC) de um timestamp ISO; sem fuso, UTC."""
+    when = datetime.fromisoformat(str(text).replace("Z", "+00:00"))
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+
+def _timestamp(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat()
+
+
+def end_of_day(day):
+    """Último instante (UTC) de uma data, para consultas "na data X"."""
+    return datetime.combine(day, dtime.max, tzinfo=timezone.utc).timestamp()
+
+
+class VariableHistory:
+    """
+    {id: (instantes, valores)}, ordenados por instante, com NaN para a
+    variável removida. Valores repetidos em sequência não são guardados.
+    """
+
+    def __init__(self, rows=()):
+        self.lock = threading.Lock()
+        self.times = {}   # {id: array('d') de instantes}
+        self.values = {}  # {id: array('d') de valores}
+        self.loaded_at = time.time()
+        for var_id, value, when in rows:
+            self._add(var_id, when, value)
+
+    def __len__(self):
+        return sum(map(len, self.times.values()))
+
+    def _add(self, var_id, when, value):
+        value = _NAN if value is None else float(value)
+        if var_id not in self.times:
+            self.times[var_id], self.values[var_id] = array("d"), array("d")
+        times, values = self.times[var_id], self.values[var_id]
+        # normalmente no fim; fora de ordem só com relógios diferentes
+        i = len(times) if not times or when >= times[-1] else bisect_right(times, when)
+        if i and (values[i - 1] == value or math.isnan(values[i - 1]) and math.isnan(value)):
+            return
+        times.insert(i, when)
+        values.insert(i, value)
+
+    def add(self, var_id, when, value):
+        with self.lock:
+            self._add(var_id, when, value)
+
+    def values_at(self, when, current):
+        """
+        {id: valor} das variáveis existentes em `when`. Variáveis sem
+        histórico (cadastradas fora do app) ficam com o valor de `current`
+        ({id: valor}).
+        """
+        result = {var_id: v for var_id, v in current.items() if var_id not in self.times}
+        with self.lock:
+            for var_id, times in self.times.items():
+                i = bisect_right(times, when)
+                if i and not math.isnan(self.values[var_id][i - 1]):
+                    result[var_id] = self.values[var_id][i - 1]
+        return result
+
+    def changes(self, var_ids, start, end):
+        """Instantes em (start, end] em que alguma das variáveis mudou."""
+        found = set()
+        with self.lock:
+            for var_id in var_ids:
+                times = self.times.get(var_id)
+                if times:
+                    found.update(times[bisect_right(times, start):bisect_right(times, end)])
+        return sorted(found)
+
+    def series(self, var_id, instants, current=_NAN):
+        """Valores da variável em cada instante de `instants` (array
+        ordenado); NaN antes do primeiro registro ou após a remoção."""
+        with self.lock:
+            if var_id not in self.times:
+                return np.full(len(instants), current)
+            times = np.array(self.times[var_id])
+            values = np.array(self.values[var_id])
+        positions = np.searchsorted(times, instants, side="right") - 1
+        return np.where(positions >= 0, values[np.maximum(positions, 0)], np.nan)
+
+
+@st.cache_resource(show_spinner=False)
+def _history_state():
+    return {"lock": threading.Lock(), "history": None}
+
+
+def _load_history():
+    sb = get_supabase_client()
+    return VariableHistory(
+        (r["variavel_id"], r["valor"], _instant(r["vigente_desde"]))
+        for r in fetch_all_rows(sb, "variaveis_historico",
+                                "id, variavel_id, valor, vigente_desde"))
+
+
+def get_history():
+    state = _history_state()
+    with state["lock"]:
+        history = state["history"]
+        if history is None or time.time() - history.loaded_at > HISTORICO_CACHE_TTL:
+            history = _load_history()
+            state["history"] = history
+        return history
+
+
+def invalidate_history_cache():
+    state = _history_state()
+    with state["lock"]:
+        state["history"] = None
+
+
+def record_values(changes):
+    """
+    Acrescenta ao histórico os novos valores [(id da variável, valor)], com
+    valor None para variável removida, todos com o instante atual.
+    """
+    changes = list(changes)
+    if not changes:
+        return
+    now = time.time()
+    get_supabase_client().table("variaveis_historico").insert(
+        [{"variavel_id": var_id, "valor": value, "vigente_desde": _timestamp(now)}
+         for var_id, value in changes]).execute()
+    history = _history_state()["history"]
+    if history is not None:
+        for var_id, value in changes:
+            history.add(var_id, now, value)
+
+
+def record_changes(changes):
+    """
+    record_values para depois de gravada a alteração da variável: uma falha
+    no histórico (ex.: tabela ainda não criada) só gera um aviso, sem
+    desfazer nem esconder a alteração.
+    """
+    try:
+        record_values(changes)
+    except Exception as e:
+        st.warning(f"Alteração gravada, mas não registrada no histórico de valores: {e}")
+
+
+def snapshot_at(when, snapshot=None, history=None):
+    """Variáveis com os valores vigentes em `when` (segundos desde a época),
+    com os nomes atuais; as removidas desde então aparecem como '#id'."""
+    snapshot = snapshot or get_variables_snapshot()
+    if history is None:
+        history = get_history()
+    rows = {var_id: (snapshot.rows[var_id][0] if var_id in snapshot.rows else f"#{var_id}",
+                     value)
+            for var_id, value in history.values_at(when, snapshot.by_id).items()}
+    past = VariablesSnapshot(snapshot.version, rows)
+    if past.names.keys() == snapshot.names.keys():
+        # mesmos nomes: as fórmulas em texto compilam igual
+        past._vocabulary = snapshot._vocabulary
+    return past
+
+
+def costs_at(products, when=None, catalog=None, snapshot=None):
+    """
+    Custos de [(id, nome, (fórmula, fórmula pré-processada))] com os valores
+    das variáveis vigentes em `when` (None = valores atuais). Retorna um
+    array na mesma ordem, com NaN onde a fórmula tem erro (ou usa variável
+    que ainda não existia).
+    """
+    snapshot = snapshot or get_variables_snapshot()
+    if when is None:
+        evaluator = CostEvaluator(snapshot, catalog or products_catalog(products),
+                                  cache=snapshot.costs)
+    else:
+        evaluator = CostEvaluator(snapshot_at(when, snapshot),
+                                  catalog or products_catalog(products))
+    result = np.full(len(products), np.nan)
+    with span("fórmulas", "histórico", len(products)):
+        for row, (pid, _, (formula, tokens)) in enumerate(products):
+            evaluator.formulas[pid] = (formula, tokens)
+            cost = evaluator.cost(pid)
+            if cost is not None:
+                result[row] = cost
+    return result
+
+
+def cost_series(products, start, end, catalog=index_catalog, snapshot=None):
+    """
+    Custo de cada produto ao longo de [start, end] (segundos desde a
+    época): os instantes são `start`, cada alteração de uma variável usada
+    pelos produtos (ou seus componentes) e `end`. Cada fórmula é avaliada
+    uma única vez, com um array por variável. Retorna (instantes, matriz
+    produtos × instantes), com NaN onde a fórmula tem erro.
+    """
+    snapshot = snapshot or get_variables_snapshot()
+    history = get_history()
+    base = CostEvaluator(snapshot, catalog)
+    # chaves das variáveis (id, ou nome nas fórmulas só em texto) -> id
+    keys = {}
+    for _, _, (formula, tokens) in products:
+        if not tokens and (not formula or not formula.strip()):
+            continue
+        try:
+            for key in base.variables(formula, tokens):
+                keys[key] = snapshot.ids.get(key, key)
+        except Exception:
+            continue
+    instants = np.array(sorted(
+        {start, end, *history.changes(set(keys.values()), start, end)}))
+    env = {key: history.series(var_id, instants, snapshot.by_id.get(var_id, _NAN))
+           for key, var_id in keys.items()}
+    evaluator = CostEvaluator(snapshot, base.catalog_data, len(instants), env, env)
+
+    result = np.full((len(products), len(instants)), np.nan)
+    with span("fórmulas", "série histórica", len(products)):
+        for row, (_, _, (formula, tokens)) in enumerate(products):
+            if not tokens and (not formula or not formula.strip()):
+                continue
+            try:
+                result[row] = evaluator.evaluate(formula, tokens)
+            except Exception:
+                continue
+    return instants, result
+
+
+def series_table(products, instants, costs):
+    """DataFrame longo (Data, Produto, Custo) para o gráfico."""
+    dates = pd.to_datetime(instants, unit="s", utc=True)
+    return pd.DataFrame({
+        "Data": np.tile(dates, len(products)),
+        "Produto": np.repeat([nome for _, nome, _ in products], len(instants)),
+        "Custo": costs.ravel(),
+    })
+
+
+# --- Funções de UI ---
+
+
+def show_history():
+    st.subheader(TEXTOS["hist_titulo"])
+    st.caption(TEXTOS["hist_descricao"])
+    _show_series()
+    st.divider()
+    _show_catalog_at()
+
+
+def _show_series():
+    try:
+        index = get_product_index()
+    except Exception as e:
+        display_error(f"Erro ao buscar produtos: {e}", e)
+        return
+    selected = st.multiselect(
+        "Produtos", sorted(index.products, key=lambda i: index.products[i].lower()),
+        format_func=index.products.get, key="hist_produtos")
+    today = date.today()
+    period = st.date_input(
+        "Período", (today - timedelta(days=HISTORICO_PERIODO), today),
+        max_value=today, key="hist_periodo")
+    if st.button("Mostrar custos no período", key="hist_calcular"):
+        if not selected:
+            display_error("Selecione ao menos um produto.")
+            return
+        if len(period) != 2:
+            display_error("Selecione a data inicial e a final.")
+            return
+        start = datetime.combine(period[0], dtime.min, tzinfo=timezone.utc).timestamp()
+        try:
+            with st.spinner("Calculando..."):
+                products = [(pid, index.products[pid], index.formulas[pid])
+                            for pid in selected if pid in index.products]
+                instants, costs = cost_series(products, start, end_of_day(period[1]))
+            st.session_state.hist_resultado = series_table(products, instants, costs)
+        except Exception as e:
+            display_error(f"Erro ao calcular o histórico: {e}", e)
+            return
+
+    table = st.session_state.get("hist_resultado")
+    if table is None:
+        return
+    chart = alt.Chart(table.dropna()).mark_line(interpolate="step-after", point=True).encode(
+        x=alt.X("Data:T"), y=alt.Y("Custo:Q", title="Custo (R$)"),
+        color="Produto:N", tooltip=["Produto", "Data", alt.Tooltip("Custo", format=".2f")])
+    st.altair_chart(chart, use_container_width=True)
+
+
+def _show_catalog_at():
+    day = st.date_input("Catálogo na data", date.today() - timedelta(days=30),
+                        max_value=date.today(), key="hist_data")
+    if st.button("Calcular catálogo na data", key="hist_catalogo"):
+        try:
+            with st.spinner("Calculando..."):
+                snapshot = get_variables_snapshot()
+                products = load_products()
+                catalog = products_catalog(products)
+                past = costs_at(products, end_of_day(day), catalog, snapshot)
+                current = costs_at(products, None, catalog, snapshot)
+            with np.errstate(all="ignore"):
+                change = np.where(past != 0, (current - past) / np.abs(past) * 100, np.nan)
+            st.session_state.hist_catalogo_resultado = pd.DataFrame({
+                "Produto": [nome for _, nome, _ in products],
+                f"Custo em {day:%d/%m/%Y}": past, "Custo atual": current,
+                "Δ %": change})
+        except Exception as e:
+            display_error(f"Erro ao calcular o catálogo na data: {e}", e)
+            return
+
+    result = st.session_state.get("hist_catalogo_resultado")
+    if result is not None:
+        st.dataframe(
+            result, hide_index=True, use_container_width=True,
+            column_config={
+                col: st.column_config.NumberColumn(
+                    format="%.2f%%" if col == "Δ %" else "R$ %.2f")
+                for col in result.columns if col != "Produto"})
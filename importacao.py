@@ -0,0 +1,346 @@
+import tempfile
+from itertools import islice
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import streamlit as st
+from textos import TEXTOS
+from supabase_db import get_supabase_client, get_setting, fetch_all_rows
+from calculadora import (display_error, display_success, get_product_costs,
+                         get_variables_snapshot, invalidate_variables_cache,
+                         invalidate_products_cache, get_category_names,
+                         invalidate_categories_cache, get_product_index,
+                         product_dependents, discard_product_costs)
+from formulas import FormulaError, compile_tokens, normalize_name
+from recalculo import enqueue_recompute
+from busca import invalidate_search_index
+from historico import record_changes, invalidate_history_cache
+
+# --- Importação e Exportação em Lotes ---
+#
+# Os arquivos são lidos e gravados em lotes de IMPORTACAO_LOTE linhas: cada
+# lote vira um insert (linhas novas) e um upsert (linhas com nome já
+# cadastrado), e a exportação lê o banco por cursor, sem carregar a tabela
+# inteira na memória.
+
+IMPORTACAO_LOTE = int(get_setting("IMPORTACAO_LOTE", 1000))
+
+FORMATOS = {"CSV": "csv", "Parquet": "parquet"}
+
+_SCHEMA_PRODUTOS = pa.schema([
+    ("id", pa.int64()), ("nome", pa.string()), ("formula", pa.string()),
+    ("categoria", pa.string()), ("custo", pa.float64()),
+])
+_SCHEMA_VARIAVEIS = pa.schema([
+    ("id", pa.int64()), ("nome", pa.string()), ("valor", pa.float64()),
+    ("categoria", pa.string()),
+])
+
+
+def read_chunks(file, fmt, chunk_size=IMPORTACAO_LOTE):
+    """Lê um CSV (separador detectado) ou Parquet em DataFrames de até
+    `chunk_size` linhas, com todas as colunas como texto."""
+    if fmt == "parquet":
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=chunk_size):
+            df = batch.to_pandas().astype(object)
+            yield df.where(df.notna(), "").astype(str)
+    else:
+        yield from pd.read_csv(file, sep=None, engine="python", dtype=str,
+                               keep_default_na=False, chunksize=chunk_size)
+
+
+def _batched(rows, size):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def _parse_value(text):
+    text = str(text).strip()
+    if "," in text:
+        # formato brasileiro: 1.234,56
+        text = text.replace(".", "").replace(",", ".")
+    return float(text)
+
+
+def _name_to_id(sb, table):
+    return {normalize_name(r["nome"]): r["id"] for r in fetch_all_rows(sb, table, "id, nome")}
+
+
+def _resolve_categories(sb, table, categories, names, create):
+    """Garante o id de cada nome de categoria do lote (criando as que faltam,
+    se permitido, em um único insert). Retorna os nomes não encontrados."""
+    missing = {}
+    for n in names:
+        key = normalize_name(n)
+        if key and key not in categories:
+            missing.setdefault(key, str(n).strip())
+    if missing and create:
+        res = sb.table(table).insert(
+            [{"nome": n} for n in sorted(missing.values())]).execute()
+        invalidate_categories_cache(table)
+        invalidate_search_index(table)
+        categories.update({normalize_name(r["nome"]): r["id"] for r in res.data})
+        return set()
+    return set(missing)
+
+
+def _check_columns(chunk, required):
+    columns = {str(c).strip().lower() for c in chunk.columns}
+    absent = required - columns
+    if absent:
+        raise ValueError(f"Colunas obrigatórias ausentes: {', '.join(sorted(absent))}")
+    chunk.columns = [str(c).strip().lower() for c in chunk.columns]
+
+
+def _import(file, fmt, table, category_table, required, build_record, create_categories,
+            on_write=None):
+    """Linhas com o mesmo nome no arquivo valem como uma só (a última).
+    `on_write`, se dado, recebe as linhas gravadas de cada lote (com o id)."""
+    sb = get_supabase_client()
+    categories = {normalize_name(n): i for i, n in get_category_names(category_table).items()}
+    existing = _name_to_id(sb, table)
+    report = {"inseridos": 0, "atualizados": 0, "rejeitados": 0, "erros": [], "ids": []}
+    line = 1  # cabeçalho
+    for chunk in read_chunks(file, fmt):
+        _check_columns(chunk, required)
+        unknown_cats = _resolve_categories(
+            sb, category_table, categories,
+            chunk["categoria"] if "categoria" in chunk else [], create_categories)
+        # {nome: registro}: um nome repetido no lote fica com a última linha
+        inserts, updates = {}, {}
+        for row in chunk.to_dict("records"):
+            line += 1
+            try:
+                cat = str(row.get("categoria") or "").strip()
+                if normalize_name(cat) in unknown_cats:
+                    raise ValueError(f"categoria '{cat}' não encontrada")
+                record = build_record(row)
+                if "categoria" in row:
+                    record["categoria_id"] = categories.get(normalize_name(cat)) if cat else None
+            except (ValueError, FormulaError) as e:
+                report["rejeitados"] += 1
+                report["erros"].append(f"Linha {line}: {e}")
+                continue
+            key = normalize_name(record["nome"])
+            current = existing.get(key)
+            if current is None:
+                inserts[key] = record
+            else:
+                updates[key] = {"id": current, **record}
+        inserts, updates = list(inserts.values()), list(updates.values())
+        if inserts:
+            res = sb.table(table).insert(inserts).execute()
+            existing.update({normalize_name(r["nome"]): r["id"] for r in res.data})
+            report["ids"] += [r["id"] for r in res.data]
+            report["inseridos"] += len(inserts)
+            if on_write:
+                on_write(res.data)
+        if updates:
+            sb.table(table).upsert(updates, on_conflict="id").execute()
+            report["ids"] += [r["id"] for r in updates]
+            report["atualizados"] += len(updates)
+            if on_write:
+                on_write(updates)
+    return report
+
+
+def import_variables(file, fmt, create_categories=False):
+    """
+    Importa variáveis (colunas nome, valor e, opcional, categoria). Variáveis
+    com o nome de uma já cadastrada são atualizadas.
+    Retorna {"inseridos", "atualizados", "rejeitados", "erros", "ids"}.
+    """
+    def build(row):
+        nome = str(row.get("nome") or "").strip()
+        if not nome:
+            raise ValueError("nome vazio")
+        try:
+            valor = _parse_value(row.get("valor"))
+        except ValueError:
+            raise ValueError(f"valor inválido: '{row.get('valor')}'") from None
+        return {"nome": nome, "valor": valor}
+
+    # só os valores que mudaram entram no histórico, depois da importação
+    current = get_variables_snapshot().by_id
+    changes = {}
+
+    def write(rows):
+        changes.update((r["id"], r["valor"]) for r in rows
+                       if current.get(r["id"]) != float(r["valor"]))
+
+    try:
+        return _import(file, fmt, "variaveis_custos", "categorias_variaveis",
+                       {"nome", "valor"}, build, create_categories, write)
+    finally:
+        # os custos de qualquer produto podem ter mudado
+        invalidate_search_index("variaveis_custos")
+        invalidate_variables_cache()
+        invalidate_products_cache()
+        enqueue_recompute()
+        record_changes(changes.items())
+        # um lote grande é relido do banco na próxima consulta ao histórico
+        invalidate_history_cache()
+
+
+def import_products(file, fmt, create_categories=False):
+    """
+    Importa produtos (colunas nome, formula e, opcional, categoria). As
+    fórmulas são validadas contra as variáveis e os produtos já cadastrados
+    (componentes citados entre colchetes); produtos com o nome de um já
+    cadastrado são atualizados.
+    Retorna {"inseridos", "atualizados", "rejeitados", "erros", "ids"}.
+    """
+    snapshot = get_variables_snapshot()
+    index = None
+    # componentes de cada linha aceita, {nome_normalizado: ids}, para o grafo
+    # do índice (carregado só na primeira fórmula com colchetes)
+    accepted = {}
+
+    def build(row):
+        nonlocal index
+        nome = str(row.get("nome") or "").strip()
+        formula = str(row.get("formula") or "").strip()
+        if not nome:
+            raise ValueError("nome vazio")
+        key = normalize_name(nome)
+        if "[" in formula:
+            if index is None:
+                # grafo com as linhas já aceitas deste arquivo
+                index = get_product_index().detached()
+                for name, ids in accepted.items():
+                    if index.names.get(name) is not None:
+                        index.link(index.names[name], ids)
+            tokens = snapshot.tokenize(formula, index.names)
+            components = compile_tokens(tokens).products
+            index.check_cycle(index.names.get(key), components)
+        else:
+            tokens = snapshot.tokenize(formula)
+            components = ()
+        accepted[key] = components
+        if index is not None and index.names.get(key) is not None:
+            index.link(index.names[key], components)
+        return {"nome": nome, "formula": formula, "formula_compilada": tokens,
+                "custo_calculado": None, "calculado_em": None}
+
+    report = {"ids": []}
+    try:
+        report = _import(file, fmt, "produtos_custos", "categorias_produtos",
+                         {"nome", "formula"}, build, create_categories)
+        return report
+    finally:
+        invalidate_search_index("produtos_custos")
+        invalidate_products_cache()
+        # os importados e os compostos que usam algum deles
+        affected = product_dependents(report["ids"])
+        discard_product_costs(affected)
+        enqueue_recompute(affected)
+
+
+def _write_chunk(out, df, fmt, schema, writer):
+    if fmt == "parquet":
+        if writer is None:
+            writer = pq.ParquetWriter(out, schema)
+        writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+        return writer
+    out.write(df.to_csv(index=False, header=writer is None).encode("utf-8"))
+    return True
+
+
+def _export(rows, fmt, schema, to_frame):
+    out = tempfile.TemporaryFile()
+    writer = None
+    for batch in _batched(rows, IMPORTACAO_LOTE):
+        writer = _write_chunk(out, to_frame(batch), fmt, schema, writer)
+    if writer is None:
+        writer = _write_chunk(out, schema.empty_table().to_pandas(), fmt, schema, None)
+    if fmt == "parquet":
+        writer.close()
+    out.seek(0)
+    return out
+
+
+def export_products(fmt):
+    """Exporta os produtos com o custo calculado para um arquivo temporário,
+    lendo o banco em lotes. Retorna o arquivo posicionado no início."""
+    sb = get_supabase_client()
+    categories = get_category_names("categorias_produtos")
+
+    def to_frame(batch):
+        costs = get_product_costs(
+            [(r["id"], r.get("formula"), r.get("formula_compilada")) for r in batch],
+            show_errors=False)
+        return pd.DataFrame({
+            "id": [r["id"] for r in batch],
+            "nome": [r["nome"] for r in batch],
+            "formula": [r.get("formula") for r in batch],
+            "categoria": [categories.get(r.get("categoria_id")) for r in batch],
+            "custo": costs,
+        })
+
+    rows = fetch_all_rows(sb, "produtos_custos",
+                          "id, nome, formula, formula_compilada, categoria_id")
+    return _export(rows, fmt, _SCHEMA_PRODUTOS, to_frame)
+
+
+def export_variables(fmt):
+    """Exporta as variáveis para um arquivo temporário, lendo o banco em
+    lotes. Retorna o arquivo posicionado no início."""
+    sb = get_supabase_client()
+    categories = get_category_names("categorias_variaveis")
+
+    def to_frame(batch):
+        return pd.DataFrame({
+            "id": [r["id"] for r in batch],
+            "nome": [r["nome"] for r in batch],
+            "valor": [float(r["valor"]) for r in batch],
+            "categoria": [categories.get(r.get("categoria_id")) for r in batch],
+        })
+
+    rows = fetch_all_rows(sb, "variaveis_custos", "id, nome, valor, categoria_id")
+    return _export(rows, fmt, _SCHEMA_VARIAVEIS, to_frame)
+
+
+# --- Funções de UI ---
+
+
+def show_import_export():
+    st.subheader(TEXTOS["imp_titulo"])
+    kind = st.radio("Dados", ["Produtos", "Variáveis"],
+                    horizontal=True, key="imp_tipo")
+    if kind == "Produtos":
+        import_func, export_func = import_products, export_products
+        st.caption(TEXTOS["imp_colunas_produtos"])
+    else:
+        import_func, export_func = import_variables, export_variables
+        st.caption(TEXTOS["imp_colunas_variaveis"])
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("**Importar**")
+        file = st.file_uploader("Arquivo CSV ou Parquet", type=[
+                                "csv", "parquet"], key=f"imp_arquivo_{kind}")
+        create = st.checkbox("Criar categorias inexistentes",
+                             key=f"imp_criar_{kind}")
+        if file is not None and st.button("Importar", key=f"imp_btn_{kind}"):
+            fmt = "parquet" if file.name.lower().endswith(".parquet") else "csv"
+            try:
+                with st.spinner("Importando..."):
+                    report = import_func(file, fmt, create)
+                display_success(
+                    f"{report['inseridos']} inserido(s), {report['atualizados']} "
+                    f"atualizado(s), {report['rejeitados']} rejeitado(s).")
+                if report["erros"]:
+                    with st.expander("Linhas rejeitadas"):
+                        st.write("\n".join(f"- {e}" for e in report["erros"][:200]))
+            except Exception as e:
+                display_error(f"Erro ao importar arquivo: {e}", e)
+    with col2:
+        st.markdown("**Exportar**")
+        label = st.radio("Formato", list(FORMATOS), horizontal=True,
+                         key=f"exp_formato_{kind}")
+        fmt = FORMATOS[label]
+        st.download_button(
+            "⬇️ Exportar", data=lambda: export_func(fmt),
+            file_name=f"{kind.lower()}.{fmt}", key=f"exp_btn_{kind}",
+            mime="text/csv" if fmt == "csv" else "application/octet-stream")
@@ -2,8 +2,15 @@ import streamlit as st
 from textos import TEXTOS
 from calculadora import show_price_calculator
 from producao import show_production_costs
+from supabase_db import (get_connection_stats, get_rerun_scope, start_rerun_scope,
+                         get_setting, BACKEND)
+from perfil import start_profile, show_profile_panel, span
 
 st.set_page_config(page_title="Custos do Ecommerce", layout="wide")
+start_rerun_scope()
+if "perfil_ativo" not in st.session_state:
+    st.session_state.perfil_ativo = str(get_setting("PERFIL", "0")).lower() in ("1", "true", "sim")
+start_profile(st.session_state.perfil_ativo)
 
 st.markdown("""
 <style>
@@ -40,7 +47,21 @@ h3 {
 st.sidebar.title("Navegação")
 menu = st.sidebar.radio("Ir para:", TEXTOS["menu_lateral"])
 
-if menu == "Custos de Produção":
-    show_production_costs()
-elif menu == "Calculadora de Preços":
-    show_price_calculator()
+with span("página", menu):
+    if menu == "Custos de Produção":
+        show_production_costs()
+    elif menu == "Calculadora de Preços":
+        show_price_calculator()
+
+# Contadores do pool de conexões (exibidos ao final, já com as chamadas desta execução)
+with st.sidebar.expander("Conexões com o banco"):
+    if BACKEND == "sqlite":
+        st.caption("Banco local (SQLite)")
+    else:
+        stats = get_connection_stats()
+        st.caption(f"Criadas: {stats.created} · Reaproveitadas: {stats.reused}")
+    scope = get_rerun_scope()
+    st.caption(f"Consultas nesta execução: {scope.backend_calls} · "
+               f"Repetidas evitadas: {scope.coalesced}")
+
+show_profile_panel()
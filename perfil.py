@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# --- Perfil de Desempenho ---
+#
+# Instrumentação opcional (ative na barra lateral ou com PERFIL = 1): cada
+# chamada ao banco e cada lote de fórmulas avaliadas registra duração,
+# quantidade e tamanho da resposta na execução atual do script. O painel
+# mostra o resumo e exporta os eventos no formato Trace Event (abre em
+# chrome://tracing ou ui.perfetto.dev).
+
+_CHAVE = "_perfil_execucao"
+
+
+class Profile:
+    """Eventos de uma execução do script."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        # (categoria, nome, início_s, duração_s, quantidade, bytes, thread)
+        self.events = []
+
+    def record(self, category, name, seconds, count=1, size=None, start=None):
+        start = time.perf_counter() - seconds if start is None else start
+        with self.lock:
+            self.events.append((category, name, start - self.started, seconds,
+                                count, size, threading.get_ident()))
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def start_profile(enabled):
+    """Inicia (ou desliga) o perfil da execução atual. Chamado no início
+    de main.py."""
+    st.session_state[_CHAVE] = Profile() if enabled else None
+
+
+def current_profile():
+    """Perfil da execução atual, ou None se desativado ou fora do script."""
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    return st.session_state.get(_CHAVE)
+
+
+@contextmanager
+def span(category, name, count=1):
+    """Mede o bloco e registra no perfil da execução, se ativo. O dicionário
+    devolvido aceita "count" e "size" definidos dentro do bloco."""
+    profile = current_profile()
+    info = {"count": count, "size": None}
+    if profile is None:
+        yield info
+        return
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        profile.record(category, name, time.perf_counter() - start,
+                       info["count"], info["size"], start)
+
+
+def payload_size(data):
+    """Tamanho aproximado, em bytes, de uma resposta do banco em JSON."""
+    return len(json.dumps(data, default=str).encode("utf-8"))
+
+
+def summary(profile):
+    """Resumo por (categoria, nome): chamadas, itens, tempo total e médio."""
+    events = pd.DataFrame(profile.events, columns=[
+        "Categoria", "Nome", "inicio", "duracao", "Itens", "Bytes", "thread"])
+    if events.empty:
+        return events
+    table = events.groupby(["Categoria", "Nome"]).agg(
+        Chamadas=("duracao", "size"), Itens=("Itens", "sum"),
+        total=("duracao", "sum"), Bytes=("Bytes", "sum"))
+    table["Total (ms)"] = table.pop("total") * 1e3
+    table["Média (ms)"] = table["Total (ms)"] / table["Chamadas"]
+    return table.sort_values("Total (ms)", ascending=False).reset_index()
+
+
+def trace_events(profile):
+    """Eventos no formato Trace Event (JSON), para análise offline."""
+    base = profile.wall_started * 1e6
+    events = [{
+        "name": name, "cat": category, "ph": "X", "pid": 1, "tid": thread,
+        "ts": base + start * 1e6, "dur": duration * 1e6,
+        "args": {"itens": count, "bytes": size},
+    } for category, name, start, duration, count, size, thread in profile.events]
+    events.append({"name": "execução", "cat": "script", "ph": "X", "pid": 1,
+                   "tid": threading.get_ident(), "ts": base,
+                   "dur": profile.elapsed * 1e6, "args": {}})
+    return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
+
+
+# --- Funções de UI ---
+
+
+def show_profile_panel():
+    """Painel da barra lateral (exibido ao final da execução)."""
+    profile = current_profile()
+    with st.sidebar.expander("Perfil de desempenho"):
+        st.toggle("Ativar perfil", key="perfil_ativo")
+        if profile is None:
+            return
+        table = summary(profile)
+        total = profile.elapsed * 1e3
+        by_category = table.groupby("Categoria")["Total (ms)"].sum() if len(table) else {}
+        banco = by_category.get("banco", 0.0)
+        formulas = by_category.get("fórmulas", 0.0)
+        st.caption(f"Execução: {total:.1f} ms · Banco: {banco:.1f} ms · "
+                   f"Fórmulas: {formulas:.1f} ms · "
+                   f"Restante (Streamlit e app): {max(total - banco - formulas, 0):.1f} ms")
+        if len(table):
+            st.dataframe(table, hide_index=True, use_container_width=True,
+                         column_config={
+                             "Total (ms)": st.column_config.NumberColumn(format="%.2f"),
+                             "Média (ms)": st.column_config.NumberColumn(format="%.2f")})
+        st.download_button("⬇️ Exportar trace", data=trace_events(profile),
+                           file_name="perfil.json", mime="application/json",
+                           key="perfil_exportar")
@@ -1,9 +1,23 @@
 import streamlit as st
 import re
 import math
+import functools
+import threading
 from textos import TEXTOS
-from supabase_db import get_supabase_client
-from calculadora import calculate_cost
+from supabase_db import (get_supabase_client, fetch_by_ids, run_concurrently,
+                         start_rerun_scope, is_fragment_run)
+from perfil import start_profile
+from calculadora import (get_product_costs, apply_variable_change,
+                         invalidate_products_cache, get_affected_products,
+                         get_product_index, get_category_names,
+                         invalidate_categories_cache, get_variables_snapshot,
+                         prepare_formula, rewrite_formulas, discard_product_costs)
+from formulas import normalize_name, FormulaError
+from recalculo import enqueue_recompute, get_recompute_worker
+from importacao import show_import_export
+from busca import search_ids, index_name, unindex_name
+from analise import show_scenarios, show_sensitivity, formula_sensitivities
+from historico import record_changes, show_history
 
 # --- Funções de Exibição de Mensagens ---
 
@@ -21,6 +35,86 @@ def display_success(message):
 
 ITEMS_PER_PAGE = 10
 
+
+def _fetch_concurrently(calls):
+    """
+    Busca em paralelo (run_concurrently) {nome: (função, mensagem de erro,
+    valor padrão)}. Os erros são mostrados aqui, na thread do script, e
+    trocados pelo valor padrão.
+    """
+    results = run_concurrently({name: call[0] for name, call in calls.items()})
+    for name, (_, message, default) in calls.items():
+        if isinstance(results[name], Exception):
+            display_error(f"{message}: {results[name]}", results[name])
+            results[name] = default
+    return results
+
+
+def _category_options(table, message):
+    """{nome: id} das categorias (cache compartilhado), para os selectbox."""
+    try:
+        return {name: cid for cid, name in get_category_names(table).items()}
+    except Exception as e:
+        display_error(f"{message}: {e}", e)
+        return {}
+
+
+def _fetch_page(build_query, page, after_id=None, order_by=("id", False)):
+    """
+    Busca uma única página no servidor (range + contagem exata), sem baixar
+    a tabela filtrada inteira. `build_query(count)` monta o select com os
+    filtros e `order_by` é (coluna, decrescente). Com `after_id`, usa
+    paginação por cursor em `id` e não conta o total (páginas e total
+    retornam None).
+    Retorna (linhas, páginas, total).
+    """
+    if after_id is not None:
+        res = build_query(None).gt("id", after_id).order(
+            "id").limit(ITEMS_PER_PAGE).execute()
+        return res.data or [], None, None
+
+    offset = (page - 1) * ITEMS_PER_PAGE
+    column, desc = order_by
+    try:
+        q = build_query("exact")
+        if column != "id":
+            q = q.order(column, desc=desc, nullsfirst=False)
+        res = q.order("id", desc=desc and column == "id").range(
+            offset, offset + ITEMS_PER_PAGE - 1).execute()
+        rows = res.data or []
+    except Exception as e:
+        # página além do fim (ex.: após deletar o último item): só a contagem
+        if getattr(e, "code", None) != "PGRST103":
+            raise
+        res = build_query("exact").limit(1).execute()
+        rows = []
+    total = res.count or 0
+    pages = math.ceil(total / ITEMS_PER_PAGE) if total else 1
+    return rows, pages, total
+
+
+def _search_groups(category_id):
+    """Filtro de categoria das listagens para o índice de busca."""
+    if category_id == "none":
+        return {None}
+    if category_id in (None, "all"):
+        return None
+    return {category_id}
+
+
+def _ranked_page(table, columns, ids, page):
+    """
+    Página de uma busca pelo índice em memória (busca.py), na ordem de
+    relevância: só os ids da página atual vão ao banco.
+    Retorna (linhas, páginas, total), como _fetch_page.
+    """
+    total = len(ids)
+    pages = math.ceil(total / ITEMS_PER_PAGE) if total else 1
+    offset = (page - 1) * ITEMS_PER_PAGE
+    wanted = ids[offset:offset + ITEMS_PER_PAGE]
+    rows = fetch_by_ids(table, wanted, columns) if wanted else {}
+    return [rows[i] for i in wanted if i in rows], pages, total
+
 # --- Funções para Categorias de Produtos ---
 
 
@@ -31,6 +125,8 @@ def add_category_product(name):
     sb = get_supabase_client()
     try:
         res = sb.table("categorias_produtos").insert({"nome": name}).execute()
+        invalidate_categories_cache("categorias_produtos")
+        index_name("categorias_produtos", res.data[0]["id"], name)
         display_success(
             f"Categoria de produto '{name}' adicionada com sucesso.")
         return res.data[0]["id"]
@@ -39,24 +135,29 @@ def add_category_product(name):
         return None
 
 
-def get_categories_product(search_term: str = "", page: int = 1):
+def _query_categories(table, search_term="", page=1, after_id=None):
     sb = get_supabase_client()
-    offset = (page - 1) * ITEMS_PER_PAGE
-    try:
+    ids = search_ids(table, search_term) if search_term else None
+    if ids is not None and after_id is None:
+        rows, pages, total = _ranked_page(table, "id, nome", ids, page)
+        return [(item["id"], item["nome"]) for item in rows], pages, total
+
+    def build(count):
         # seleciona só os campos que precisamos
-        q = sb.table("categorias_produtos").select("id", "nome")
-        if search_term:
-            q = q.ilike("nome", f"%{search_term}%")
-        raw = q.execute().data or []
-        total = len(raw)
-        pages = math.ceil(total / ITEMS_PER_PAGE) if total else 1
-
-        # faz o slicing da página
-        page_items = raw[offset: offset + ITEMS_PER_PAGE]
-        # converte para lista de tuplas (id, nome)
-        data = [(item["id"], item["nome"]) for item in page_items]
-
-        return data, pages, total
+        q = sb.table(table).select("id", "nome", count=count)
+        if ids is not None:
+            q = q.in_("id", ids)
+        return q
+
+    rows, pages, total = _fetch_page(build, page, after_id)
+    # converte para lista de tuplas (id, nome)
+    data = [(item["id"], item["nome"]) for item in rows]
+    return data, pages, total
+
+
+def get_categories_product(search_term: str = "", page: int = 1, after_id=None):
+    try:
+        return _query_categories("categorias_produtos", search_term, page, after_id)
     except Exception as e:
         display_error(f"Erro ao buscar categorias de produto: {e}", e)
         return [], 1, 0
@@ -70,6 +171,8 @@ def update_category_product(cat_id, new_name):
     try:
         sb.table("categorias_produtos").update(
             {"nome": new_name}).eq("id", cat_id).execute()
+        invalidate_categories_cache("categorias_produtos")
+        index_name("categorias_produtos", cat_id, new_name)
         display_success("Categoria de produto atualizada com sucesso.")
         return True
     except Exception as e:
@@ -80,12 +183,15 @@ def update_category_product(cat_id, new_name):
 def delete_category_product(cat_id):
     sb = get_supabase_client()
     try:
-        in_prod = sb.table("produtos_custos").select("id").eq(
-            "categoria_id", cat_id).limit(1).execute().data
+        # só a contagem (índice em categoria_id), sem baixar linhas
+        in_prod = sb.table("produtos_custos").select("id", count="exact", head=True).eq(
+            "categoria_id", cat_id).execute().count
         if in_prod:
             display_error("Não pode deletar, categoria de produto em uso.")
             return False
         sb.table("categorias_produtos").delete().eq("id", cat_id).execute()
+        invalidate_categories_cache("categorias_produtos")
+        unindex_name("categorias_produtos", cat_id)
         display_success("Categoria de produto deletada com sucesso.")
         return True
     except Exception as e:
@@ -102,6 +208,8 @@ def add_category_variable(name):
     sb = get_supabase_client()
     try:
         res = sb.table("categorias_variaveis").insert({"nome": name}).execute()
+        invalidate_categories_cache("categorias_variaveis")
+        index_name("categorias_variaveis", res.data[0]["id"], name)
         display_success(
             f"Categoria de variável '{name}' adicionada com sucesso.")
         return res.data[0]["id"]
@@ -110,24 +218,9 @@ def add_category_variable(name):
         return None
 
 
-def get_categories_variable(search_term: str = "", page: int = 1):
-    sb = get_supabase_client()
-    offset = (page - 1) * ITEMS_PER_PAGE
+def get_categories_variable(search_term: str = "", page: int = 1, after_id=None):
     try:
-        # seleciona só os campos que precisamos
-        q = sb.table("categorias_variaveis").select("id", "nome")
-        if search_term:
-            q = q.ilike("nome", f"%{search_term}%")
-        raw = q.execute().data or []
-        total = len(raw)
-        pages = math.ceil(total / ITEMS_PER_PAGE) if total else 1
-
-        # faz o slicing da página
-        page_items = raw[offset: offset + ITEMS_PER_PAGE]
-        # converte para lista de tuplas (id, nome)
-        data = [(item["id"], item["nome"]) for item in page_items]
-
-        return data, pages, total
+        return _query_categories("categorias_variaveis", search_term, page, after_id)
     except Exception as e:
         display_error(f"Erro ao buscar categorias de variável: {e}", e)
         return [], 1, 0
@@ -141,6 +234,8 @@ def update_category_variable(cat_id, new_name):
     try:
         sb.table("categorias_variaveis").update(
             {"nome": new_name}).eq("id", cat_id).execute()
+        invalidate_categories_cache("categorias_variaveis")
+        index_name("categorias_variaveis", cat_id, new_name)
         display_success("Categoria de variável atualizada com sucesso.")
         return True
     except Exception as e:
@@ -151,12 +246,15 @@ def update_category_variable(cat_id, new_name):
 def delete_category_variable(cat_id):
     sb = get_supabase_client()
     try:
-        in_var = sb.table("variaveis_custos").select("id").eq(
-            "categoria_id", cat_id).limit(1).execute().data
+        # só a contagem (índice em categoria_id), sem baixar linhas
+        in_var = sb.table("variaveis_custos").select("id", count="exact", head=True).eq(
+            "categoria_id", cat_id).execute().count
         if in_var:
             display_error("Não pode deletar, categoria de variável em uso.")
             return False
         sb.table("categorias_variaveis").delete().eq("id", cat_id).execute()
+        invalidate_categories_cache("categorias_variaveis")
+        unindex_name("categorias_variaveis", cat_id)
         display_success("Categoria de variável deletada com sucesso.")
         return True
     except Exception as e:
@@ -166,25 +264,36 @@ def delete_category_variable(cat_id):
 # --- Funções de Variáveis de Custo ---
 
 
-def get_variables(category_id=None, search_term="", page=1):
+def _query_variables(category_id=None, search_term="", page=1, after_id=None):
     sb = get_supabase_client()
-    offset = (page-1)*ITEMS_PER_PAGE
-    try:
-        q = sb.table("variaveis_custos").select(
-            "*, categorias_variaveis(nome)")
+    columns = "id, nome, valor, categoria_id"
+    ids = None
+    if search_term:
+        ids = search_ids("variaveis_custos", search_term, _search_groups(category_id))
+
+    def build(count):
+        q = sb.table("variaveis_custos").select(columns, count=count)
         if category_id == "none":
             q = q.is_("categoria_id", None)
         elif category_id not in (None, "all"):
             q = q.eq("categoria_id", category_id)
-        if search_term:
-            q = q.ilike("nome", f"%{search_term}%")
-        data = q.execute().data or []
-        total = len(data)
-        pages = math.ceil(total/ITEMS_PER_PAGE) if total else 1
-        rows = data[offset:offset+ITEMS_PER_PAGE]
-        formatted = [(r["id"], r["nome"], r["valor"], r["categoria_id"],
-                      (r.get("categorias_variaveis") or {}).get("nome")) for r in rows]
-        return formatted, pages, total
+        if ids is not None:
+            q = q.in_("id", ids)
+        return q
+
+    if ids is not None and after_id is None:
+        rows, pages, total = _ranked_page("variaveis_custos", columns, ids, page)
+    else:
+        rows, pages, total = _fetch_page(build, page, after_id)
+    names = get_category_names("categorias_variaveis")
+    formatted = [(r["id"], r["nome"], r["valor"], r["categoria_id"],
+                  names.get(r["categoria_id"])) for r in rows]
+    return formatted, pages, total
+
+
+def get_variables(category_id=None, search_term="", page=1, after_id=None):
+    try:
+        return _query_variables(category_id, search_term, page, after_id)
     except Exception as e:
         display_error(f"Erro ao buscar variáveis: {e}", e)
         return [], 1, 0
@@ -199,8 +308,11 @@ def add_variable(name, value, category_id):
         return False
     sb = get_supabase_client()
     try:
-        sb.table("variaveis_custos").insert(
+        res = sb.table("variaveis_custos").insert(
             {"nome": name, "valor": value, "categoria_id": category_id}).execute()
+        index_name("variaveis_custos", res.data[0]["id"], name, category_id)
+        enqueue_recompute(apply_variable_change(res.data[0]["id"], name, value))
+        record_changes([(res.data[0]["id"], value)])
         display_success(f"Variável '{name}' adicionada com sucesso.")
         return True
     except Exception as e:
@@ -217,8 +329,19 @@ def update_variable(var_id, name, value, category_id):
         return False
     sb = get_supabase_client()
     try:
+        old = get_variables_snapshot().rows.get(var_id)
         sb.table("variaveis_custos").update(
             {"nome": name, "valor": value, "categoria_id": category_id}).eq("id", var_id).execute()
+        index_name("variaveis_custos", var_id, name, category_id)
+        affected = apply_variable_change(var_id, name, value)
+        if old and normalize_name(old[0]) != normalize_name(name):
+            # as fórmulas citam a variável pelo id: só o texto muda, e só o
+            # dos produtos que a citam (não o dos compostos que os usam)
+            rewrite_formulas(get_product_index().by_variable.get(var_id, ()))
+        # só os produtos que usam a variável terão o custo recalculado
+        enqueue_recompute(affected)
+        if old is None or float(old[1]) != float(value):
+            record_changes([(var_id, value)])
         display_success("Variável atualizada com sucesso.")
         return True
     except Exception as e:
@@ -230,6 +353,9 @@ def delete_variable(var_id):
     sb = get_supabase_client()
     try:
         sb.table("variaveis_custos").delete().eq("id", var_id).execute()
+        unindex_name("variaveis_custos", var_id)
+        enqueue_recompute(apply_variable_change(var_id))
+        record_changes([(var_id, None)])
         display_success("Variável deletada com sucesso.")
         return True
     except Exception as e:
@@ -239,29 +365,56 @@ def delete_variable(var_id):
 # --- Funções de Produtos de Custo ---
 
 
-def get_products(category_id=None, search_term="", page=1):
+def _query_products(category_id=None, search_term="", page=1, after_id=None,
+                    order_by=("id", False)):
     sb = get_supabase_client()
-    offset = (page-1)*ITEMS_PER_PAGE
-    try:
-        q = sb.table("produtos_custos").select("*, categorias_produtos(nome)")
+    columns = "id, nome, formula, formula_compilada, categoria_id, custo_calculado"
+    ids = None
+    if search_term:
+        ids = search_ids("produtos_custos", search_term, _search_groups(category_id))
+
+    def build(count):
+        q = sb.table("produtos_custos").select(columns, count=count)
         if category_id == "none":
             q = q.is_("categoria_id", None)
         elif category_id not in (None, "all"):
             q = q.eq("categoria_id", category_id)
-        if search_term:
-            q = q.ilike("nome", f"%{search_term}%")
-        data = q.execute().data or []
-        total = len(data)
-        pages = math.ceil(total/ITEMS_PER_PAGE) if total else 1
-        rows = data[offset:offset+ITEMS_PER_PAGE]
-        formatted = [(r["id"], r["nome"], r.get("formula"), r["categoria_id"], (r.get(
-            "categorias_produtos") or {}).get("nome")) for r in rows]
-        return formatted, pages, total
+        if ids is not None:
+            q = q.in_("id", ids)
+        return q
+
+    if ids is not None and after_id is None and order_by == ("id", False):
+        # com busca, a ordem de cadastro dá lugar à de relevância
+        rows, pages, total = _ranked_page("produtos_custos", columns, ids, page)
+    else:
+        rows, pages, total = _fetch_page(build, page, after_id, order_by)
+    names = get_category_names("categorias_produtos")
+    formatted = [(r["id"], r["nome"], r.get("formula"), r["categoria_id"],
+                  names.get(r["categoria_id"]), r.get("custo_calculado"),
+                  r.get("formula_compilada")) for r in rows]
+    return formatted, pages, total
+
+
+def get_products(category_id=None, search_term="", page=1, after_id=None,
+                 order_by=("id", False)):
+    try:
+        return _query_products(category_id, search_term, page, after_id, order_by)
     except Exception as e:
         display_error(f"Erro ao buscar produtos: {e}", e)
         return [], 1, 0
 
 
+def _prepare_formula(formula, prod_id=None):
+    """Fórmula pré-processada, ou None (com a mensagem de erro) se inválida."""
+    try:
+        return prepare_formula(formula, prod_id)
+    except FormulaError as e:
+        display_error(f"Fórmula inválida: {e}")
+    except Exception as e:
+        display_error(f"Erro ao validar a fórmula: {e}", e)
+    return None
+
+
 def add_product(name, formula, category_id):
     if not name:
         display_error("O nome do produto não pode ser vazio.")
@@ -269,10 +422,17 @@ def add_product(name, formula, category_id):
     if not formula:
         display_error("A fórmula do produto não pode ser vazia.")
         return False
+    tokens = _prepare_formula(formula)
+    if tokens is None:
+        return False
     sb = get_supabase_client()
     try:
-        sb.table("produtos_custos").insert(
-            {"nome": name, "formula": formula, "categoria_id": category_id}).execute()
+        res = sb.table("produtos_custos").insert(
+            {"nome": name, "formula": formula, "formula_compilada": tokens,
+             "categoria_id": category_id}).execute()
+        invalidate_products_cache()
+        index_name("produtos_custos", res.data[0]["id"], name, category_id)
+        enqueue_recompute([res.data[0]["id"]])
         display_success(f"Produto '{name}' adicionado com sucesso.")
         return True
     except Exception as e:
@@ -281,18 +441,36 @@ def add_product(name, formula, category_id):
 
 
 def update_product(prod_id, name, formula, category_id):
+    """Retorna a fórmula pré-processada gravada, ou False em caso de erro."""
     if not name:
         display_error("O nome do produto não pode ser vazio.")
         return False
     if not formula:
         display_error("A fórmula do produto não pode ser vazia.")
         return False
+    tokens = _prepare_formula(formula, prod_id)
+    if tokens is None:
+        return False
     sb = get_supabase_client()
     try:
+        index = get_product_index()
+        # o produto e os compostos que o usam, direta ou indiretamente
+        affected = index.dependents([prod_id])
+        old_name = index.products.get(prod_id, name)
+        # o custo gravado deixa de valer até o recálculo em segundo plano
         sb.table("produtos_custos").update(
-            {"nome": name, "formula": formula, "categoria_id": category_id}).eq("id", prod_id).execute()
+            {"nome": name, "formula": formula, "formula_compilada": tokens,
+             "categoria_id": category_id, "custo_calculado": None,
+             "calculado_em": None}).eq("id", prod_id).execute()
+        invalidate_products_cache()
+        discard_product_costs(affected)
+        if normalize_name(old_name) != normalize_name(name):
+            # os compostos citam o produto pelo id: só o texto muda
+            rewrite_formulas(index.parents.get(prod_id, ()))
+        index_name("produtos_custos", prod_id, name, category_id)
+        enqueue_recompute(affected)
         display_success("Produto atualizado com sucesso.")
-        return True
+        return tokens
     except Exception as e:
         display_error(f"Erro ao atualizar produto: {e}", e)
         return False
@@ -301,7 +479,15 @@ def update_product(prod_id, name, formula, category_id):
 def delete_product(prod_id):
     sb = get_supabase_client()
     try:
+        index = get_product_index()
+        used_by = sorted(index.products[p] for p in index.parents.get(prod_id, ()))
+        if used_by:
+            display_error(
+                f"O produto não pode ser deletado: é componente de {', '.join(used_by)}.")
+            return False
         sb.table("produtos_custos").delete().eq("id", prod_id).execute()
+        invalidate_products_cache()
+        unindex_name("produtos_custos", prod_id)
         display_success("Produto deletado com sucesso.")
         return True
     except Exception as e:
@@ -311,6 +497,187 @@ def delete_product(prod_id):
 # --- Funções de UI ---
 
 
+_fragments = threading.local()
+
+
+def _fragment(func):
+    """
+    st.fragment: ações dentro da função executam de novo só ela, e não a
+    página inteira. Como main.py não roda nesses casos, o cache de consultas
+    e o perfil da execução recomeçam no fragmento mais externo.
+    """
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        depth = getattr(_fragments, "depth", 0)
+        if depth == 0 and is_fragment_run():
+            start_rerun_scope()
+            start_profile(st.session_state.get("perfil_ativo", False))
+        _fragments.depth = depth + 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _fragments.depth = depth
+    return st.fragment(run)
+
+
+def _rerun_fragment():
+    """Refaz só o fragmento atual (ou a página, se ela toda está rodando)."""
+    st.rerun(scope="fragment" if is_fragment_run() else "app")
+
+
+def _set_state(key, value):
+    st.session_state[key] = value
+
+
+def _toggle_state(key):
+    st.session_state[key] = not st.session_state.get(key)
+
+
+def _category_index(opts, cat_sel):
+    return list(opts.values()).index(cat_sel) + 1 if cat_sel in opts.values() else 0
+
+
+def _product_form(key, opts, name="", formula="", cat_sel=None):
+    """Campos do formulário de produto. Retorna (enviado, nome, fórmula, categoria)."""
+    form = st.form(key=key)
+    new_name = form.text_input("Nome do Produto", value=name)
+    new_formula = form.text_area(
+        "Fórmula", value=formula,
+        help="Use [Nome do Produto] para somar o custo de outro produto.")
+    new_cat = form.selectbox("Categoria", ["(Nenhuma)"] + list(opts.keys()),
+                             index=_category_index(opts, cat_sel))
+    submitted = form.form_submit_button("Salvar")
+    cid = None if new_cat == "(Nenhuma)" else opts[new_cat]
+    return submitted, new_name, new_formula, cid
+
+
+@_fragment
+def _new_product_form(opts):
+    submitted, name, formula, cid = _product_form("prod_form", opts)
+    if submitted and add_product(name, formula, cid):
+        st.session_state.show_prod_form = False
+        st.session_state.editing_prod_id = None
+        # o novo produto entra na listagem: a página toda é refeita
+        st.rerun()
+
+
+@_fragment
+def _product_card(row, opts):
+    """
+    Card de um produto. Editar, salvar e deletar refazem só o card: a linha
+    alterada fica em _prod_editados até a listagem ser lida de novo.
+    """
+    edited = st.session_state.setdefault("_prod_editados", {})
+    pid = row[0]
+    row = edited.get(pid, row)
+    if row is None:
+        st.caption("Produto deletado.")
+        return
+    pid, name, formula, cid, cname, stored, tokens = row
+    editing = f"prod_editando_{pid}"
+    with st.container():
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            if st.session_state.get(editing):
+                submitted, new_name, new_formula, new_cid = _product_form(
+                    f"prod_form_{pid}", opts, name, formula, cid)
+                new_tokens = submitted and update_product(
+                    pid, new_name, new_formula, new_cid)
+                if new_tokens:
+                    names = {v: k for k, v in opts.items()}
+                    edited[pid] = (pid, new_name, new_formula, new_cid,
+                                   names.get(new_cid), None, new_tokens)
+                    st.session_state[editing] = False
+                    _rerun_fragment()
+            else:
+                st.markdown(f"<h3>{name}</h3>", unsafe_allow_html=True)
+                if cname:
+                    st.caption(f"Categoria: {cname}")
+                # usa o custo gravado; só calcula na hora (e só para os cards
+                # exibidos) se ainda não foi (re)calculado em segundo plano
+                if stored is None or get_recompute_worker().is_pending(pid):
+                    cost = get_product_costs([(pid, formula, tokens)])[0]
+                else:
+                    cost = float(stored)
+                st.metric("Custo Calculado",
+                          f"R$ {cost:.2f}" if cost is not None else "Erro")
+                with st.expander("Ver Fórmula"):
+                    st.code(formula or "(vazio)")
+                try:
+                    sens = formula_sensitivities([(formula, tokens)])[0]
+                except Exception:
+                    sens = None
+                if sens:
+                    with st.expander("Sensibilidade"):
+                        for var, (delta, relative) in sorted(
+                                sens.items(), key=lambda item: -abs(item[1][0])):
+                            st.write(f"- {var}: R$ {delta:+.4f} ({relative:+.3f}%)")
+        with col2:
+            st.button("✏️", key=f"edit_{pid}", on_click=_toggle_state, args=(editing,))
+            if st.button("🗑️", key=f"del_{pid}", type="primary"):
+                if delete_product(pid):
+                    edited[pid] = None
+                    _rerun_fragment()
+
+
+def _go_to_page(state_key, input_key, page):
+    st.session_state[state_key] = page
+    st.session_state[input_key] = page
+
+
+def _page_typed(state_key, input_key):
+    st.session_state[state_key] = st.session_state[input_key]
+
+
+def _paginator(pages, state_key, key_prefix):
+    """
+    Primeira, anterior, número da página, próxima e última; a troca de página
+    refaz só o fragmento da listagem.
+    """
+    if pages <= 1:
+        return
+    page = min(max(st.session_state.get(state_key, 1), 1), pages)
+    input_key = f"{key_prefix}_numero"
+    # o campo segue a página atual, mesmo quando ela muda por outro caminho
+    st.session_state[input_key] = page
+    st.markdown("<div class='pagination-container'>",
+                unsafe_allow_html=True)
+    cols = st.columns([1, 1, 2, 1, 1, 1])
+    buttons = ((0, "⏮", "primeira", 1), (1, "◀", "anterior", page - 1),
+               (4, "▶", "proxima", page + 1), (5, "⏭", "ultima", pages))
+    for col, label, name, target in buttons:
+        with cols[col]:
+            st.button(label, key=f"{key_prefix}_{name}",
+                      disabled=target == page or not 1 <= target <= pages,
+                      on_click=_go_to_page, args=(state_key, input_key, target))
+    with cols[2]:
+        st.number_input("Página", min_value=1, max_value=pages, step=1,
+                        key=input_key, label_visibility="collapsed",
+                        on_change=_page_typed, args=(state_key, input_key))
+    with cols[3]:
+        st.caption(f"de {pages}")
+    st.markdown("</div>", unsafe_allow_html=True)
+
+
+@_fragment
+def _product_list(cat_id, search, order_by, opts):
+    # listagem lida de novo: descarta as linhas alteradas pelos cards
+    st.session_state["_prod_editados"] = {}
+    # página de produtos e índice dos compostos (usado pelos cards ainda sem
+    # custo gravado), ao mesmo tempo
+    page = st.session_state.prod_page
+    fetched = _fetch_concurrently({
+        "index": (get_product_index, "Erro ao buscar o índice de produtos", None),
+        "page": (lambda: _query_products(cat_id, search, page, order_by=order_by),
+                 "Erro ao buscar produtos", ([], 1, 0)),
+    })
+    data, pages, total = fetched["page"]
+    st.write(f"Total de Produtos: {total}")
+    for row in data:
+        _product_card(row, opts)
+    _paginator(pages, "prod_page", "prod_page")
+
+
 def show_products():
     st.subheader(TEXTOS["prod_produtos"])
     if 'prod_page' not in st.session_state:
@@ -319,88 +686,31 @@ def show_products():
         st.session_state.editing_prod_id = None
     if 'show_prod_form' not in st.session_state:
         st.session_state.show_prod_form = False
-    col1, col2, col3 = st.columns([3, 2, 1])
+    sort_opts = {"Cadastro": ("id", False),
+                 "Menor custo": ("custo_calculado", False),
+                 "Maior custo": ("custo_calculado", True)}
+    opts = _category_options("categorias_produtos", "Erro ao buscar categorias de produto")
+    disp = {"Todos": "all", "Sem Categoria": "none", **opts}
+
+    col1, col2, col3, col4 = st.columns([3, 2, 2, 1])
     with col1:
         search = st.text_input("Buscar Produto", key="prod_search")
     with col2:
-        cats, _, _ = get_categories_product()
-        opts = {c[1]: c[0] for c in cats}
-        disp = {"Todos": "all", "Sem Categoria": "none", **opts}
         selected = st.selectbox("Filtrar por Categoria", list(
             disp.keys()), key="prod_cat_filter")
         cat_id = disp[selected]
     with col3:
+        sort = st.selectbox("Ordenar por", list(
+            sort_opts.keys()), key="prod_sort")
+    with col4:
         label = "➕ Adicionar Produto" if not st.session_state.show_prod_form else "❌ Fechar Formulário"
         if st.button(label, key="add_prod_btn"):
             st.session_state.show_prod_form = not st.session_state.show_prod_form
             st.session_state.editing_prod_id = 'new' if st.session_state.show_prod_form else None
             st.rerun()
-    if st.session_state.editing_prod_id:
-        with st.container():
-            is_new = st.session_state.editing_prod_id == 'new'
-            data = {}
-            sb = get_supabase_client()
-            if not is_new:
-                prod_result = sb.table("produtos_custos").select(
-                    "*").eq("id", st.session_state.editing_prod_id).single().execute()
-                if prod_result and prod_result.data:
-                    data = prod_result.data
-                else:
-                    data = {}
-            name = data.get("nome", "")
-            formula = data.get("formula", "")
-            cat_sel = data.get("categoria_id", None)
-            form = st.form(key="prod_form")
-            new_name = form.text_input("Nome do Produto", value=name)
-            new_formula = form.text_area("Fórmula", value=formula)
-            product_categories, _, _ = get_categories_product()
-            product_opts = {c[1]: c[0] for c in product_categories}
-            new_cat = form.selectbox("Categoria", ["(Nenhuma)"] + list(
-                product_opts.keys()), index=0 if not cat_sel else (list(product_opts.values()).index(cat_sel) + 1 if cat_sel in product_opts.values() else 0))
-            if form.form_submit_button("Salvar"):
-                cid = None if new_cat == "(Nenhuma)" else product_opts[new_cat]
-                if is_new:
-                    add_product(new_name, new_formula, cid)
-                else:
-                    update_product(st.session_state.editing_prod_id,
-                                   new_name, new_formula, cid)
-                st.session_state.show_prod_form = False
-                st.session_state.editing_prod_id = None
-                st.rerun()
-    data, pages, total = get_products(
-        category_id=cat_id, search_term=search, page=st.session_state.prod_page)
-    st.write(f"Total de Produtos: {total}")
-    for pid, name, formula, cid, cname in data:
-        with st.container():
-            col1, col2 = st.columns([3, 1])
-            with col1:
-                st.markdown(f"<h3>{name}</h3>", unsafe_allow_html=True)
-                if cname:
-                    st.caption(f"Categoria: {cname}")
-                cost = calculate_cost(formula)
-                st.metric("Custo Calculado",
-                          f"R$ {cost:.2f}" if cost is not None else "Erro")
-                with st.expander("Ver Fórmula"):
-                    st.code(formula or "(vazio)")
-            with col2:
-                if st.button("✏️", key=f"edit_{pid}"):
-                    st.session_state.editing_prod_id = pid
-                    st.session_state.show_prod_form = True
-                    st.rerun()
-                if st.button("🗑️", key=f"del_{pid}", type="primary"):
-                    delete_product(pid)
-                    st.rerun()
-
-    if pages > 1:
-        st.markdown("<div class='pagination-container'>",
-                    unsafe_allow_html=True)
-        cols = st.columns(pages)
-        for i in range(pages):
-            with cols[i]:
-                if st.button(str(i+1), key=f"prod_page_{i+1}"):
-                    st.session_state.prod_page = i+1
-                    st.rerun()
-        st.markdown("</div>", unsafe_allow_html=True)
+    if st.session_state.editing_prod_id == 'new':
+        _new_product_form(opts)
+    _product_list(cat_id, search, sort_opts[sort], opts)
 
 
 def show_production_costs():
@@ -413,6 +723,93 @@ def show_production_costs():
         show_variables()
     elif choice == "Gerenciar Categorias":
         show_categories()
+    elif choice == "Cenários":
+        show_scenarios()
+    elif choice == "Sensibilidade":
+        show_sensitivity()
+    elif choice == "Histórico":
+        show_history()
+    elif choice == "Importar/Exportar":
+        show_import_export()
+
+
+def _variable_form(key, opts, name="", value=0.0, cat_sel=None):
+    """Campos do formulário de variável. Retorna (enviado, nome, valor, categoria)."""
+    form = st.form(key=key)
+    new_name = form.text_input("Nome da Variável", value=name)
+    new_value = form.number_input("Valor", value=value, format="%.2f")
+    new_cat = form.selectbox("Categoria", ["(Nenhuma)"] + list(opts.keys()),
+                             index=_category_index(opts, cat_sel))
+    submitted = form.form_submit_button("Salvar")
+    cid = None if new_cat == "(Nenhuma)" else opts[new_cat]
+    return submitted, new_name, new_value, cid
+
+
+@_fragment
+def _new_variable_form(opts):
+    submitted, name, value, cid = _variable_form("var_form", opts)
+    if submitted and add_variable(name, value, cid):
+        st.session_state.show_var_form = False
+        st.session_state.editing_var_id = None
+        st.rerun()
+
+
+@_fragment
+def _variable_card(row, opts, with_index):
+    """Card de uma variável; como em _product_card, as ações refazem só o card."""
+    edited = st.session_state.setdefault("_var_editadas", {})
+    vid = row[0]
+    row = edited.get(vid, row)
+    if row is None:
+        st.caption("Variável deletada.")
+        return
+    vid, name, value, cid, cname = row
+    editing = f"var_editando_{vid}"
+    with st.container():
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            if st.session_state.get(editing):
+                submitted, new_name, new_value, new_cid = _variable_form(
+                    f"var_form_{vid}", opts, name, float(value), cid)
+                if submitted and update_variable(vid, new_name, new_value, new_cid):
+                    names = {v: k for k, v in opts.items()}
+                    edited[vid] = (vid, new_name, new_value, new_cid, names.get(new_cid))
+                    st.session_state[editing] = False
+                    _rerun_fragment()
+            else:
+                st.markdown(f"<h3>{name}</h3>", unsafe_allow_html=True)
+                if cname:
+                    st.caption(f"Categoria: {cname}")
+                st.metric("Valor", f"R$ {value:.2f}")
+                used_by = get_affected_products(vid, name) if with_index else []
+                if used_by:
+                    with st.expander(f"Usada em {len(used_by)} produto(s)"):
+                        st.write(", ".join(used_by))
+                else:
+                    st.caption("Não usada em nenhum produto")
+        with col2:
+            st.button("✏️", key=f"edit_var_{vid}", on_click=_toggle_state, args=(editing,))
+            if st.button("🗑️", key=f"del_var_{vid}", type="primary"):
+                if delete_variable(vid):
+                    edited[vid] = None
+                    _rerun_fragment()
+
+
+@_fragment
+def _variable_list(cat_id, search, opts):
+    st.session_state["_var_editadas"] = {}
+    # página de variáveis e índice de uso pelos produtos, ao mesmo tempo
+    page = st.session_state.var_page
+    fetched = _fetch_concurrently({
+        "index": (get_product_index, "Erro ao buscar produtos da variável", None),
+        "page": (lambda: _query_variables(cat_id, search, page),
+                 "Erro ao buscar variáveis", ([], 1, 0)),
+    })
+    data, pages, total = fetched["page"]
+    st.write(f"Total de Variáveis: {total}")
+    for row in data:
+        _variable_card(row, opts, fetched["index"] is not None)
+    _paginator(pages, "var_page", "var_page")
 
 
 def show_variables():
@@ -423,14 +820,13 @@ def show_variables():
         st.session_state.editing_var_id = None
     if 'show_var_form' not in st.session_state:
         st.session_state.show_var_form = False
+    opts = _category_options("categorias_variaveis", "Erro ao buscar categorias de variável")
+    disp = {"Todos": "all", "Sem Categoria": "none", **opts}
 
     col1, col2, col3 = st.columns([3, 2, 1])
     with col1:
         search = st.text_input("Buscar Variável", key="var_search")
     with col2:
-        cats, _, _ = get_categories_variable()
-        opts = {c[1]: c[0] for c in cats}
-        disp = {"Todos": "all", "Sem Categoria": "none", **opts}
         selected = st.selectbox("Filtrar por Categoria", list(
             disp.keys()), key="var_cat_filter")
         cat_id = disp[selected]
@@ -440,73 +836,9 @@ def show_variables():
             st.session_state.show_var_form = not st.session_state.show_var_form
             st.session_state.editing_var_id = 'new' if st.session_state.show_var_form else None
             st.rerun()
-
-    if st.session_state.editing_var_id:
-        with st.container():
-            is_new = st.session_state.editing_var_id == 'new'
-            data = {}
-            sb = get_supabase_client()
-            if not is_new:
-                var_result = sb.table("variaveis_custos").select(
-                    "*").eq("id", st.session_state.editing_var_id).single().execute()
-                if var_result and var_result.data:
-                    data = var_result.data
-                else:
-                    data = {}
-            name = data.get("nome", "")
-            value = data.get("valor", 0.0)
-            cat_sel = data.get("categoria_id", None)
-
-            form = st.form(key="var_form")
-            new_name = form.text_input("Nome da Variável", value=name)
-            new_value = form.number_input("Valor", value=value, format="%.2f")
-            variable_categories, _, _ = get_categories_variable()
-            variable_opts = {c[1]: c[0] for c in variable_categories}
-            new_cat = form.selectbox("Categoria", ["(Nenhuma)"] + list(
-                variable_opts.keys()), index=0 if not cat_sel else (list(variable_opts.values()).index(cat_sel) + 1 if cat_sel in variable_opts.values() else 0))
-
-            if form.form_submit_button("Salvar"):
-                cid = None if new_cat == "(Nenhuma)" else variable_opts[new_cat]
-                if is_new:
-                    add_variable(new_name, new_value, cid)
-                else:
-                    update_variable(
-                        st.session_state.editing_var_id, new_name, new_value, cid)
-                st.session_state.show_var_form = False
-                st.session_state.editing_var_id = None
-                st.rerun()
-
-    data, pages, total = get_variables(
-        category_id=cat_id, search_term=search, page=st.session_state.var_page)
-    st.write(f"Total de Variáveis: {total}")
-
-    for vid, name, value, cid, cname in data:
-        with st.container():
-            col1, col2 = st.columns([3, 1])
-            with col1:
-                st.markdown(f"<h3>{name}</h3>", unsafe_allow_html=True)
-                if cname:
-                    st.caption(f"Categoria: {cname}")
-                st.metric("Valor", f"R$ {value:.2f}")
-            with col2:
-                if st.button("✏️", key=f"edit_var_{vid}"):
-                    st.session_state.editing_var_id = vid
-                    st.session_state.show_var_form = True
-                    st.rerun()
-                if st.button("🗑️", key=f"del_var_{vid}", type="primary"):
-                    delete_variable(vid)
-                    st.rerun()
-
-    if pages > 1:
-        st.markdown("<div class='pagination-container'>",
-                    unsafe_allow_html=True)
-        cols = st.columns(pages)
-        for i in range(pages):
-            with cols[i]:
-                if st.button(str(i+1), key=f"var_page_{i+1}"):
-                    st.session_state.var_page = i+1
-                    st.rerun()
-        st.markdown("</div>", unsafe_allow_html=True)
+    if st.session_state.editing_var_id == 'new':
+        _new_variable_form(opts)
+    _variable_list(cat_id, search, opts)
 
 
 def show_categories():
@@ -553,13 +885,8 @@ def show_categories():
             is_new = st.session_state.editing_cat_id == 'new'
             data = {}
             if not is_new:
-                sb = get_supabase_client()
-                cat_result = sb.table(table_name).select(
-                    "*").eq("id", st.session_state.editing_cat_id).single().execute()
-                if cat_result and cat_result.data:
-                    data = cat_result.data
-                else:
-                    data = {}
+                cat_id = st.session_state.editing_cat_id
+                data = fetch_by_ids(table_name, [cat_id]).get(cat_id, {})
             name = data.get("nome", "")
             form = st.form(key=f"cat_form_{st.session_state.category_type}")
             new_name = form.text_input("Nome da Categoria", value=name)
@@ -572,10 +899,14 @@ def show_categories():
                 st.session_state.editing_cat_id = None
                 st.rerun()
 
+    _category_list(get_func, delete_func, search, st.session_state.category_type)
+
+
+@_fragment
+def _category_list(get_func, delete_func, search, kind):
     data, pages, total = get_func(
         search_term=search, page=st.session_state.cat_page)
-    st.write(
-        f"Total de Categorias de {st.session_state.category_type}: {total}")
+    st.write(f"Total de Categorias de {kind}: {total}")
 
     for cid, name in data:
         with st.container():
@@ -583,21 +914,14 @@ def show_categories():
             with col1:
                 st.markdown(f"<h3>{name}</h3>", unsafe_allow_html=True)
             with col2:
-                if st.button("✏️", key=f"edit_cat_{cid}_{st.session_state.category_type}"):
+                # editar abre o formulário no topo e deletar muda os filtros
+                # das outras telas: a página toda é refeita
+                if st.button("✏️", key=f"edit_cat_{cid}_{kind}"):
                     st.session_state.editing_cat_id = cid
                     st.session_state.show_cat_form = True
                     st.rerun()
-                if st.button("🗑️", key=f"del_cat_{cid}_{st.session_state.category_type}", type="primary"):
+                if st.button("🗑️", key=f"del_cat_{cid}_{kind}", type="primary"):
                     delete_func(cid)
                     st.rerun()
 
-    if pages > 1:
-        st.markdown("<div class='pagination-container'>",
-                    unsafe_allow_html=True)
-        cols = st.columns(pages)
-        for i in range(pages):
-            with cols[i]:
-                if st.button(str(i+1), key=f"cat_page_{i+1}_{st.session_state.category_type}"):
-                    st.session_state.cat_page = i+1
-                    st.rerun()
-        st.markdown("</div>", unsafe_allow_html=True)
+    _paginator(pages, "cat_page", f"cat_page_{kind}")
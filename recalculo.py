@@ -0,0 +1,135 @@
+import logging
+import threading
+import streamlit as st
+from supabase_db import get_supabase_client, get_setting, fetch_all_rows
+from calculadora import get_variables_snapshot, index_catalog, CostEvaluator
+from formulas import FormulaError
+
+# --- Recálculo em Segundo Plano dos Custos Materializados ---
+#
+# Cada produto guarda o custo calculado em produtos_custos.custo_calculado
+# (com calculado_em). Alterações em variáveis ou fórmulas marcam os produtos
+# afetados como pendentes; uma thread por processo espera as alterações
+# pararem de chegar (debounce) e grava os novos custos em lotes, via a função
+# SQL atualizar_custos_produtos. Produtos gravados antes da fórmula
+# pré-processada (formula_compilada) ganham essa versão no primeiro recálculo.
+
+RECALCULO_DEBOUNCE = float(get_setting("RECALCULO_DEBOUNCE", 2))
+RECALCULO_LOTE = int(get_setting("RECALCULO_LOTE", 500))
+
+_COLUNAS = "id, formula, formula_compilada"
+
+_logger = logging.getLogger(__name__)
+
+
+class RecomputeWorker:
+
+    def __init__(self, sb, start=True):
+        self._sb = sb
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._everything = False
+        # lote em recálculo: continua "pendente" para a leitura até ser gravado
+        self._running = set()
+        self._running_everything = False
+        self._wake = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="recalculo-custos", daemon=True)
+        if start:
+            self._thread.start()
+
+    def enqueue(self, product_ids=None):
+        """Marca produtos para recálculo (None = todos)."""
+        with self._lock:
+            if product_ids is None:
+                self._everything = True
+            else:
+                self._pending.update(product_ids)
+        self._wake.set()
+
+    def recompute_now(self, product_ids=None):
+        """Recalcula e grava na thread atual, sem fila (None = todos)."""
+        self._recompute(set(product_ids or ()), product_ids is None)
+
+    def is_pending(self, product_id):
+        with self._lock:
+            return (self._everything or self._running_everything
+                    or product_id in self._pending or product_id in self._running)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            # debounce: só começa quando nada novo chegar por RECALCULO_DEBOUNCE s
+            while True:
+                self._wake.clear()
+                if not self._wake.wait(RECALCULO_DEBOUNCE):
+                    break
+            with self._lock:
+                ids, everything = self._pending, self._everything
+                self._pending, self._everything = set(), False
+                self._running, self._running_everything = ids, everything
+            try:
+                self._recompute(ids, everything)
+            except Exception:
+                _logger.exception("Erro no recálculo dos custos dos produtos")
+                # volta para a fila; a leitura segue calculando esses na hora
+                with self._lock:
+                    self._pending |= ids
+                    self._everything |= everything
+            finally:
+                with self._lock:
+                    self._running, self._running_everything = set(), False
+
+    def _rows(self, ids, everything):
+        if everything:
+            yield from fetch_all_rows(self._sb, "produtos_custos", _COLUNAS)
+            return
+        ids = sorted(ids)
+        for i in range(0, len(ids), RECALCULO_LOTE):
+            yield from self._sb.table("produtos_custos").select(_COLUNAS).in_(
+                "id", ids[i:i + RECALCULO_LOTE]).execute().data or []
+
+    def _recompute(self, ids, everything):
+        snapshot = get_variables_snapshot()
+        # um único avaliador no lote todo: componentes comuns a vários
+        # produtos compostos são calculados uma vez só
+        evaluator = CostEvaluator(snapshot, index_catalog, cache=snapshot.costs)
+        batch = []
+        for row in self._rows(ids, everything):
+            tokens = row.get("formula_compilada") or self._convert(row, snapshot)
+            evaluator.formulas[row["id"]] = (row["formula"], tokens)
+            cost = evaluator.cost(row["id"])
+            batch.append(
+                {"id": row["id"], "formula": row["formula"], "custo": cost})
+            if len(batch) >= RECALCULO_LOTE:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def _convert(self, row, snapshot):
+        """Grava a fórmula pré-processada de um produto que ainda não a tem;
+        None se a fórmula é inválida."""
+        try:
+            tokens = snapshot.tokenize(row["formula"])
+        except FormulaError:
+            return None
+        self._sb.table("produtos_custos").update({"formula_compilada": tokens}).eq(
+            "id", row["id"]).eq("formula", row["formula"]).execute()
+        return tokens
+
+    def _write(self, batch):
+        # a função só grava se a fórmula ainda for a mesma que foi avaliada
+        self._sb.rpc("atualizar_custos_produtos", {"custos": batch}).execute()
+
+
+@st.cache_resource(show_spinner=False)
+def get_recompute_worker():
+    worker = RecomputeWorker(get_supabase_client())
+    # ao iniciar o processo, garante que todos os custos estão em dia
+    worker.enqueue()
+    return worker
+
+
+def enqueue_recompute(product_ids=None):
+    get_recompute_worker().enqueue(product_ids)
@@ -0,0 +1,429 @@
+import re
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+# --- Banco Local (SQLite) ---
+#
+# Implementa o subconjunto da API do cliente Supabase/PostgREST usado pelo
+# app (table().select().eq()...execute(), rpc()), sobre um arquivo SQLite.
+# Serve para instalações de um único ponto, sem latência de rede, e como
+# base para benchmarks. Escolhido com BACKEND = "sqlite" (ver supabase_db).
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS categorias_produtos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    nome TEXT NOT NULL UNIQUE,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS categorias_variaveis (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    nome TEXT NOT NULL UNIQUE,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS variaveis_custos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    nome TEXT NOT NULL,
+    valor REAL NOT NULL,
+    categoria_id INTEGER REFERENCES categorias_variaveis(id),
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS produtos_custos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    nome TEXT NOT NULL,
+    formula TEXT,
+    formula_compilada TEXT,
+    categoria_id INTEGER REFERENCES categorias_produtos(id),
+    custo_calculado REAL,
+    calculado_em TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS variaveis_calc (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    nome TEXT NOT NULL UNIQUE,
+    valor REAL NOT NULL,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS variaveis_historico (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    variavel_id INTEGER NOT NULL,
+    valor REAL,
+    vigente_desde TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS variaveis_custos_nome_idx ON variaveis_custos (nome);
+CREATE INDEX IF NOT EXISTS variaveis_custos_categoria_idx ON variaveis_custos (categoria_id);
+CREATE INDEX IF NOT EXISTS produtos_custos_nome_idx ON produtos_custos (nome);
+CREATE INDEX IF NOT EXISTS produtos_custos_categoria_idx ON produtos_custos (categoria_id);
+CREATE INDEX IF NOT EXISTS produtos_custos_custo_idx ON produtos_custos (custo_calculado);
+CREATE INDEX IF NOT EXISTS variaveis_historico_variavel_idx
+    ON variaveis_historico (variavel_id, vigente_desde);
+-- variáveis sem histórico (bancos anteriores à tabela): valor atual desde o cadastro
+INSERT INTO variaveis_historico (variavel_id, valor, vigente_desde)
+    SELECT v.id, v.valor, v.created_at FROM variaveis_custos v
+    WHERE NOT EXISTS (SELECT 1 FROM variaveis_historico h WHERE h.variavel_id = v.id);
+"""
+
+# colunas incluídas depois da criação do esquema: (tabela, coluna, tipo),
+# adicionadas a bancos já existentes ao abrir
+COLUNAS_NOVAS = [
+    ("produtos_custos", "formula_compilada", "TEXT"),
+]
+
+# recursos embutidos no select (ex.: "categorias_produtos(nome)") e a coluna
+# de ligação, como as chaves estrangeiras que o PostgREST usa
+FOREIGN_KEYS = {
+    ("produtos_custos", "categorias_produtos"): "categoria_id",
+    ("variaveis_custos", "categorias_variaveis"): "categoria_id",
+}
+
+_IDENTIFICADOR = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_EMBUTIDO = re.compile(r"^(\w+)\((.*)\)$")
+
+
+class APIError(Exception):
+    """Erro no formato do postgrest (com `code`), para o app tratar os dois
+    bancos da mesma forma."""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+
+class APIResponse:
+    __slots__ = ("data", "count")
+
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+def _ident(name):
+    if not _IDENTIFICADOR.match(str(name)):
+        raise APIError(f"Identificador inválido: {name!r}")
+    return f'"{name}"'
+
+
+def _split_columns(columns):
+    """Separa "a, b, tabela(c, d)" nos campos de primeiro nível."""
+    parts, depth, current = [], 0, ""
+    for ch in ",".join(columns):
+        if ch == "," and depth == 0:
+            parts.append(current.strip())
+            current = ""
+            continue
+        depth += ch == "("
+        depth -= ch == ")"
+        current += ch
+    parts.append(current.strip())
+    return [p for p in parts if p]
+
+
+def _like(pattern):
+    # o PostgREST aceita * no lugar de %
+    return str(pattern).replace("*", "%")
+
+
+def _lower(value):
+    # lower() do SQLite só trata ASCII; o casefold cobre acentos
+    return None if value is None else str(value).casefold()
+
+
+class QueryBuilder:
+
+    def __init__(self, client, table):
+        self._client = client
+        self._table = _ident(table)
+        self._name = table
+        self._op = "select"
+        self._columns = ["*"]
+        self._count = None
+        self._head = False
+        self._filters = []
+        self._params = []
+        self._order = []
+        self._limit = None
+        self._offset = None
+        self._single = False
+        self._payload = None
+        self._on_conflict = None
+
+    # --- operações ---
+
+    def select(self, *columns, count=None, head=False):
+        self._op = "select"
+        self._columns = _split_columns(columns) or ["*"]
+        self._count = count
+        self._head = head
+        return self
+
+    def insert(self, rows):
+        self._op, self._payload = "insert", rows
+        return self
+
+    def upsert(self, rows, on_conflict="id"):
+        self._op, self._payload = "upsert", rows
+        self._on_conflict = [c.strip() for c in on_conflict.split(",")]
+        return self
+
+    def update(self, values):
+        self._op, self._payload = "update", values
+        return self
+
+    def delete(self):
+        self._op = "delete"
+        return self
+
+    # --- filtros ---
+
+    def _filter(self, sql, *params):
+        self._filters.append(sql)
+        self._params.extend(params)
+        return self
+
+    def eq(self, column, value):
+        return self._filter(f"t.{_ident(column)} = ?", value)
+
+    def neq(self, column, value):
+        return self._filter(f"t.{_ident(column)} <> ?", value)
+
+    def gt(self, column, value):
+        return self._filter(f"t.{_ident(column)} > ?", value)
+
+    def gte(self, column, value):
+        return self._filter(f"t.{_ident(column)} >= ?", value)
+
+    def lt(self, column, value):
+        return self._filter(f"t.{_ident(column)} < ?", value)
+
+    def lte(self, column, value):
+        return self._filter(f"t.{_ident(column)} <= ?", value)
+
+    def like(self, column, pattern):
+        return self._filter(f"t.{_ident(column)} LIKE ?", _like(pattern))
+
+    def ilike(self, column, pattern):
+        return self._filter(
+            f"py_lower(t.{_ident(column)}) LIKE ?", _lower(_like(pattern)))
+
+    def is_(self, column, value):
+        if value is None or str(value).lower() == "null":
+            return self._filter(f"t.{_ident(column)} IS NULL")
+        return self._filter(f"t.{_ident(column)} IS ?", value)
+
+    def in_(self, column, values):
+        values = list(values)
+        if not values:
+            return self._filter("0")
+        marks = ", ".join("?" * len(values))
+        return self._filter(f"t.{_ident(column)} IN ({marks})", *values)
+
+    def or_(self, filters):
+        """Filtros no formato do PostgREST: "col.op.valor,col.op.valor"."""
+        operators = {"eq": "=", "neq": "<>", "gt": ">", "gte": ">=",
+                     "lt": "<", "lte": "<=", "like": "LIKE"}
+        sql, params = [], []
+        for part in filters.split(","):
+            column, op, value = part.strip().split(".", 2)
+            if op == "ilike":
+                sql.append(f"py_lower(t.{_ident(column)}) LIKE ?")
+                params.append(_lower(_like(value)))
+            elif op == "is" and value.lower() == "null":
+                sql.append(f"t.{_ident(column)} IS NULL")
+            elif op in operators:
+                sql.append(f"t.{_ident(column)} {operators[op]} ?")
+                params.append(_like(value) if op == "like" else value)
+            else:
+                raise APIError(f"Operador não suportado: {op}")
+        return self._filter(f"({' OR '.join(sql)})", *params)
+
+    # --- ordenação e paginação ---
+
+    def order(self, column, desc=False, nullsfirst=None):
+        nulls = "" if nullsfirst is None else (
+            " NULLS FIRST" if nullsfirst else " NULLS LAST")
+        self._order.append(
+            f"t.{_ident(column)} {'DESC' if desc else 'ASC'}{nulls}")
+        return self
+
+    def limit(self, size):
+        self._limit = int(size)
+        return self
+
+    def range(self, start, end):
+        self._offset = int(start)
+        self._limit = int(end) - int(start) + 1
+        return self
+
+    def single(self):
+        self._single = True
+        return self
+
+    # --- execução ---
+
+    def execute(self):
+        with self._client.lock:
+            conn = self._client.connection
+            with conn:
+                result = getattr(self, f"_execute_{self._op}")(conn)
+        if self._single:
+            if len(result.data) != 1:
+                raise APIError(
+                    "JSON object requested, multiple (or no) rows returned",
+                    code="PGRST116")
+            result.data = result.data[0]
+        return result
+
+    def _where(self):
+        return f" WHERE {' AND '.join(self._filters)}" if self._filters else ""
+
+    def _execute_select(self, conn):
+        fields, joins, embeds = [], [], []
+        for i, column in enumerate(self._columns):
+            embedded = _EMBUTIDO.match(column)
+            if embedded:
+                other, inner = embedded.groups()
+                key = FOREIGN_KEYS.get((self._name, other))
+                if key is None:
+                    raise APIError(f"Relação não encontrada: {self._name} → {other}")
+                alias = f"e{i}"
+                joins.append(f" LEFT JOIN {_ident(other)} {alias}"
+                             f" ON {alias}.id = t.{_ident(key)}")
+                names = [c.strip() for c in inner.split(",") if c.strip()]
+                fields += [f'{alias}.{_ident(c)} AS "{alias}__{c}"' for c in names]
+                embeds.append((other, alias, key, names))
+            elif column == "*":
+                fields.append("t.*")
+            else:
+                fields.append(f"t.{_ident(column)}")
+
+        where = self._where()
+        sql = f"SELECT {', '.join(fields)} FROM {self._table} t{''.join(joins)}{where}"
+        if self._order:
+            sql += f" ORDER BY {', '.join(self._order)}"
+        if self._limit is not None or self._offset is not None:
+            sql += f" LIMIT {self._limit if self._limit is not None else -1}"
+            sql += f" OFFSET {self._offset or 0}"
+        rows = []
+        # head: só a contagem, sem as linhas
+        for row in () if self._head else conn.execute(sql, self._params):
+            item = dict(row)
+            for other, alias, key, names in embeds:
+                values = {c: item.pop(f"{alias}__{c}") for c in names}
+                item[other] = values if item.get(key) is not None else None
+            rows.append(item)
+
+        count = None
+        if self._count:
+            count = conn.execute(
+                f"SELECT COUNT(*) FROM {self._table} t{where}", self._params).fetchone()[0]
+        return APIResponse(rows, count)
+
+    def _rows(self):
+        return self._payload if isinstance(self._payload, list) else [self._payload]
+
+    def _execute_insert(self, conn):
+        data = []
+        for row in self._rows():
+            columns = ", ".join(_ident(c) for c in row)
+            marks = ", ".join("?" * len(row))
+            data.append(dict(conn.execute(
+                f"INSERT INTO {self._table} ({columns}) VALUES ({marks}) RETURNING *",
+                list(row.values())).fetchone()))
+        return APIResponse(data)
+
+    def _execute_upsert(self, conn):
+        target = ", ".join(_ident(c) for c in self._on_conflict)
+        data = []
+        for row in self._rows():
+            columns = ", ".join(_ident(c) for c in row)
+            marks = ", ".join("?" * len(row))
+            updates = ", ".join(f"{_ident(c)} = excluded.{_ident(c)}"
+                                for c in row if c not in self._on_conflict)
+            action = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+            result = conn.execute(
+                f"INSERT INTO {self._table} ({columns}) VALUES ({marks})"
+                f" ON CONFLICT ({target}) {action} RETURNING *",
+                list(row.values())).fetchone()
+            if result is not None:
+                data.append(dict(result))
+        return APIResponse(data)
+
+    def _execute_update(self, conn):
+        values = self._payload
+        sets = ", ".join(f"{_ident(c)} = ?" for c in values)
+        sql = f"UPDATE {self._table} AS t SET {sets}{self._where()} RETURNING *"
+        rows = conn.execute(sql, [*values.values(), *self._params]).fetchall()
+        return APIResponse([dict(r) for r in rows])
+
+    def _execute_delete(self, conn):
+        sql = f"DELETE FROM {self._table} AS t{self._where()} RETURNING *"
+        return APIResponse([dict(r) for r in conn.execute(sql, self._params).fetchall()])
+
+
+def _atualizar_custos_produtos(conn, custos):
+    # mesma regra da função SQL do Supabase: só grava se a fórmula não mudou
+    now = datetime.now(timezone.utc).isoformat()
+    cursor = conn.executemany(
+        "UPDATE produtos_custos SET custo_calculado = ?, calculado_em = ?"
+        " WHERE id = ? AND formula IS ?",
+        [(c.get("custo"), now, c["id"], c.get("formula")) for c in custos])
+    return cursor.rowcount
+
+
+RPCS = {"atualizar_custos_produtos": _atualizar_custos_produtos}
+
+
+class RPCRequest:
+
+    def __init__(self, client, function, params):
+        self._client = client
+        self._function = function
+        self._params = params or {}
+
+    def execute(self):
+        function = RPCS.get(self._function)
+        if function is None:
+            raise APIError(f"Função não encontrada: {self._function}", code="PGRST202")
+        with self._client.lock:
+            conn = self._client.connection
+            with conn:
+                return APIResponse(function(conn, **self._params))
+
+
+class SQLiteClient:
+    """Cliente com a mesma interface usada do cliente Supabase. Uma conexão
+    por processo, compartilhada entre threads com um lock."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.create_function(
+            "py_lower", 1, _lower, deterministic=True)
+        if path != ":memory:":
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(SCHEMA)
+        self._add_columns()
+
+    def _add_columns(self):
+        for table, column, kind in COLUNAS_NOVAS:
+            existing = {r["name"] for r in self.connection.execute(
+                f"PRAGMA table_info({_ident(table)})")}
+            if column not in existing:
+                self.connection.execute(
+                    f"ALTER TABLE {_ident(table)} ADD COLUMN {_ident(column)} {kind}")
+
+    def table(self, name):
+        return QueryBuilder(self, name)
+
+    def from_(self, name):
+        return self.table(name)
+
+    def rpc(self, function, params=None):
+        return RPCRequest(self, function, params)
+
+    def close(self):
+        self.connection.close()
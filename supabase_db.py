@@ -1,10 +1,323 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+import httpx
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx, add_script_run_ctx
+from streamlit.runtime.scriptrunner_utils.script_run_context import SCRIPT_RUN_CONTEXT_ATTR_NAME
 from supabase import create_client
 from supabase.client import ClientOptions
+from perfil import span, current_profile, payload_size
 
 
-def get_supabase_client():
+def get_setting(name, default=None):
+    """Lê uma configuração de st.secrets, com fallback para o ambiente."""
+    try:
+        if name in st.secrets:
+            return st.secrets[name]
+    except FileNotFoundError:
+        pass
+    return os.environ.get(name, default)
+
+
+SUPABASE_POOL_SIZE = int(get_setting("SUPABASE_POOL_SIZE", 10))
+SUPABASE_TIMEOUT = float(get_setting("SUPABASE_TIMEOUT", 30))
+SUPABASE_KEEPALIVE = float(get_setting("SUPABASE_KEEPALIVE", 60))
+# consultas independentes de uma página feitas ao mesmo tempo
+SUPABASE_CONCORRENCIA = int(get_setting("SUPABASE_CONCORRENCIA", 4))
+
+
+class ConnectionStats:
+    """Conta as conexões HTTP abertas e as requisições que reaproveitaram
+    uma conexão já existente do pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created = 0
+        self.requests = 0
+
+    def _trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.created += 1
+
+    def on_request(self, request):
+        request.extensions["trace"] = self._trace
+        with self._lock:
+            self.requests += 1
+
+    @property
+    def reused(self):
+        return max(self.requests - self.created, 0)
+
+
+@st.cache_resource(show_spinner=False)
+def get_connection_stats():
+    return ConnectionStats()
+
+
+# "supabase" (padrão) ou "sqlite" para um banco local em SQLITE_PATH
+BACKEND = str(get_setting("BACKEND", "supabase")).lower()
+SQLITE_PATH = get_setting("SQLITE_PATH", "custos.db")
+
+
+@st.cache_resource(show_spinner=False)
+def _get_backend_client():
+    # Um único cliente por processo, compartilhado por todas as sessões.
+    # O httpx.Client é thread-safe e mantém as conexões abertas (keep-alive).
+    if BACKEND == "sqlite":
+        from sqlite_db import SQLiteClient
+        return SQLiteClient(SQLITE_PATH)
     url = st.secrets["SUPABASE_URL"]
     key = st.secrets["SUPABASE_KEY"]
-    opts = ClientOptions(schema="public")  # força usar o public
+    http = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=SUPABASE_POOL_SIZE,
+            max_keepalive_connections=SUPABASE_POOL_SIZE,
+            keepalive_expiry=SUPABASE_KEEPALIVE,
+        ),
+        timeout=httpx.Timeout(SUPABASE_TIMEOUT),
+        follow_redirects=True,
+        event_hooks={"request": [get_connection_stats().on_request]},
+    )
+    opts = ClientOptions(schema="public", httpx_client=http)  # força usar o public
     return create_client(url, key, options=opts)
+
+
+# --- Consultas por Execução do Script ---
+#
+# Dentro de uma mesma execução do script (rerun), consultas de leitura
+# idênticas (mesma tabela, mesmos filtros, mesma ordem) vão ao banco uma
+# única vez; as repetições recebem a mesma resposta. Qualquer escrita limpa
+# as respostas guardadas. Fora de uma execução (ex.: a thread de recálculo)
+# o cliente é usado diretamente.
+
+_WRITES = {"insert", "update", "upsert", "delete"}
+
+
+class RerunScope:
+    """Respostas e contadores de consultas de uma execução do script."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.backend_calls = 0
+        self.coalesced = 0
+        # fetch_by_ids: linhas já lidas por (tabela, colunas)
+        self.rows = {}
+
+    def clear(self):
+        with self.lock:
+            self.responses.clear()
+            self.rows.clear()
+
+
+def _script_running():
+    return get_script_run_ctx(suppress_warning=True) is not None
+
+
+def start_rerun_scope():
+    """Inicia os contadores e o cache de consultas da execução atual.
+    Chamado no início de main.py."""
+    st.session_state["_consultas_execucao"] = RerunScope()
+
+
+def is_fragment_run():
+    """True quando só um fragmento (st.fragment) roda de novo, sem passar
+    por main.py."""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return bool(ctx is not None and ctx.fragment_ids_this_run)
+
+
+def get_rerun_scope():
+    """Escopo da execução atual, ou None fora de uma execução do script."""
+    if not _script_running():
+        return None
+    scope = st.session_state.get("_consultas_execucao")
+    if scope is None:
+        scope = RerunScope()
+        st.session_state["_consultas_execucao"] = scope
+    return scope
+
+
+class _CoalescedQuery:
+    """Repassa as chamadas ao builder do cliente e guarda a sequência delas,
+    que identifica a consulta."""
+
+    def __init__(self, scope, builder, calls):
+        self._scope = scope
+        self._builder = builder
+        self._calls = calls
+        self._read_only = True
+
+    def __getattr__(self, name):
+        attr = getattr(self._builder, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            if name in _WRITES:
+                self._read_only = False
+            self._builder = attr(*args, **kwargs)
+            self._calls.append((name, args, sorted(kwargs.items())))
+            return self
+        return call
+
+    def _label(self):
+        # "tabela.operação" (ex.: produtos_custos.select) ou "rpc.função"
+        kind, name = self._calls[0]
+        op = next((c[0] for c in self._calls[1:] if c[0] in _WRITES or c[0] == "select"), "")
+        return f"{name}.{op}" if kind == "table" else f"rpc.{name}"
+
+    def execute(self):
+        scope = self._scope
+        key = repr(self._calls) if self._read_only else None
+        if key is not None:
+            with scope.lock:
+                cached = scope.responses.get(key)
+                if cached is not None:
+                    scope.coalesced += 1
+            if cached is not None:
+                with span("banco (repetidas)", self._label()):
+                    return cached
+        with span("banco", self._label()) as info:
+            result = self._builder.execute()
+            if current_profile() is not None:
+                data = result.data
+                info["count"] = len(data) if isinstance(data, list) else 1
+                info["size"] = payload_size(data)
+        with scope.lock:
+            scope.backend_calls += 1
+        if key is None:
+            scope.clear()
+        else:
+            with scope.lock:
+                scope.responses[key] = result
+        return result
+
+
+class CoalescingClient:
+    """Cliente do banco com as consultas de leitura agrupadas por execução."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name):
+        scope = get_rerun_scope()
+        if scope is None:
+            return self._client.table(name)
+        return _CoalescedQuery(scope, self._client.table(name), [("table", name)])
+
+    def from_(self, name):
+        return self.table(name)
+
+    def rpc(self, function, params=None):
+        request = self._client.rpc(function, params or {})
+        scope = get_rerun_scope()
+        if scope is None:
+            return request
+        query = _CoalescedQuery(scope, request, [("rpc", function)])
+        query._read_only = False
+        return query
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def get_supabase_client():
+    """Cliente do banco configurado (Supabase ou SQLite), compartilhado pelo
+    processo, com as leituras repetidas de uma execução agrupadas."""
+    return CoalescingClient(_get_backend_client())
+
+
+def fetch_by_ids(table, ids, columns="*"):
+    """
+    Linhas de `table` por id: {id: linha}, em uma única consulta `in_`. As
+    linhas ficam guardadas até o fim da execução, e só os ids ainda não lidos
+    vão ao banco.
+    """
+    ids = set(ids)
+    scope = get_rerun_scope() or RerunScope()
+    key = (table, columns)
+    with scope.lock:
+        known = scope.rows.setdefault(key, {})
+        missing = ids - known.keys()
+    if missing:
+        sb = _get_backend_client()
+        with span("banco", f"{table}.select (ids)", len(missing)):
+            data = sb.table(table).select(columns).in_(
+                "id", sorted(missing)).execute().data or []
+        with scope.lock:
+            scope.backend_calls += 1
+            known.update({row["id"]: row for row in data})
+    return {i: known[i] for i in ids if i in known}
+
+
+def fetch_all_rows(sb, table, columns, batch_size=1000):
+    """
+    Lê uma tabela inteira em lotes por cursor em `id` (o PostgREST limita o
+    número de linhas por resposta). Gera as linhas lote a lote.
+    """
+    last_id = None
+    while True:
+        q = sb.table(table).select(columns).order("id").limit(batch_size)
+        if last_id is not None:
+            q = q.gt("id", last_id)
+        rows = q.execute().data or []
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1]["id"]
+
+
+@st.cache_resource(show_spinner=False)
+def _get_executor():
+    # um único pool por processo: o limite vale para todas as sessões juntas
+    return ThreadPoolExecutor(max_workers=max(1, SUPABASE_CONCORRENCIA),
+                              thread_name_prefix="consulta")
+
+
+def _with_ctx(func, ctx):
+    """`func` rodando com o contexto da execução do script de quem chamou;
+    a thread do pool fica sem contexto ao terminar."""
+    def run():
+        if ctx is None:
+            return func()
+        thread = threading.current_thread()
+        add_script_run_ctx(thread, ctx)
+        try:
+            return func()
+        finally:
+            setattr(thread, SCRIPT_RUN_CONTEXT_ATTR_NAME, None)
+    return run
+
+
+def run_concurrently(calls, timeout=SUPABASE_TIMEOUT):
+    """
+    Executa ao mesmo tempo as funções de `calls` ({nome: função sem
+    argumentos}) no pool do processo, de SUPABASE_CONCORRENCIA threads, com o
+    contexto da execução atual do script (cache de consultas e perfil
+    continuam valendo). Retorna {nome: resultado}; uma função que falhou, ou
+    não terminou em `timeout` segundos, tem a exceção no lugar do resultado.
+    As funções não devem desenhar na página: os erros são mostrados por quem
+    chamou.
+    """
+    if not calls:
+        return {}
+    ctx = get_script_run_ctx(suppress_warning=True)
+    executor = _get_executor()
+    futures = {name: executor.submit(_with_ctx(func, ctx)) for name, func in calls.items()}
+    deadline = time.monotonic() + timeout
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result(max(deadline - time.monotonic(), 0))
+        except FuturesTimeout:
+            # as que ainda não começaram saem da fila; as que já rodam
+            # terminam sozinhas, ocupando uma das threads do pool
+            future.cancel()
+            results[name] = TimeoutError(f"tempo esgotado ({timeout:g} s)")
+        except Exception as e:
+            results[name] = e
+    return results
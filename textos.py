@@ -7,7 +7,7 @@ TEXTOS = {
     # Seção: Calculadora de Preços
     "calc_menu_titulo_texto": "Menu da Calculadora",
     "calc_menu_titulo_style": "font-size:24px; margin-bottom:-10px;",
-    "calc_menu_opcoes": ["Calcular Preço", "Variáveis"],
+    "calc_menu_opcoes": ["Calcular Preço", "Simulação de Preços", "Variáveis"],
     "calc_titulo_texto": "Calculadora de Preços",
     "calc_titulo_style": "font-size:28px; margin-bottom:-10px;",
     "calc_dados_base": "Dados Base",
@@ -21,16 +21,27 @@ TEXTOS = {
     "var_titulo": "Gerenciar Pesos e Perdas por Tipo de Placa",
     "var_selecione_texto": "Selecionar Placa",
     "var_selecione_style": "font-size:24px; margin-bottom:0px;",
-    "var_placas": {
-        "50": "Placa 50x50cm",
-        "30": "Placa 30x30cm",
-        "25": "Placa 25x25cm"
-    },
+    "var_placa": "Placa {tamanho}cm",
+    "var_adicionar_placa": "Adicionar Tipo de Placa",
+    "var_sem_placas": "Nenhum tipo de placa cadastrado. Adicione um tamanho acima.",
+
+    # Submenu: Simulação de Preços
+    "sim_titulo_texto": "Simulação de Preços",
+    "sim_descricao": "Custo de cada placa para todas as combinações de preço do PS e frete nas faixas abaixo.",
 
     # Seção: Custos de Produção
     "prod_titulo": "Custos de Produção",
-    "prod_menu_opcoes": ["Produtos", "Variáveis de Custos", "Gerenciar Categorias"],
+    "prod_menu_opcoes": ["Produtos", "Variáveis de Custos", "Gerenciar Categorias", "Cenários", "Sensibilidade", "Histórico", "Importar/Exportar"],
     "prod_menu_titulo": "Menu",
     "prod_variaveis": "Variáveis de Produção",
-    "prod_produtos": "Produtos e Fórmulas"
+    "prod_produtos": "Produtos e Fórmulas",
+    "cen_titulo": "Cenários de Custo",
+    "cen_descricao": "Cada linha altera uma variável em um cenário (ex.: PS +8%, frete -3%), sem mudar os valores cadastrados. Linhas com o mesmo nome de cenário são combinadas.",
+    "sens_titulo": "Sensibilidade dos Custos",
+    "sens_descricao": "Variação do custo de cada produto quando cada variável que ele usa sobe {passo}%. O ranking soma o impacto de cada variável em todo o catálogo.",
+    "hist_titulo": "Histórico de Custos",
+    "hist_descricao": "Custos calculados com os valores que as variáveis tinham em cada data, guardados a cada alteração. As fórmulas usadas são as atuais.",
+    "imp_titulo": "Importar e Exportar",
+    "imp_colunas_produtos": "Colunas: nome, formula e, opcional, categoria. Produtos com nome já cadastrado são atualizados.",
+    "imp_colunas_variaveis": "Colunas: nome, valor e, opcional, categoria. Variáveis com nome já cadastrado são atualizadas."
 }